@@ -0,0 +1,122 @@
+"""スタッフ用: 全受診者のスコア分布と参照テーブルとの乖離を確認する管理ページ。
+
+    streamlit run admin.py
+
+results / questionnaires をキーセットページングで全件読み、ページごとに
+cohort_stats のヒストグラムへ加算する（保持するのは集計配列だけ）。
+"""
+
+import plotly.graph_objects as go
+import streamlit as st
+
+from athero_percentiles import AGE_GROUPS, GENDER_LABELS, GENDERS, METRIC_SPECS, PERCENTILE_LABELS
+from cohort_stats import PSI_ALERT, PSI_WARN, CohortAggregator
+from service_client import create_service_client
+from staff_auth import require_staff
+from visit_stream import STREAM_PAGE_SIZE, iter_visit_batches
+
+st.set_page_config(page_title="コホート集計（スタッフ用）", layout="wide")
+st.title("コホート集計（スタッフ用）")
+
+# --- スタッフ認証 ---
+require_staff()
+
+
+@st.cache_resource
+def get_service_client():
+    return create_service_client()
+
+
+METRIC_TITLES = {
+    "atherosclerosis_risk": "血管健康リスク（左右平均）",
+    "glaucoma_risk": "視界の健康リスク（左右別）",
+    "fundus_age_delta": "眼底年齢 − 撮影時年齢（左右別）",
+}
+
+if "cohort_aggregator" not in st.session_state:
+    st.session_state.cohort_aggregator = None
+
+# --- 集計の実行 ---
+with st.sidebar:
+    page_size = st.number_input("1ページの行数", min_value=50, max_value=5000, value=STREAM_PAGE_SIZE, step=50)
+    start = st.button("全件を集計する", type="primary")
+    resume = st.button(
+        "前回の続きから集計する",
+        disabled=st.session_state.cohort_aggregator is None,
+        help="前回の集計の最後の行より後に追加された結果だけを加算します。",
+    )
+
+if start or resume:
+    if start or st.session_state.cohort_aggregator is None:
+        st.session_state.cohort_aggregator = CohortAggregator()
+    aggregator = st.session_state.cohort_aggregator
+    status = st.status("集計中…", expanded=False)
+    progress = st.empty()
+    for batch in iter_visit_batches(get_service_client(), after=aggregator.cursor, page_size=int(page_size)):
+        aggregator.add_batch(batch)
+        progress.caption(f"{aggregator.rows:,} 行 / {aggregator.visits:,} 撮影を集計済み")
+    status.update(label="集計が完了しました", state="complete")
+
+aggregator = st.session_state.cohort_aggregator
+if aggregator is None:
+    st.info("サイドバーの「全件を集計する」を押すと、results と questionnaires を読み込んで集計します。")
+    st.stop()
+
+cols = st.columns(4)
+cols[0].metric("撮影数", f"{aggregator.visits:,}")
+cols[1].metric("results の行数", f"{aggregator.rows:,}")
+cols[2].metric("問診なし", f"{aggregator.missing_questionnaire:,}")
+cols[3].metric("性別未登録", f"{aggregator.unknown_gender:,}")
+if aggregator.cursor is not None:
+    st.caption(f"最後に集計した撮影日時: {aggregator.cursor.captured_datetime}")
+
+# --- 指標ごとの分布 ---
+metric = st.selectbox("指標", list(METRIC_SPECS), format_func=lambda m: METRIC_TITLES.get(m, m))
+histogram = aggregator.histograms[metric]
+if histogram.out_of_range:
+    st.caption(f"※ 表示範囲外の値 {histogram.out_of_range:,} 件は両端のビンに含めています。")
+
+filter_cols = st.columns(2)
+gender = filter_cols[0].selectbox(
+    "性別", [None, *GENDERS], format_func=lambda g: "すべて" if g is None else GENDER_LABELS[g]
+)
+age_group = filter_cols[1].selectbox(
+    "年代", [None, *AGE_GROUPS], format_func=lambda a: "すべて" if a is None else f"{a}代"
+)
+centers, counts = aggregator.histogram(metric, gender, age_group)
+figure = go.Figure(go.Bar(x=centers, y=counts, marker_color="#4a90d9"))
+figure.update_layout(
+    height=320, margin=dict(l=20, r=20, t=20, b=20), bargap=0,
+    xaxis_title=METRIC_TITLES.get(metric, metric), yaxis_title="件数",
+    xaxis_type="log" if histogram.log_scale else "linear",
+)
+st.plotly_chart(figure, use_container_width=True)
+
+# --- 性別・年代ごとの件数・十分位・参照テーブルとの乖離 ---
+st.markdown("#### 性別・年代ごとの十分位と参照テーブルとの乖離（PSI）")
+st.caption(
+    f"十分位はヒストグラムからの近似値です。PSI は {PSI_WARN} 未満で安定、"
+    f"{PSI_ALERT} 以上で参照テーブルの見直しを検討してください。"
+)
+rows = []
+for row in aggregator.group_rows(metric):
+    psi = row["psi"]
+    table_row = {
+        "グループ": row["group"],
+        "件数": row["n"],
+        "平均": None if row["mean"] is None else round(row["mean"], 3),
+    }
+    for label, value in zip(PERCENTILE_LABELS, row["deciles"] or [None] * len(PERCENTILE_LABELS)):
+        table_row[f"{label}%"] = value
+    table_row["参照件数"] = row["reference_n"]
+    table_row["PSI"] = None if psi is None else round(psi, 3)
+    table_row["判定"] = (
+        "" if psi is None else "要見直し" if psi >= PSI_ALERT else "注意" if psi >= PSI_WARN else "安定"
+    )
+    rows.append(table_row)
+if rows:
+    # 動脈硬化リスクの十分位は 1e-6 程度の値もあるので、有効数字で表示する
+    decile_format = {f"{label}%": st.column_config.NumberColumn(format="%.3g") for label in PERCENTILE_LABELS}
+    st.dataframe(rows, hide_index=True, use_container_width=True, column_config=decile_format)
+else:
+    st.info("この指標の集計データ・参照データはまだありません。")
@@ -1,8 +1,21 @@
-"""動脈硬化リスクの性別・年代別十分位参照データと相対位置計算。"""
+"""性別・年代別の十分位参照データと、同年代・同性の中での相対位置計算。
+
+動脈硬化リスクのほか、視界の健康リスク（緑内障）や眼底年齢の差など複数の指標を
+METRIC_SPECS に登録し、evaluate_visit で1回の撮影の全指標を NumPy でまとめて評価する。
+"""
 
 from __future__ import annotations
 
-import plotly.graph_objects as go
+import hashlib
+import json
+import math
+
+from typing import TYPE_CHECKING, Callable
+
+import numpy as np
+
+if TYPE_CHECKING:
+    import plotly.graph_objects as go
 
 PERCENTILE_LABELS = [0, 10, 20, 30, 40, 50, 60, 70, 80, 90, 100]
 
@@ -171,7 +184,15 @@ ATHERO_PERCENTILE_TABLE: dict[tuple[str, int], dict] = {
     },
 }
 
+# 視界の健康リスク（緑内障）と眼底年齢の差（眼底年齢 − 撮影時年齢）の参照データ。
+# 集計済みのデータが揃ったら ATHERO_PERCENTILE_TABLE と同じ形式で追加する。
+# 参照データのないグループは絶対評価だけを表示する。
+GLAUCOMA_PERCENTILE_TABLE: dict[tuple[str, int], dict] = {}
+FUNDUS_AGE_DELTA_PERCENTILE_TABLE: dict[tuple[str, int], dict] = {}
+
 GENDER_LABELS = {"M": "男性", "F": "女性"}
+GENDERS = ("M", "F")
+AGE_GROUPS = (0, 10, 20, 30, 40, 50, 60, 70, 80)
 
 
 def get_age_group(age: int) -> int:
@@ -185,7 +206,9 @@ def lookup_percentiles(gender: str, age_group: int) -> dict | None:
 
 
 def score_to_percentile(score: float, percentiles: list[float]) -> float:
-    """リスクスコアを同グループ内の百分位（0–100）に変換する。"""
+    """リスクスコアを同グループ内の百分位（0–100）に変換する。NaN は NaN のまま返す。"""
+    if math.isnan(score):
+        return math.nan
     if score <= percentiles[0]:
         return 0.0
     if score >= percentiles[-1]:
@@ -211,6 +234,272 @@ def format_peer_group_label(gender: str, age_group: int) -> str:
     return f"{age_group}代・{gender_label}"
 
 
+class MetricSpec:
+    """相対位置を計算する指標の定義。
+
+    eye_value: 片眼の結果と撮影時年齢から指標の値を返す（値がなければ None）
+    per_eye: True なら左右それぞれを評価し、False なら左右の平均を評価する
+    absolute_thresholds: 絶対評価（low / medium / high）の境界。None なら絶対評価なし
+    """
+
+    __slots__ = ("name", "subject", "eye_value", "per_eye", "absolute_thresholds", "tables",
+                 "_breakpoints", "_sizes")
+
+    def __init__(self, name: str, subject: str, tables: dict[tuple[str, int], dict],
+                 eye_value: Callable[[object, int | None], float | None],
+                 per_eye: bool, absolute_thresholds: tuple[float, float] | None):
+        self.name = name
+        self.subject = subject
+        self.eye_value = eye_value
+        self.per_eye = per_eye
+        self.absolute_thresholds = absolute_thresholds
+        self.tables = tables
+        # (性別, 年代) ごとの十分位を (2, 9, 11) の配列に並べ、参照データのないグループは NaN
+        self._breakpoints = np.full((len(GENDERS), len(AGE_GROUPS), len(PERCENTILE_LABELS)), np.nan)
+        self._sizes = np.zeros((len(GENDERS), len(AGE_GROUPS)), dtype=np.int64)
+        for (gender, age_group), ref_data in tables.items():
+            g, a = GENDERS.index(gender), AGE_GROUPS.index(age_group)
+            self._breakpoints[g, a] = ref_data["percentiles"]
+            self._sizes[g, a] = ref_data["sample_size"]
+
+    def reference_rows(self, gender_idx: np.ndarray, age_idx: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        """各行の十分位と参考件数を返す。性別・年代が不明（-1）の行は NaN と 0。"""
+        valid = (gender_idx >= 0) & (age_idx >= 0)
+        g = np.where(valid, gender_idx, 0)
+        a = np.where(valid, age_idx, 0)
+        breakpoints = np.where(valid[:, None], self._breakpoints[g, a], np.nan)
+        sizes = np.where(valid, self._sizes[g, a], 0)
+        return breakpoints, sizes
+
+    def visit_values(self, visit, real_age: int | None) -> list[tuple[str | None, float]]:
+        """撮影結果からこの指標の (眼, 値) を作る。per_eye でなければ左右の平均を眼 None で1つ。"""
+        values = []
+        for result in visit.eyes():
+            value = self.eye_value(result, real_age)
+            if value is not None:
+                values.append((result.eye, float(value)))
+        if self.per_eye or not values:
+            return values
+        return [(None, sum(value for _eye, value in values) / len(values))]
+
+
+def _fundus_age_delta(result, real_age: int | None) -> float | None:
+    if result.fundus_age is None or real_age is None:
+        return None
+    return result.fundus_age - real_age
+
+
+METRIC_SPECS: dict[str, MetricSpec] = {
+    "fundus_age_delta": MetricSpec(
+        "fundus_age_delta", "眼底年齢", FUNDUS_AGE_DELTA_PERCENTILE_TABLE,
+        eye_value=_fundus_age_delta, per_eye=True, absolute_thresholds=None,
+    ),
+    "glaucoma_risk": MetricSpec(
+        "glaucoma_risk", "視界の健康リスク", GLAUCOMA_PERCENTILE_TABLE,
+        eye_value=lambda result, _real_age: result.glaucoma_risk, per_eye=True, absolute_thresholds=(0.3, 0.7),
+    ),
+    "atherosclerosis_risk": MetricSpec(
+        "atherosclerosis_risk", "血管健康リスク", ATHERO_PERCENTILE_TABLE,
+        eye_value=lambda result, _real_age: result.atherosclerosis_risk, per_eye=False, absolute_thresholds=(0.3, 0.7),
+    ),
+}
+
+# 参照テーブルと判定の境界のダイジェスト。PDF・スナップショットの内容ハッシュに含め、
+# 参照データを更新したら作り直されるようにする
+REFERENCE_DIGEST = hashlib.sha256(json.dumps(
+    {
+        name: {
+            "tables": sorted((f"{g}{a}", t["percentiles"], t["sample_size"]) for (g, a), t in spec.tables.items()),
+            "thresholds": spec.absolute_thresholds,
+        }
+        for name, spec in METRIC_SPECS.items()
+    },
+    sort_keys=True,
+).encode("utf-8")).hexdigest()
+
+
+def scores_to_percentiles(scores: np.ndarray, breakpoints: np.ndarray) -> np.ndarray:
+    """score_to_percentile の行ごとの一括版。breakpoints は (n, 11)、参照データのない行は NaN を返す。"""
+    scores = np.asarray(scores, dtype=float)
+    labels = np.asarray(PERCENTILE_LABELS, dtype=float)
+    # 各行で score 以上になる最初の十分位の位置（= score より小さい十分位の個数）
+    upper = np.clip((breakpoints < scores[:, None]).sum(axis=1), 1, len(labels) - 1)
+    rows = np.arange(len(scores))
+    low = breakpoints[rows, upper - 1]
+    high = breakpoints[rows, upper]
+    with np.errstate(invalid="ignore", divide="ignore"):
+        ratio = np.where(high > low, (scores - low) / (high - low), 1.0)
+    result = labels[upper - 1] + ratio * (labels[upper] - labels[upper - 1])
+    result = np.where(scores <= breakpoints[:, 0], 0.0, result)
+    result = np.where(scores >= breakpoints[:, -1], 100.0, result)
+    return np.where(np.isnan(breakpoints[:, 0]), np.nan, result)
+
+
+RELATIVE_RISK_LABELS = ("低い", "やや低い", "平均的", "やや高い", "高い")
+
+
+def relative_risk_labels(percentiles: np.ndarray) -> list[str | None]:
+    """get_relative_risk_label の一括版。NaN は None。"""
+    percentiles = np.asarray(percentiles, dtype=float)
+    index = np.searchsorted([20, 40, 60, 80], np.round(np.nan_to_num(percentiles)), side="left")
+    return [
+        None if math.isnan(p) else RELATIVE_RISK_LABELS[i]
+        for p, i in zip(percentiles.tolist(), index.tolist())
+    ]
+
+
+def encode_peer_groups(genders, ages) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """性別・年齢の列を (性別の添字, 年代の添字, 年代) の配列にする。
+
+    未登録の性別と負の年齢（誕生日が撮影より後）の添字は -1（get_age_group と同じく参照データなし）。
+    """
+    gender_idx = np.array([GENDERS.index(g) if g in GENDERS else -1 for g in genders], dtype=np.int64)
+    age_groups = np.minimum((np.asarray(ages, dtype=np.int64) // 10) * 10, 80)
+    return gender_idx, np.where(age_groups >= 0, age_groups // 10, -1), age_groups
+
+
+def absolute_levels(values: np.ndarray, thresholds: tuple[float, float] | None) -> list[str | None]:
+    """絶対評価（low / medium / high）の一括版。"""
+    if thresholds is None:
+        return [None] * len(values)
+    levels = np.searchsorted(thresholds, np.asarray(values, dtype=float), side="right")
+    return [("low", "medium", "high")[i] for i in levels.tolist()]
+
+
+def evaluate_metric_batch(metric: str, genders, ages, values):
+    """1つの指標を多数の人について一括評価する（エクスポートや一括スコアリング用）。
+
+    戻り値は (百分位の配列（参照データなしは NaN）, 相対ラベル, 参考件数の配列, 絶対評価)。
+    """
+    spec = METRIC_SPECS[metric]
+    values = np.asarray(values, dtype=float)
+    gender_idx, age_idx, _age_groups = encode_peer_groups(genders, ages)
+    breakpoints, sizes = spec.reference_rows(gender_idx, age_idx)
+    percentiles = scores_to_percentiles(values, breakpoints)
+    return (
+        percentiles,
+        relative_risk_labels(percentiles),
+        sizes,
+        absolute_levels(values, spec.absolute_thresholds),
+    )
+
+
+class PeerEvaluation:
+    """1つの指標（片眼または左右平均）の評価結果。"""
+
+    __slots__ = ("metric", "eye", "value", "percentile", "relative_label", "absolute_level",
+                 "peer_label", "sample_size")
+
+    def __init__(self, metric, eye, value, percentile, relative_label, absolute_level,
+                 peer_label, sample_size):
+        self.metric = metric
+        self.eye = eye  # "R" / "L"、左右平均なら None
+        self.value = value
+        self.percentile = percentile  # 参照データがなければ None
+        self.relative_label = relative_label
+        self.absolute_level = absolute_level
+        self.peer_label = peer_label
+        self.sample_size = sample_size
+
+    @property
+    def subject(self) -> str:
+        return METRIC_SPECS[self.metric].subject
+
+    def to_dict(self) -> dict:
+        return {name: getattr(self, name) for name in self.__slots__}
+
+
+class VisitPeerReport:
+    """1回の撮影の全指標の評価結果。Web ページと PDF の両方がこれを元に描画する。"""
+
+    __slots__ = ("gender", "real_age", "peer_label", "entries")
+
+    def __init__(self, gender, real_age, peer_label, entries: list[PeerEvaluation]):
+        self.gender = gender
+        self.real_age = real_age
+        self.peer_label = peer_label  # 性別が未登録なら None
+        self.entries = entries
+
+    def get(self, metric: str, eye: str | None = None) -> PeerEvaluation | None:
+        for entry in self.entries:
+            if entry.metric == metric and entry.eye == eye:
+                return entry
+        return None
+
+    def to_dict(self) -> dict:
+        return {
+            "gender": self.gender,
+            "real_age": self.real_age,
+            "peer_label": self.peer_label,
+            "entries": [entry.to_dict() for entry in self.entries],
+        }
+
+
+def visit_metric_values(visit, real_age: int | None) -> list[tuple[str, str | None, float]]:
+    """撮影結果から METRIC_SPECS の全指標の (指標, 眼, 値) の並びを作る。値のないものは含めない。"""
+    return [
+        (name, eye, value)
+        for name, spec in METRIC_SPECS.items()
+        for eye, value in spec.visit_values(visit, real_age)
+    ]
+
+
+def evaluate_visits(genders, ages, visits) -> list[VisitPeerReport]:
+    """evaluate_visit の一括版。全員の全指標を1回の計算で百分位に変換する（一括スコアリング用）。"""
+    gender_idx, age_idx, age_groups = encode_peer_groups(genders, ages)
+    peer_labels = [
+        format_peer_group_label(gender, int(age_group)) if gender in GENDERS and age_group >= 0 else None
+        for gender, age_group in zip(genders, age_groups)
+    ]
+    reports = [
+        VisitPeerReport(gender, real_age, peer_label, [])
+        for gender, real_age, peer_label in zip(genders, ages, peer_labels)
+    ]
+
+    # (人, 指標, 眼, 値) を1列に並べ、指標ごとに参照データの十分位を割り当てる
+    rows = [
+        (person, metric, eye, value)
+        for person, (visit, real_age) in enumerate(zip(visits, ages))
+        for metric, eye, value in visit_metric_values(visit, real_age)
+    ]
+    if not rows:
+        return reports
+    people = np.array([person for person, _metric, _eye, _value in rows], dtype=np.int64)
+    metrics = np.array([metric for _person, metric, _eye, _value in rows], dtype=object)
+    scores = np.array([value for _person, _metric, _eye, value in rows])
+    breakpoints = np.empty((len(rows), len(PERCENTILE_LABELS)))
+    sizes = np.empty(len(rows), dtype=np.int64)
+    levels: list[str | None] = [None] * len(rows)
+    for name, spec in METRIC_SPECS.items():
+        index = np.flatnonzero(metrics == name)
+        if not len(index):
+            continue
+        breakpoints[index], sizes[index] = spec.reference_rows(gender_idx[people[index]], age_idx[people[index]])
+        for i, level in zip(index.tolist(), absolute_levels(scores[index], spec.absolute_thresholds)):
+            levels[i] = level
+    percentiles = scores_to_percentiles(scores, breakpoints)
+    labels = relative_risk_labels(percentiles)
+
+    for i, (person, metric, eye, value) in enumerate(rows):
+        has_reference = not math.isnan(percentiles[i])
+        reports[person].entries.append(PeerEvaluation(
+            metric=metric,
+            eye=eye,
+            value=value,
+            percentile=float(percentiles[i]) if has_reference else None,
+            relative_label=labels[i],
+            absolute_level=levels[i],
+            peer_label=peer_labels[person] if has_reference else None,
+            sample_size=int(sizes[i]),
+        ))
+    return reports
+
+
+def evaluate_visit(gender: str | None, real_age: int, visit) -> VisitPeerReport:
+    """1回の撮影の全指標について、百分位・相対ラベル・絶対評価を一括で計算する。"""
+    return evaluate_visits([gender], [real_age], [visit])[0]
+
+
 def get_relative_risk_label(percentile: float) -> str:
     """百分位から5段階の相対リスクラベルを返す。"""
     p = round(percentile)
@@ -225,13 +514,15 @@ def get_relative_risk_label(percentile: float) -> str:
     return "高い"
 
 
-def format_relative_comparison_message(peer_label: str, percentile: float) -> str:
+def format_relative_comparison_message(
+    peer_label: str, percentile: float, subject: str = "血管健康リスク"
+) -> str:
     """同年代・同性との比較を直感的な文章に変換する（Markdown用）。"""
-    return format_relative_comparison_plain_text(peer_label, percentile, markdown=True)
+    return format_relative_comparison_plain_text(peer_label, percentile, markdown=True, subject=subject)
 
 
 def format_relative_comparison_plain_text(
-    peer_label: str, percentile: float, markdown: bool = False
+    peer_label: str, percentile: float, markdown: bool = False, subject: str = "血管健康リスク"
 ) -> str:
     """同年代・同性との比較を直感的な文章に変換する（PDF等のプレーンテキスト用）。"""
     label = get_relative_risk_label(percentile)
@@ -243,15 +534,15 @@ def format_relative_comparison_plain_text(
     if p <= 40:
         lower_pct = 100 - p
         return (
-            f"あなたの血管健康リスクは、{emph(peer_label)}の方と比べて {emph(label)} と推定されます。"
+            f"あなたの{subject}は、{emph(peer_label)}の方と比べて {emph(label)} と推定されます。"
             f"（同グループの約 {emph(str(lower_pct))}% の方よりリスクが低い位置です）"
         )
     if p <= 60:
         return (
-            f"あなたの血管健康リスクは、{emph(peer_label)}の方と比べて {emph(label)} と推定されます。"
+            f"あなたの{subject}は、{emph(peer_label)}の方と比べて {emph(label)} と推定されます。"
         )
     return (
-        f"あなたの血管健康リスクは、{emph(peer_label)}の方と比べて {emph(label)} と推定されます。"
+        f"あなたの{subject}は、{emph(peer_label)}の方と比べて {emph(label)} と推定されます。"
         f"（同グループの約 {emph(str(p))}% の方よりリスクが高い位置です）"
     )
 
@@ -302,8 +593,53 @@ def draw_athero_gauge_pdf(
     canvas.drawRightString(x_pt + width_pt, label_y, "高い")
 
 
+def build_athero_gauge_svg(percentile: float, width: int = 300) -> str:
+    """相対リスク位置を示す半円ゲージを SVG 文字列で返す（静的HTML用）。"""
+    display_value = max(0, min(100, round(percentile)))
+    risk_label = get_relative_risk_label(percentile)
+    cx, cy, r, band = 150, 150, 110, 36
+
+    def point(value: float, radius: float) -> tuple[float, float]:
+        angle = math.pi * (1 - value / 100)
+        return cx + radius * math.cos(angle), cy - radius * math.sin(angle)
+
+    def arc(start: float, end: float, color: str) -> str:
+        x1, y1 = point(start, r)
+        x2, y2 = point(end, r)
+        return (
+            f'<path d="M {x1:.1f} {y1:.1f} A {r} {r} 0 0 1 {x2:.1f} {y2:.1f}" '
+            f'fill="none" stroke="{color}" stroke-width="{band}"/>'
+        )
+
+    needle_x, needle_y = point(display_value, r + band / 2)
+    height = round(width * 200 / 300)
+    return (
+        f'<svg xmlns="http://www.w3.org/2000/svg" viewBox="0 0 300 200" '
+        f'width="{width}" height="{height}" role="img" aria-label="{risk_label}">'
+        + arc(0, 40, "#d4edda")
+        + arc(40, 60, "#fff3cd")
+        + arc(60, 100, "#f8d7da")
+        + f'<line x1="{cx}" y1="{cy}" x2="{needle_x:.1f}" y2="{needle_y:.1f}" '
+        'stroke="#333" stroke-width="4" stroke-linecap="round"/>'
+        f'<circle cx="{cx}" cy="{cy}" r="6" fill="#333"/>'
+        f'<text x="{cx}" y="{cy - 50}" text-anchor="middle" font-size="24">{risk_label}</text>'
+        f'<text x="30" y="{cy + 22}" text-anchor="middle" font-size="12" fill="#666">低い</text>'
+        f'<text x="{cx}" y="{cy + 22}" text-anchor="middle" font-size="12" fill="#666">平均的</text>'
+        f'<text x="270" y="{cy + 22}" text-anchor="middle" font-size="12" fill="#666">高い</text>'
+        f'<text x="{cx}" y="{cy + 42}" text-anchor="middle" font-size="11" fill="#999">'
+        "同年代・同性と比べた位置</text>"
+        "</svg>"
+    )
+
+
 def build_athero_gauge_figure(percentile: float) -> go.Figure:
-    """相対リスク位置を示す半円ゲージチャートを生成する。"""
+    """相対リスク位置を示す半円ゲージチャートを生成する。
+
+    図の JSON をキャッシュから読み直す（pio.from_json）のは図を作るのと同じくらいかかるので、毎回作る。
+    """
+    # plotly は読み込みが重いので、図を作るときだけ読み込む（一括スコアリングなどでは使わない）
+    import plotly.graph_objects as go
+
     display_value = round(percentile)
     risk_label = get_relative_risk_label(percentile)
 
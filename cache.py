@@ -0,0 +1,429 @@
+"""ビューア全体で使うキャッシュの共通インターフェースと差し替え可能なバックエンド。
+
+名前空間（Supabase の行・画像・バーコード・PDF・ゲージ）ごとに TTL・サイズ上限・
+値の形式を決め、ヒット／ミス数を集計する。バックエンドは環境変数で選ぶ。
+
+    VIEWER_CACHE_BACKEND=disk     ホスト内で共有するディスクキャッシュ（disk_cache.py、既定）
+    VIEWER_CACHE_BACKEND=memory   プロセス内 LRU
+    VIEWER_CACHE_BACKEND=redis    Redis プロトコルのサーバー（VIEWER_CACHE_URL=redis://host:port/db）
+
+Redis プロトコルのバックエンドは resp_server.py のローカル代替サーバーでも動く。
+個人情報を含む名前空間（shared=False）は、どのバックエンドを選んでもプロセス内 LRU にだけ置く。
+"""
+
+from __future__ import annotations
+
+import collections
+import json
+import os
+import socket
+import threading
+import time
+import urllib.parse
+from typing import Any, Callable
+
+from disk_cache import DiskCache, get_default_cache as get_default_disk_cache
+
+# Redis で期限のない名前空間に付ける期限（秒）。名前空間ごとの合計を守れない代わりに、古い値が残り続けないようにする
+RESP_DEFAULT_TTL = 30 * 24 * 3600
+
+
+class NamespaceConfig:
+    """名前空間ごとの設定。
+
+    ttl: 有効期限（秒、None なら無期限）
+    max_entry_bytes: これより大きい値はキャッシュしない
+    max_bytes: 名前空間全体の上限。プロセス内 LRU とディスクは名前空間ごとの LRU で守る。
+        Redis は書き込みのたびに名前空間ごとの合計を安く数えられないので、期限のない名前空間にも
+        RESP_DEFAULT_TTL の期限を付け、全体は Redis の maxmemory（allkeys-lru）に任せる。
+        これを超える1件の値はどのバックエンドでも保存しない
+    codec: "bytes"（そのまま）または "json"
+    shared: False ならディスクや外部のサーバーに書かず、プロセス内 LRU にだけ置く
+        （誕生日や問診の回答など、平文で共有の保存先に置きたくない値）
+    """
+
+    __slots__ = ("ttl", "max_entry_bytes", "max_bytes", "codec", "shared")
+
+    def __init__(
+        self,
+        ttl: float | None = None,
+        max_entry_bytes: int = 16 * 1024 ** 2,
+        max_bytes: int = 256 * 1024 ** 2,
+        codec: str = "bytes",
+        shared: bool = True,
+    ):
+        self.ttl = ttl
+        self.max_entry_bytes = max_entry_bytes
+        self.max_bytes = max_bytes
+        self.codec = codec
+        self.shared = shared
+
+
+DEFAULT_NAMESPACES: dict[str, NamespaceConfig] = {
+    # Supabase の行（解析結果・問診）。解析のやり直しに備えて短めにする。
+    # 誕生日や健康状態の回答を含むので、プロセスの外には置かない
+    "rows": NamespaceConfig(ttl=300, max_entry_bytes=256 * 1024, max_bytes=32 * 1024 ** 2, codec="json",
+                            shared=False),
+    # 撮影画像（URL ごとに不変）
+    "images": NamespaceConfig(ttl=7 * 24 * 3600, max_bytes=512 * 1024 ** 2),
+    # 受付番号のバーコード PNG
+    "barcodes": NamespaceConfig(ttl=None, max_entry_bytes=256 * 1024, max_bytes=16 * 1024 ** 2),
+    # PDF・サムネイルなどのレポート成果物
+    "reports": NamespaceConfig(ttl=30 * 24 * 3600, max_bytes=256 * 1024 ** 2),
+    # 本人確認の失敗（不一致の組み合わせ・uuid ごとの失敗回数）。プロセス間で共有して総当たりを抑える
+    "login": NamespaceConfig(ttl=15 * 60, max_entry_bytes=4 * 1024, max_bytes=4 * 1024 ** 2, codec="json"),
+}
+
+
+class CacheBackend:
+    """バックエンドの基底クラス。値は bytes（または bytes 互換のオブジェクト）。"""
+
+    name = "base"
+
+    def configure_namespace(self, namespace: str, config: NamespaceConfig) -> None:
+        """名前空間の設定を受け取る（必要なバックエンドだけが使う）。"""
+
+    def get(self, namespace: str, key: str):
+        raise NotImplementedError
+
+    def set(self, namespace: str, key: str, value: bytes, ttl: float | None) -> None:
+        raise NotImplementedError
+
+    def incr(self, namespace: str, key: str, ttl: float | None) -> int | None:
+        """整数値に1を足して返す（なければ 1）。同時に呼ばれても増分を失わない。"""
+        raise NotImplementedError
+
+    def delete(self, namespace: str, key: str) -> None:
+        raise NotImplementedError
+
+
+class MemoryLRUBackend(CacheBackend):
+    """プロセス内の LRU。名前空間ごとにサイズ上限を持つ。"""
+
+    name = "memory"
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # 名前空間 -> OrderedDict[key, (value, expires_at)]
+        self._data: dict[str, collections.OrderedDict] = collections.defaultdict(collections.OrderedDict)
+        self._sizes: collections.Counter = collections.Counter()
+        self._limits: dict[str, int] = {}
+        self.evictions: collections.Counter = collections.Counter()
+
+    def configure_namespace(self, namespace: str, config: NamespaceConfig) -> None:
+        self._limits[namespace] = config.max_bytes
+
+    def get(self, namespace: str, key: str):
+        with self._lock:
+            entries = self._data[namespace]
+            item = entries.get(key)
+            if item is None:
+                return None
+            value, expires_at = item
+            if expires_at is not None and expires_at <= time.monotonic():
+                self._remove(namespace, key)
+                return None
+            entries.move_to_end(key)
+            return value
+
+    def set(self, namespace: str, key: str, value: bytes, ttl: float | None) -> None:
+        with self._lock:
+            self._set_locked(namespace, key, value, ttl)
+
+    def incr(self, namespace: str, key: str, ttl: float | None) -> int:
+        with self._lock:
+            item = self._data[namespace].get(key)
+            value = 0
+            if item is not None and (item[1] is None or item[1] > time.monotonic()):
+                value = int(item[0])
+            value += 1
+            self._set_locked(namespace, key, str(value).encode("ascii"), ttl)
+            return value
+
+    def delete(self, namespace: str, key: str) -> None:
+        with self._lock:
+            self._remove(namespace, key)
+
+    def _set_locked(self, namespace: str, key: str, value: bytes, ttl: float | None) -> None:
+        expires_at = time.monotonic() + ttl if ttl is not None else None
+        self._remove(namespace, key)
+        limit = self._limits.get(namespace)
+        if limit is not None and len(value) > limit:
+            # 上限より大きい値を入れると、入れたばかりの値まで追い出してしまうので保存しない
+            self.evictions[namespace] += 1
+            return
+        self._data[namespace][key] = (value, expires_at)
+        self._sizes[namespace] += len(value)
+        entries = self._data[namespace]
+        while limit is not None and self._sizes[namespace] > limit and entries:
+            oldest = next(iter(entries))
+            self._remove(namespace, oldest)
+            self.evictions[namespace] += 1
+
+    def _remove(self, namespace: str, key: str) -> None:
+        item = self._data[namespace].pop(key, None)
+        if item is not None:
+            self._sizes[namespace] -= len(item[0])
+
+
+class DiskBackend(CacheBackend):
+    """ホスト内の全プロセスで共有するディスクキャッシュ。読み出しは mmap。"""
+
+    name = "disk"
+
+    def __init__(self, disk_cache: DiskCache | None = None):
+        self.disk_cache = disk_cache or DiskCache()
+
+    def configure_namespace(self, namespace: str, config: NamespaceConfig) -> None:
+        # 名前空間ごとの上限はキーの接頭辞ごとの LRU で守る（全体の上限は DiskCache.max_bytes）
+        self.disk_cache.set_prefix_limit(f"{namespace}:", config.max_bytes)
+
+    def get(self, namespace: str, key: str):
+        return self.disk_cache.get(f"{namespace}:{key}")
+
+    def set(self, namespace: str, key: str, value: bytes, ttl: float | None) -> None:
+        self.disk_cache.put(f"{namespace}:{key}", value, ttl=ttl)
+
+    def incr(self, namespace: str, key: str, ttl: float | None) -> int:
+        return self.disk_cache.incr(f"{namespace}:{key}", ttl=ttl)
+
+    def delete(self, namespace: str, key: str) -> None:
+        self.disk_cache.delete(f"{namespace}:{key}")
+
+
+class RespError(Exception):
+    """Redis プロトコルのサーバーがエラーを返した。"""
+
+
+class RespBackend(CacheBackend):
+    """Redis プロトコル（RESP2）のサーバーを使うバックエンド。
+
+    スレッドごとに接続を持ち、接続できないときやサーバーがエラーを返したときは
+    ミスとして扱う（ページを止めない）。
+    """
+
+    name = "redis"
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 6379, db: int = 0,
+                 timeout: float = 0.5, prefix: str = "viewer"):
+        self.host = host
+        self.port = port
+        self.db = db
+        self.timeout = timeout
+        self.prefix = prefix
+        self._local = threading.local()
+        self.errors = 0
+        self._default_ttls: dict[str, float] = {}
+
+    @classmethod
+    def from_url(cls, url: str) -> RespBackend:
+        parsed = urllib.parse.urlparse(url)
+        db = int(parsed.path.lstrip("/") or 0)
+        return cls(host=parsed.hostname or "127.0.0.1", port=parsed.port or 6379, db=db)
+
+    def _connect(self):
+        sock = socket.create_connection((self.host, self.port), timeout=self.timeout)
+        conn = (sock, sock.makefile("rb"))
+        self._local.conn = conn
+        if self.db:
+            self._command("SELECT", str(self.db))
+        return conn
+
+    def _close(self) -> None:
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            sock, reader = conn
+            reader.close()
+            sock.close()
+            self._local.conn = None
+
+    def _command(self, *args: str | bytes):
+        conn = getattr(self._local, "conn", None) or self._connect()
+        sock, reader = conn
+        parts = [f"*{len(args)}\r\n".encode()]
+        for arg in args:
+            data = arg.encode("utf-8") if isinstance(arg, str) else bytes(arg)
+            parts.append(f"${len(data)}\r\n".encode() + data + b"\r\n")
+        sock.sendall(b"".join(parts))
+        return self._read_reply(reader)
+
+    def _read_reply(self, reader):
+        line = reader.readline()
+        if not line:
+            raise ConnectionError("connection closed")
+        kind, payload = line[:1], line[1:-2]
+        if kind == b"+":
+            return payload.decode()
+        if kind == b"-":
+            raise RespError(payload.decode())
+        if kind == b":":
+            return int(payload)
+        if kind == b"$":
+            length = int(payload)
+            if length < 0:
+                return None
+            data = reader.read(length + 2)
+            return data[:-2]
+        if kind == b"*":
+            count = int(payload)
+            if count < 0:
+                return None
+            return [self._read_reply(reader) for _ in range(count)]
+        raise RespError(f"unexpected reply: {line!r}")
+
+    def _safe_command(self, *args: str | bytes):
+        try:
+            return self._command(*args)
+        except (OSError, RespError, ValueError):
+            # エラーの応答や読めない応答のあとは、接続の読み位置が信用できないので張り直す
+            self._close()
+            self.errors += 1
+            return None
+
+    def configure_namespace(self, namespace: str, config: NamespaceConfig) -> None:
+        if config.ttl is None:
+            self._default_ttls[namespace] = RESP_DEFAULT_TTL
+
+    def _key(self, namespace: str, key: str) -> str:
+        return f"{self.prefix}:{namespace}:{key}"
+
+    def get(self, namespace: str, key: str):
+        return self._safe_command("GET", self._key(namespace, key))
+
+    def set(self, namespace: str, key: str, value: bytes, ttl: float | None) -> None:
+        ttl = ttl if ttl is not None else self._default_ttls.get(namespace)
+        if ttl is not None:
+            self._safe_command("SET", self._key(namespace, key), value, "PX", str(int(ttl * 1000)))
+        else:
+            self._safe_command("SET", self._key(namespace, key), value)
+
+    def incr(self, namespace: str, key: str, ttl: float | None) -> int | None:
+        # INCR 自体がサーバー側で原子的。期限は呼ぶたびに延ばす（接続できなければ None）
+        ttl = ttl if ttl is not None else self._default_ttls.get(namespace)
+        value = self._safe_command("INCR", self._key(namespace, key))
+        if value is not None and ttl is not None:
+            self._safe_command("PEXPIRE", self._key(namespace, key), str(int(ttl * 1000)))
+        return value
+
+    def delete(self, namespace: str, key: str) -> None:
+        self._safe_command("DEL", self._key(namespace, key))
+
+
+class NamespacedCache:
+    """1つの名前空間へのアクセス。ヒット／ミスなどを集計する。"""
+
+    def __init__(self, backend: CacheBackend, name: str, config: NamespaceConfig):
+        self.backend = backend
+        self.name = name
+        self.config = config
+        self._lock = threading.Lock()
+        self._stats: collections.Counter = collections.Counter()
+
+    def _count(self, field: str, n: int = 1) -> None:
+        with self._lock:
+            self._stats[field] += n
+
+    def _encode(self, value: Any) -> bytes:
+        if self.config.codec == "json":
+            return json.dumps(value, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+        return value
+
+    def _decode(self, data) -> Any:
+        if self.config.codec == "json":
+            return json.loads(bytes(data))
+        return data
+
+    def get(self, key: str) -> Any | None:
+        data = self.backend.get(self.name, key)
+        if data is None:
+            self._count("misses")
+            return None
+        self._count("hits")
+        return self._decode(data)
+
+    def set(self, key: str, value: Any) -> None:
+        data = self._encode(value)
+        if len(data) > min(self.config.max_entry_bytes, self.config.max_bytes):
+            self._count("oversized")
+            return
+        self.backend.set(self.name, key, data, self.config.ttl)
+        self._count("sets")
+        self._count("bytes_written", len(data))
+
+    def get_or_set(self, key: str, factory: Callable[[], Any]) -> Any | None:
+        """あればそれを、なければ factory() の結果を保存して返す（None は保存しない）。"""
+        value = self.get(key)
+        if value is not None:
+            return value
+        value = factory()
+        if value is not None:
+            self.set(key, value)
+        return value
+
+    def incr(self, key: str) -> int | None:
+        """整数の値に原子的に1を足して返す（なければ 1）。バックエンドに届かなければ None。
+
+        値は10進の文字列として保存するので、json の名前空間では get() で整数として読める。
+        """
+        value = self.backend.incr(self.name, key, self.config.ttl)
+        if value is not None:
+            self._count("incrs")
+        return value
+
+    def delete(self, key: str) -> None:
+        self.backend.delete(self.name, key)
+
+    def stats(self) -> dict:
+        with self._lock:
+            stats = dict(self._stats)
+        lookups = stats.get("hits", 0) + stats.get("misses", 0)
+        stats["hit_ratio"] = round(stats.get("hits", 0) / lookups, 3) if lookups else None
+        return stats
+
+
+class Cache:
+    """名前空間の集まり。shared=False の名前空間はプロセス内 LRU に置く。"""
+
+    def __init__(self, backend: CacheBackend, namespaces: dict[str, NamespaceConfig] | None = None):
+        self.backend = backend
+        self.local_backend = backend if isinstance(backend, MemoryLRUBackend) else MemoryLRUBackend()
+        self._namespaces: dict[str, NamespacedCache] = {}
+        for name, config in (namespaces or DEFAULT_NAMESPACES).items():
+            target = backend if config.shared else self.local_backend
+            target.configure_namespace(name, config)
+            self._namespaces[name] = NamespacedCache(target, name, config)
+
+    def namespace(self, name: str) -> NamespacedCache:
+        return self._namespaces[name]
+
+    def stats(self) -> dict:
+        return {
+            "backend": self.backend.name,
+            "namespaces": {
+                name: {**ns.stats(), "backend": ns.backend.name} for name, ns in self._namespaces.items()
+            },
+        }
+
+
+def create_backend_from_env() -> CacheBackend:
+    kind = os.environ.get("VIEWER_CACHE_BACKEND", "disk")
+    if kind == "memory":
+        return MemoryLRUBackend()
+    if kind == "disk":
+        return DiskBackend(get_default_disk_cache())
+    if kind == "redis":
+        return RespBackend.from_url(os.environ.get("VIEWER_CACHE_URL", "redis://127.0.0.1:6379/0"))
+    raise ValueError(f"unknown VIEWER_CACHE_BACKEND: {kind}")
+
+
+_default_cache: Cache | None = None
+_default_lock = threading.Lock()
+
+
+def get_cache() -> Cache:
+    """プロセス内で共有する既定のキャッシュ（バックエンドは環境変数で選ぶ）。"""
+    global _default_cache
+    with _default_lock:
+        if _default_cache is None:
+            _default_cache = Cache(create_backend_from_env())
+        return _default_cache
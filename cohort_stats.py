@@ -0,0 +1,245 @@
+"""全受診者のスコア分布を、固定ビンのヒストグラムの逐次集計で求める。
+
+visit_stream のバッチごとに NumPy でヒストグラムへ加算するだけなので、
+メモリに持つのは (指標, 性別, 年代, ビン) の集計配列のみで、テーブルの件数によらない。
+十分位はヒストグラムの累積から近似する（誤差はビン幅以内）。動脈硬化リスクのように
+値が 0 付近の数桁に広がる指標は対数の間隔のビンにする。
+出荷している参照テーブル（METRIC_SPECS）との乖離（PSI）は、ヒストグラムではなく
+各グループの参照の十分位で区切った10区間の件数を別に数えて求める（ビン幅の誤差が入らない）。
+"""
+
+from __future__ import annotations
+
+import numpy as np
+
+from athero_percentiles import (
+    AGE_GROUPS,
+    GENDERS,
+    METRIC_SPECS,
+    PERCENTILE_LABELS,
+    encode_peer_groups,
+    format_peer_group_label,
+    visit_metric_values,
+)
+
+# 指標ごとのヒストグラムの範囲・ビン数・間隔（"linear" / "log"）。
+# 範囲外の値は端のビンに入れ、件数を別に数える
+HISTOGRAM_RANGES = {
+    "fundus_age_delta": (-40.0, 40.0, 320, "linear"),
+    "glaucoma_risk": (0.0, 1.0, 400, "linear"),
+    # 参照テーブルの十分位は 1e-8〜0.5 に広がるので、1ビンあたり約5%の幅の対数ビンにする
+    "atherosclerosis_risk": (1e-9, 1.0, 400, "log"),
+}
+
+# HISTOGRAM_RANGES にない指標のビン数（範囲は参照テーブルの最小〜最大）
+DEFAULT_HISTOGRAM_BINS = 400
+
+
+def histogram_range(metric: str) -> tuple[float, float, int, str]:
+    if metric in HISTOGRAM_RANGES:
+        return HISTOGRAM_RANGES[metric]
+    values = [v for table in METRIC_SPECS[metric].tables.values() for v in table["percentiles"]]
+    return float(min(values)), float(max(values)), DEFAULT_HISTOGRAM_BINS, "linear"
+
+
+def reference_shares(breakpoints) -> np.ndarray:
+    """参照の十分位の内側9点で区切った10区間に、参照の分布で入る割合。
+
+    区間 k は「k 個の内側の十分位以下」（値 v が bp[k] <= v < bp[k+1]）。十分位が同じ値で
+    並ぶグループでは、その値に分布の塊があるので、幅のない区間は 0、塊を含む区間はその分だけ大きい。
+    """
+    breakpoints = np.asarray(breakpoints, dtype=float)
+    sections = len(breakpoints) - 1
+    # bp[k] 以上になる割合は、bp[k] と同じ値が最初に現れる十分位で決まる
+    first = np.searchsorted(breakpoints, breakpoints[1:-1], side="left")
+    at_least = np.concatenate(([1.0], 1 - first / sections, [0.0]))
+    return -np.diff(at_least)
+
+
+# PSI の目安（0.1 未満: 安定、0.25 以上: 参照テーブルの見直しを検討）
+PSI_WARN = 0.1
+PSI_ALERT = 0.25
+
+
+class MetricHistogram:
+    """1指標の (性別, 年代) ごとのヒストグラムと件数・合計・範囲外の件数。
+
+    参照データのあるグループは、参照の十分位で区切った10区間の件数（reference_counts）も数える。
+    """
+
+    __slots__ = ("metric", "edges", "log_scale", "counts", "sums", "out_of_range",
+                 "thresholds", "reference_counts")
+
+    def __init__(self, metric: str):
+        low, high, bins, scale = histogram_range(metric)
+        self.metric = metric
+        self.log_scale = scale == "log"
+        self.edges = np.geomspace(low, high, bins + 1) if self.log_scale else np.linspace(low, high, bins + 1)
+        self.counts = np.zeros((len(GENDERS), len(AGE_GROUPS), bins), dtype=np.int64)
+        self.sums = np.zeros((len(GENDERS), len(AGE_GROUPS)))
+        self.out_of_range = 0
+        # (性別, 年代) ごとの参照の内側の十分位（参照データのないグループは NaN）
+        self.thresholds = np.full((len(GENDERS), len(AGE_GROUPS), len(PERCENTILE_LABELS) - 2), np.nan)
+        for (gender, age_group), ref_data in METRIC_SPECS[metric].tables.items():
+            self.thresholds[GENDERS.index(gender), AGE_GROUPS.index(age_group)] = ref_data["percentiles"][1:-1]
+        self.reference_counts = np.zeros(
+            (len(GENDERS), len(AGE_GROUPS), len(PERCENTILE_LABELS) - 1), dtype=np.int64
+        )
+
+    def add(self, gender_idx: np.ndarray, age_idx: np.ndarray, values: np.ndarray) -> None:
+        """1バッチ分の値を加算する。性別が不明（-1）の行と NaN は呼び出し側で除いておく。"""
+        self._add_reference_counts(gender_idx, age_idx, values)
+        bins = self.counts.shape[2]
+        position = np.searchsorted(self.edges, values, side="right") - 1
+        self.out_of_range += int(np.count_nonzero((position < 0) | (values > self.edges[-1])))
+        position = np.clip(position, 0, bins - 1)
+        cell = gender_idx * len(AGE_GROUPS) + age_idx
+        self.counts += np.bincount(
+            cell * bins + position, minlength=self.counts.size
+        ).reshape(self.counts.shape)
+        self.sums += np.bincount(cell, weights=values, minlength=self.sums.size).reshape(self.sums.shape)
+
+    def _add_reference_counts(self, gender_idx: np.ndarray, age_idx: np.ndarray, values: np.ndarray) -> None:
+        cell = gender_idx * len(AGE_GROUPS) + age_idx
+        sections = self.reference_counts.shape[2]
+        thresholds = self.thresholds.reshape(-1, sections - 1)
+        for c in np.unique(cell):
+            if np.isnan(thresholds[c]).any():
+                continue
+            in_cell = values[cell == c]
+            # 区間の番号 = その値以下の内側の十分位の数
+            section = np.searchsorted(thresholds[c], in_cell, side="right")
+            self.reference_counts.reshape(-1, sections)[c] += np.bincount(section, minlength=sections)
+
+    def cell_counts(self) -> np.ndarray:
+        return self.counts.sum(axis=2)
+
+    def cdf(self, gender_idx: int, age_idx: int, points) -> np.ndarray:
+        """points 以下の値の割合（ビン内は一様分布とみなして線形補間）。"""
+        counts = self.counts[gender_idx, age_idx]
+        total = counts.sum()
+        if not total:
+            return np.full(len(points), np.nan)
+        cumulative = np.concatenate(([0], np.cumsum(counts))) / total
+        return np.interp(points, self.edges, cumulative)
+
+    def deciles(self, gender_idx: int, age_idx: int) -> np.ndarray | None:
+        """近似の十分位（0, 10, …, 100 パーセンタイル）。データがなければ None。"""
+        counts = self.counts[gender_idx, age_idx]
+        total = counts.sum()
+        if not total:
+            return None
+        cumulative = np.concatenate(([0], np.cumsum(counts))) / total
+        quantiles = np.asarray(PERCENTILE_LABELS) / 100
+        # 各分位点を含むビン（累積割合が初めて分位点以上になるビン）の中で線形補間する
+        upper = np.clip(np.searchsorted(cumulative, quantiles, side="left"), 1, len(cumulative) - 1)
+        low, high = cumulative[upper - 1], cumulative[upper]
+        ratio = np.where(high > low, (quantiles - low) / np.where(high > low, high - low, 1), 0.0)
+        result = self.edges[upper - 1] + ratio * (self.edges[upper] - self.edges[upper - 1])
+        # 0パーセンタイルは最初の空でないビンの下端
+        result[0] = self.edges[np.flatnonzero(counts)[0]]
+        return result
+
+    def psi(self, gender_idx: int, age_idx: int, reference_breakpoints) -> float | None:
+        """参照テーブルの十分位で区切った10区間の割合と、参照の分布での割合との PSI。"""
+        counts = self.reference_counts[gender_idx, age_idx]
+        total = counts.sum()
+        if not total:
+            return None
+        observed = counts / total
+        expected = reference_shares(reference_breakpoints)
+        # 幅のない区間（十分位が同じ値）に値がなければ、その区間は比べない
+        used = (observed > 0) | (expected > 0)
+        observed = np.clip(observed[used], 1e-4, None)
+        expected = np.clip(expected[used], 1e-4, None)
+        return float(np.sum((observed - expected) * np.log(observed / expected)))
+
+
+class CohortAggregator:
+    """visit_stream のバッチを受け取り、全指標のヒストグラムを更新する。"""
+
+    def __init__(self):
+        self.histograms = {metric: MetricHistogram(metric) for metric in METRIC_SPECS}
+        self.visits = 0
+        self.rows = 0
+        self.missing_questionnaire = 0
+        self.unknown_gender = 0
+        self.cursor = None
+
+    def add_batch(self, batch) -> None:
+        self.rows += batch.rows_read
+        self.cursor = batch.cursor
+        self.visits += len(batch.visits)
+
+        genders, ages = [], []
+        # 指標ごとの (行番号, 値)。行番号は genders / ages の位置
+        columns: dict[str, tuple[list[int], list[float]]] = {m: ([], []) for m in METRIC_SPECS}
+        for streamed in batch.visits:
+            questionnaire = streamed.questionnaire
+            if questionnaire is None or questionnaire.bday is None:
+                self.missing_questionnaire += 1
+                continue
+            if questionnaire.gender not in GENDERS:
+                self.unknown_gender += 1
+                continue
+            row = len(genders)
+            real_age = questionnaire.real_age
+            genders.append(questionnaire.gender)
+            ages.append(real_age)
+            for metric, _eye, value in visit_metric_values(streamed.visit, real_age):
+                columns[metric][0].append(row)
+                columns[metric][1].append(value)
+        if not genders:
+            return
+
+        gender_idx, age_idx, _age_groups = encode_peer_groups(genders, ages)
+        for metric, (rows, values) in columns.items():
+            if not rows:
+                continue
+            rows = np.asarray(rows, dtype=np.int64)
+            values = np.asarray(values, dtype=float)
+            # 負の年齢（誕生日が撮影より後）の行は、どの年代のヒストグラムにも入れない
+            usable = np.isfinite(values) & (age_idx[rows] >= 0)
+            self.histograms[metric].add(gender_idx[rows[usable]], age_idx[rows[usable]], values[usable])
+
+    # --- 表示用の集計 ---
+
+    def group_rows(self, metric: str) -> list[dict]:
+        """(性別, 年代) ごとの件数・平均・近似十分位・参照テーブルとの PSI。"""
+        histogram = self.histograms[metric]
+        spec = METRIC_SPECS[metric]
+        counts = histogram.cell_counts()
+        rows = []
+        for g, gender in enumerate(GENDERS):
+            for a, age_group in enumerate(AGE_GROUPS):
+                n = int(counts[g, a])
+                reference = spec.tables.get((gender, age_group))
+                if not n and not reference:
+                    continue
+                deciles = histogram.deciles(g, a)
+                rows.append({
+                    "group": format_peer_group_label(gender, age_group),
+                    "n": n,
+                    "mean": float(histogram.sums[g, a] / n) if n else None,
+                    "deciles": [float(d) for d in deciles] if deciles is not None else None,
+                    "reference_n": reference["sample_size"] if reference else None,
+                    "psi": histogram.psi(g, a, reference["percentiles"]) if reference and n else None,
+                })
+        return rows
+
+    def histogram(self, metric: str, gender: str | None = None, age_group: int | None = None):
+        """表示用に (ビンの中心, 件数) を返す。性別・年代を省略するとその軸を合計する。
+
+        対数のビンでは中心を幾何平均にする。
+        """
+        histogram = self.histograms[metric]
+        counts = histogram.counts
+        if gender is not None:
+            counts = counts[GENDERS.index(gender)][None]
+        if age_group is not None:
+            counts = counts[:, AGE_GROUPS.index(age_group)][:, None]
+        if histogram.log_scale:
+            centers = np.sqrt(histogram.edges[:-1] * histogram.edges[1:])
+        else:
+            centers = (histogram.edges[:-1] + histogram.edges[1:]) / 2
+        return centers, counts.sum(axis=(0, 1))
@@ -0,0 +1,311 @@
+"""複数の Streamlit プロセスで共有する、内容アドレス方式のディスクキャッシュ。
+
+本体は SHA-256 をファイル名にして objects/ 以下に1つだけ保存し、
+キー → ダイジェストの対応と最終アクセス時刻は SQLite（WAL）の索引で管理する。
+合計サイズが上限を超えたら最終アクセスの古いキーから追い出す（LRU）。
+キーの接頭辞（"images:" など）ごとの上限も設定でき、超えたらその接頭辞のキーだけを同じ順で追い出す。
+書き込みと追い出しは SQLite の書き込みロック（BEGIN IMMEDIATE）の中で行うので、
+同じホストの複数プロセスから同時に使っても索引とファイルが食い違わない。
+読み出しは mmap で行い、同じホストの全プロセスがページキャッシュ上の1つのコピーを共有する。
+"""
+
+from __future__ import annotations
+
+import contextlib
+import hashlib
+import mmap
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from typing import Iterator
+
+DISK_CACHE_DIR = os.environ.get(
+    "DISK_CACHE_DIR", os.path.join(os.path.dirname(__file__), ".cache")
+)
+DISK_CACHE_MAX_BYTES = int(os.environ.get("DISK_CACHE_MAX_BYTES", 2 * 1024 ** 3))
+
+# 追い出し後の目標（上限の90%まで減らし、毎回の追い出しを避ける）
+EVICT_TARGET_RATIO = 0.9
+# 最終アクセス時刻の更新間隔。読み出しのたびに書き込みロックを取らないようにする
+ACCESS_RESOLUTION_SECONDS = 60.0
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS blobs (
+    digest TEXT PRIMARY KEY,
+    size INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS entries (
+    key TEXT PRIMARY KEY,
+    digest TEXT NOT NULL,
+    last_access REAL NOT NULL,
+    expires_at REAL
+);
+CREATE INDEX IF NOT EXISTS entries_last_access ON entries (last_access);
+CREATE INDEX IF NOT EXISTS entries_digest ON entries (digest);
+"""
+
+
+class DiskCache:
+    """サイズ上限付き LRU のディスクキャッシュ。"""
+
+    def __init__(self, root: str = DISK_CACHE_DIR, max_bytes: int = DISK_CACHE_MAX_BYTES):
+        self.root = root
+        self.max_bytes = max_bytes
+        # キーの接頭辞 -> その接頭辞のキーの合計の上限
+        self.prefix_limits: dict[str, int] = {}
+        self._local = threading.local()
+        os.makedirs(os.path.join(root, "objects"), exist_ok=True)
+        with self._transaction() as conn:
+            for statement in _SCHEMA.split(";"):
+                if statement.strip():
+                    conn.execute(statement)
+            # 有効期限の列がない古い索引には列を追加する
+            columns = {row[1] for row in conn.execute("PRAGMA table_info(entries)")}
+            if "expires_at" not in columns:
+                conn.execute("ALTER TABLE entries ADD COLUMN expires_at REAL")
+
+    def set_prefix_limit(self, prefix: str, max_bytes: int) -> None:
+        """prefix で始まるキーの合計の上限を設定する（書き込みのたびにその範囲だけ追い出す）。"""
+        self.prefix_limits[prefix] = max_bytes
+
+    # --- SQLite 索引 ---
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(
+                os.path.join(self.root, "index.sqlite3"), timeout=30, isolation_level=None
+            )
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    @contextlib.contextmanager
+    def _transaction(self) -> Iterator[sqlite3.Connection]:
+        """プロセス間で排他される書き込みトランザクション。"""
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+    def _blob_path(self, digest: str) -> str:
+        return os.path.join(self.root, "objects", digest[:2], digest)
+
+    # --- 読み出し ---
+
+    def get(self, key: str) -> mmap.mmap | bytes | None:
+        """キーの内容を読み出す。なければ None。
+
+        戻り値は読み取り専用の mmap（空の内容のみ b""）。bytes と同様にスライスでき、
+        read/seek を持つのでそのまま PIL の Image.open などにも渡せる。
+        """
+        row = self._conn().execute(
+            "SELECT digest, last_access, expires_at FROM entries WHERE key = ?", (key,)
+        ).fetchone()
+        if row is None:
+            return None
+        digest, last_access, expires_at = row
+        if expires_at is not None and expires_at <= time.time():
+            # 期限切れは次の追い出しを待たずにその場で消す（他プロセスが書き直していれば残す）
+            with self._transaction() as conn:
+                conn.execute(
+                    "DELETE FROM entries WHERE key = ? AND digest = ? AND expires_at = ?",
+                    (key, digest, expires_at),
+                )
+                if conn.execute("SELECT 1 FROM entries WHERE digest = ? LIMIT 1", (digest,)).fetchone() is None:
+                    self._remove_blob_locked(conn, digest)
+            return None
+        try:
+            with open(self._blob_path(digest), "rb") as f:
+                size = os.fstat(f.fileno()).st_size
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if size else b""
+        except FileNotFoundError:
+            # 他プロセスの追い出しと競合した場合はミス扱いにして索引を掃除する
+            with self._transaction() as conn:
+                conn.execute("DELETE FROM entries WHERE key = ? AND digest = ?", (key, digest))
+            return None
+
+        now = time.time()
+        if now - last_access >= ACCESS_RESOLUTION_SECONDS:
+            with self._transaction() as conn:
+                conn.execute("UPDATE entries SET last_access = ? WHERE key = ?", (now, key))
+        return data
+
+    def __contains__(self, key: str) -> bool:
+        return self._conn().execute(
+            "SELECT 1 FROM entries WHERE key = ?", (key,)
+        ).fetchone() is not None
+
+    # --- 書き込み ---
+
+    def put(self, key: str, data: bytes, ttl: float | None = None) -> str:
+        """キーに内容を保存し、内容のダイジェストを返す。同じ内容の本体は共有される。
+
+        ttl（秒）を指定すると、その時間を過ぎた読み出しはミスになる。
+        """
+        with self._transaction() as conn:
+            return self._put_locked(conn, key, data, ttl)
+
+    def incr(self, key: str, ttl: float | None = None) -> int:
+        """キーの整数値（10進の文字列）に1を足して返す。なければ（期限切れも）1 から始める。
+
+        読み出しと書き込みを同じ書き込みロックの中で行うので、複数プロセスから同時に
+        呼んでも増分が失われない。ttl は呼ぶたびに更新する。
+        """
+        with self._transaction() as conn:
+            row = conn.execute(
+                "SELECT digest, expires_at FROM entries WHERE key = ?", (key,)
+            ).fetchone()
+            value = 0
+            if row is not None and (row[1] is None or row[1] > time.time()):
+                try:
+                    with open(self._blob_path(row[0]), "rb") as f:
+                        value = int(f.read())
+                except (FileNotFoundError, ValueError):
+                    value = 0
+            value += 1
+            self._put_locked(conn, key, str(value).encode("ascii"), ttl)
+        return value
+
+    def _put_locked(self, conn: sqlite3.Connection, key: str, data: bytes, ttl: float | None) -> str:
+        digest = hashlib.sha256(data).hexdigest()
+        path = self._blob_path(digest)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+            try:
+                with os.fdopen(fd, "wb") as f:
+                    f.write(data)
+                os.replace(tmp_path, path)
+            except BaseException:
+                os.unlink(tmp_path)
+                raise
+        conn.execute(
+            "INSERT OR IGNORE INTO blobs (digest, size) VALUES (?, ?)", (digest, len(data))
+        )
+        now = time.time()
+        conn.execute(
+            "INSERT OR REPLACE INTO entries (key, digest, last_access, expires_at) "
+            "VALUES (?, ?, ?, ?)",
+            (key, digest, now, now + ttl if ttl is not None else None),
+        )
+        for prefix, limit in self.prefix_limits.items():
+            if key.startswith(prefix):
+                self._evict_prefix_locked(conn, prefix, limit, keep=key)
+        self._evict_locked(conn, keep=key)
+        return digest
+
+    def delete(self, key: str) -> None:
+        with self._transaction() as conn:
+            conn.execute("DELETE FROM entries WHERE key = ?", (key,))
+            self._remove_orphans_locked(conn)
+
+    # --- 追い出し ---
+
+    def _total_bytes(self, conn: sqlite3.Connection) -> int:
+        return conn.execute("SELECT COALESCE(SUM(size), 0) FROM blobs").fetchone()[0]
+
+    def _remove_orphans_locked(self, conn: sqlite3.Connection) -> None:
+        orphans = conn.execute(
+            "SELECT digest FROM blobs WHERE digest NOT IN (SELECT digest FROM entries)"
+        ).fetchall()
+        for (digest,) in orphans:
+            self._remove_blob_locked(conn, digest)
+
+    def _remove_blob_locked(self, conn: sqlite3.Connection, digest: str) -> None:
+        try:
+            os.unlink(self._blob_path(digest))
+        except FileNotFoundError:
+            pass
+        conn.execute("DELETE FROM blobs WHERE digest = ?", (digest,))
+
+    def _evict_locked(self, conn: sqlite3.Connection, keep: str | None = None) -> None:
+        """合計が上限を超えていれば目標まで追い出す。keep（書き込んだばかりのキー）は残す。"""
+        total = self._total_bytes(conn)
+        if total <= self.max_bytes:
+            return
+        # 期限切れのものを先に捨て、それでも超えていれば LRU で1件ずつ追い出す
+        conn.execute("DELETE FROM entries WHERE expires_at <= ?", (time.time(),))
+        self._remove_orphans_locked(conn)
+        total = self._total_bytes(conn)
+        target = self.max_bytes * EVICT_TARGET_RATIO
+        while total > target:
+            oldest = conn.execute(
+                "SELECT key, digest FROM entries WHERE key IS NOT ? ORDER BY last_access LIMIT 1", (keep,)
+            ).fetchone()
+            if oldest is None:
+                break
+            key, digest = oldest
+            conn.execute("DELETE FROM entries WHERE key = ?", (key,))
+            # 本体は他のキーから参照されていなければ消え、その分だけ合計が減る
+            if conn.execute("SELECT 1 FROM entries WHERE digest = ? LIMIT 1", (digest,)).fetchone() is None:
+                size = conn.execute("SELECT size FROM blobs WHERE digest = ?", (digest,)).fetchone()
+                self._remove_blob_locked(conn, digest)
+                total -= size[0] if size else 0
+
+    @staticmethod
+    def _prefix_range(prefix: str) -> tuple[str, str]:
+        """prefix で始まるキーの範囲 [low, high)（主キーの索引で引ける形）。"""
+        return prefix, prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+    def prefix_bytes(self, prefix: str) -> int:
+        """prefix で始まるキーが参照する本体の合計（共有された本体はキーごとに数える）。"""
+        low, high = self._prefix_range(prefix)
+        return self._conn().execute(
+            "SELECT COALESCE(SUM(b.size), 0) FROM entries e JOIN blobs b ON b.digest = e.digest "
+            "WHERE e.key >= ? AND e.key < ?", (low, high)
+        ).fetchone()[0]
+
+    def _evict_prefix_locked(self, conn: sqlite3.Connection, prefix: str, limit: int, keep: str) -> None:
+        """prefix のキーの合計が limit を超えていれば、その範囲の期限切れ・LRU の順に追い出す。"""
+        low, high = self._prefix_range(prefix)
+        total = conn.execute(
+            "SELECT COALESCE(SUM(b.size), 0) FROM entries e JOIN blobs b ON b.digest = e.digest "
+            "WHERE e.key >= ? AND e.key < ?", (low, high)
+        ).fetchone()[0]
+        if total <= limit:
+            return
+        candidates = conn.execute(
+            "SELECT e.key, e.digest, b.size FROM entries e JOIN blobs b ON b.digest = e.digest "
+            "WHERE e.key >= ? AND e.key < ? AND e.key IS NOT ? "
+            "ORDER BY e.expires_at IS NULL OR e.expires_at > ?, e.last_access",
+            (low, high, keep, time.time()),
+        ).fetchall()
+        for key, digest, size in candidates:
+            if total <= limit * EVICT_TARGET_RATIO:
+                break
+            conn.execute("DELETE FROM entries WHERE key = ?", (key,))
+            if conn.execute("SELECT 1 FROM entries WHERE digest = ? LIMIT 1", (digest,)).fetchone() is None:
+                self._remove_blob_locked(conn, digest)
+            total -= size
+
+    def stats(self) -> dict:
+        conn = self._conn()
+        entries = conn.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+        blobs = conn.execute("SELECT COUNT(*) FROM blobs").fetchone()[0]
+        return {
+            "entries": entries,
+            "blobs": blobs,
+            "bytes": self._total_bytes(conn),
+            "max_bytes": self.max_bytes,
+        }
+
+
+_default_cache: DiskCache | None = None
+_default_lock = threading.Lock()
+
+
+def get_default_cache() -> DiskCache:
+    """プロセス内で共有する既定のディスクキャッシュ（DISK_CACHE_DIR）。"""
+    global _default_cache
+    with _default_lock:
+        if _default_cache is None:
+            _default_cache = DiskCache()
+        return _default_cache
@@ -0,0 +1,360 @@
+"""研究用の一括エクスポート（問診・左右の結果・同年代での位置・フィードバックを1撮影1行に）。
+
+    python export.py --format csv --out export.csv
+    python export.py --format parquet --out export_parquet/ --resume
+
+results をキーセットページングで読み、ページごとに派生列（撮影時年齢・眼底年齢の差・
+百分位など）を NumPy でまとめて計算して追記する。メモリに持つのは1ページ分だけ。
+書き込みのたびに最後に書き出した results のキーを状態ファイルに保存し、
+--resume でその次の行から再開する。
+
+個人の特定を避けるため、誕生日と画像 URL は出力しない（年齢は撮影時年齢として出力する）。
+Parquet 出力には pyarrow が必要。
+"""
+
+from __future__ import annotations
+
+import argparse
+import csv
+import json
+import logging
+import os
+import tempfile
+
+from athero_percentiles import (
+    METRIC_SPECS,
+    evaluate_metric_batch,
+    format_peer_group_label,
+    get_age_group,
+    visit_metric_values,
+)
+from visit_stream import STREAM_PAGE_SIZE, StreamCursor, iter_visit_batches
+
+logger = logging.getLogger(__name__)
+
+FEEDBACK_EXPORT_COLUMNS = (
+    "uuid, ux_rating, duration_rating, info_quality_rating, motivation_rating, "
+    "recommendation_score, healthcheck_rating, created_at"
+)
+
+EYE_PREFIXES = {"R": "right", "L": "left"}
+
+# 指標ごとの派生列: (値, 百分位, 絶対評価, 相対ラベル)。片眼ごとの指標は {eye} に right / left が入る。
+# ここにない指標は "{eye}_<指標>_percentile" などの既定の名前で末尾に出力する
+METRIC_EXPORT_COLUMNS = {
+    "fundus_age_delta": ("{eye}_fundus_age_delta", "{eye}_fundus_age_delta_percentile", None, None),
+    "glaucoma_risk": ("{eye}_glaucoma_risk", "{eye}_glaucoma_risk_percentile", "{eye}_glaucoma_risk_level", None),
+    "atherosclerosis_risk": ("atherosclerosis_average", "atherosclerosis_percentile",
+                             "atherosclerosis_level", "atherosclerosis_relative_label"),
+}
+
+
+def metric_export_columns(name: str) -> tuple[str, str, str | None, str | None]:
+    columns = METRIC_EXPORT_COLUMNS.get(name)
+    if columns is not None:
+        return columns
+    spec = METRIC_SPECS[name]
+    base = f"{{eye}}_{name}" if spec.per_eye else name
+    return (base, f"{base}_percentile", f"{base}_level" if spec.absolute_thresholds else None,
+            f"{base}_relative_label")
+
+
+def _expand_eyes(column: str | None, per_eye: bool) -> list[str]:
+    if column is None:
+        return []
+    return [column.format(eye=prefix) for prefix in EYE_PREFIXES.values()] if per_eye else [column]
+
+
+def _default_named_metric_columns() -> tuple[list[str], set[str]]:
+    """METRIC_EXPORT_COLUMNS にない指標の列と、そのうち文字列の列（絶対評価・相対ラベル）。"""
+    columns: list[str] = []
+    text_columns: set[str] = set()
+    for name, spec in METRIC_SPECS.items():
+        if name in METRIC_EXPORT_COLUMNS:
+            continue
+        value, percentile, level, label = metric_export_columns(name)
+        for column in (value, percentile, level, label):
+            columns.extend(_expand_eyes(column, spec.per_eye))
+        text_columns.update(_expand_eyes(level, spec.per_eye) + _expand_eyes(label, spec.per_eye))
+    return columns, text_columns
+
+
+# 既定の名前で出力する指標の列（末尾に並べる）と、そのうち文字列の列
+_EXTRA_COLUMNS, _EXTRA_TEXT_COLUMNS = _default_named_metric_columns()
+
+EXPORT_COLUMNS = [
+    "uuid", "captured_datetime", "gender", "age", "peer_group", "height", "weight", "health",
+    *(
+        f"{eye}_{name}"
+        for eye in ("right", "left")
+        for name in (
+            "fundus_age", "fundus_age_delta", "fundus_age_delta_percentile",
+            "glaucoma_risk", "glaucoma_risk_level", "glaucoma_risk_percentile",
+            "atherosclerosis_risk",
+        )
+    ),
+    "atherosclerosis_average", "atherosclerosis_level",
+    "atherosclerosis_percentile", "atherosclerosis_relative_label", "peer_sample_size",
+    "feedback_ux_rating", "feedback_duration_rating", "feedback_info_quality_rating",
+    "feedback_motivation_rating", "feedback_recommendation_score", "feedback_healthcheck_rating",
+    *_EXTRA_COLUMNS,
+]
+
+# 1回の確定（Parquet は1ファイル）にまとめる行数の目安。CSV は追記できるのでページごとに確定する
+ROWS_PER_PART = 50_000
+CSV_ROWS_PER_PART = 1
+# フィードバックを引くときに1回の in フィルタに入れる uuid の数（URL の長さの上限を避ける）
+FEEDBACK_UUID_CHUNK = 100
+
+
+def fetch_latest_feedback(client, uuids: list[str]) -> dict[str, dict]:
+    """uuid ごとの最新のフィードバック。uuid は FEEDBACK_UUID_CHUNK 件ずつ問い合わせる。"""
+    feedback: dict[str, dict] = {}
+    for start in range(0, len(uuids), FEEDBACK_UUID_CHUNK):
+        response = client.table("feedback").select(FEEDBACK_EXPORT_COLUMNS) \
+            .in_("uuid", uuids[start:start + FEEDBACK_UUID_CHUNK]) \
+            .order("created_at") \
+            .execute()
+        # created_at の昇順なので、後の行（新しいフィードバック）で上書きする
+        feedback.update({row["uuid"]: row for row in response.data or []})
+    return feedback
+
+
+def _none_if_nan(value):
+    return None if value != value else round(float(value), 2)
+
+
+def build_rows(batch, feedback: dict[str, dict]) -> list[dict]:
+    """1バッチ分の撮影を出力行にする。百分位などの派生列は指標ごとに一括で計算する。"""
+    rows = []
+    genders, ages = [], []
+    for streamed in batch.visits:
+        questionnaire = streamed.questionnaire
+        real_age = questionnaire.real_age if questionnaire and questionnaire.bday else None
+        gender = questionnaire.gender if questionnaire else None
+        row = dict.fromkeys(EXPORT_COLUMNS)
+        row.update({
+            "uuid": streamed.uuid,
+            "captured_datetime": streamed.captured_datetime,
+            "gender": gender,
+            "age": real_age,
+            "peer_group": (
+                format_peer_group_label(gender, get_age_group(real_age))
+                if gender in ("M", "F") and real_age is not None and real_age >= 0 else None
+            ),
+            "height": questionnaire.height if questionnaire else None,
+            "weight": questionnaire.weight if questionnaire else None,
+            "health": questionnaire.health if questionnaire else None,
+        })
+        for prefix, result in (("right", streamed.visit.right), ("left", streamed.visit.left)):
+            if result is None:
+                continue
+            row[f"{prefix}_fundus_age"] = result.fundus_age
+            row[f"{prefix}_glaucoma_risk"] = result.glaucoma_risk
+            row[f"{prefix}_atherosclerosis_risk"] = result.atherosclerosis_risk
+        # 指標の値は METRIC_SPECS の定義から作る（結果ページ・集計と同じ）
+        for metric, eye, value in visit_metric_values(streamed.visit, real_age):
+            per_eye = METRIC_SPECS[metric].per_eye
+            column = metric_export_columns(metric)[0]
+            row[column.format(eye=EYE_PREFIXES[eye]) if per_eye else column] = value
+        for name, value in (feedback.get(streamed.uuid) or {}).items():
+            if f"feedback_{name}" in row:
+                row[f"feedback_{name}"] = value
+        rows.append(row)
+        genders.append(gender)
+        ages.append(real_age if real_age is not None else 0)
+
+    # 指標ごとに、値のある行だけをまとめて百分位に変換する
+    for metric, spec in METRIC_SPECS.items():
+        value_column, percentile_column, level_column, label_column = metric_export_columns(metric)
+        for prefix in EYE_PREFIXES.values() if spec.per_eye else (None,):
+            source, percentile_to, level_to, label_to = (
+                column.format(eye=prefix) if column and prefix else column
+                for column in (value_column, percentile_column, level_column, label_column)
+            )
+            index = [i for i, row in enumerate(rows) if row[source] is not None and row["age"] is not None]
+            if not index:
+                continue
+            percentiles, labels, sizes, levels = evaluate_metric_batch(
+                metric, [genders[i] for i in index], [ages[i] for i in index], [rows[i][source] for i in index]
+            )
+            for j, i in enumerate(index):
+                rows[i][percentile_to] = _none_if_nan(percentiles[j])
+                if level_to:
+                    rows[i][level_to] = levels[j]
+                if label_to:
+                    rows[i][label_to] = labels[j]
+                if metric == "atherosclerosis_risk":
+                    rows[i]["peer_sample_size"] = int(sizes[j]) if sizes[j] else None
+    return rows
+
+
+class CsvExportWriter:
+    """1つの CSV ファイルに追記する。再開時は状態ファイルに記録した位置まで切り詰める。"""
+
+    def __init__(self, path: str, state: dict, rows_per_part: int = CSV_ROWS_PER_PART):
+        self.path = path
+        self.rows_per_part = rows_per_part
+        self._pending = 0
+        resume_offset = state.get("csv_bytes")
+        if resume_offset is not None and os.path.exists(path):
+            with open(path, "r+b") as f:
+                f.truncate(resume_offset)
+            self._file = open(path, "a", newline="", encoding="utf-8")
+            self._writer = csv.DictWriter(self._file, fieldnames=EXPORT_COLUMNS)
+        else:
+            self._file = open(path, "w", newline="", encoding="utf-8")
+            self._writer = csv.DictWriter(self._file, fieldnames=EXPORT_COLUMNS)
+            self._writer.writeheader()
+
+    def write(self, rows: list[dict]) -> None:
+        self._writer.writerows(rows)
+        self._pending += len(rows)
+
+    def pending(self) -> int:
+        """まだ確定していない行数。"""
+        return self._pending
+
+    def flush(self, state: dict) -> None:
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        state["csv_bytes"] = self._file.tell()
+        self._pending = 0
+
+    def close(self) -> None:
+        self._file.close()
+
+
+class ParquetExportWriter:
+    """ディレクトリに part-NNNNN.parquet を順に書き出す（Parquet は追記できないため）。"""
+
+    def __init__(self, directory: str, state: dict, rows_per_part: int = ROWS_PER_PART):
+        try:
+            import pyarrow  # noqa: F401
+        except ImportError as e:
+            raise RuntimeError("Parquet 出力には pyarrow が必要です（pip install pyarrow）。") from e
+        self.directory = directory
+        self.rows_per_part = rows_per_part
+        self.part = state.get("parquet_parts", 0)
+        self._buffer: list[dict] = []
+        os.makedirs(directory, exist_ok=True)
+
+    def write(self, rows: list[dict]) -> None:
+        self._buffer.extend(rows)
+
+    def pending(self) -> int:
+        """まだ確定していない行数。"""
+        return len(self._buffer)
+
+    def flush(self, state: dict) -> None:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        if self._buffer:
+            table = pa.Table.from_pylist(self._buffer, schema=_parquet_schema())
+            path = os.path.join(self.directory, f"part-{self.part:05d}.parquet")
+            pq.write_table(table, f"{path}.tmp")
+            os.replace(f"{path}.tmp", path)
+            self.part += 1
+            self._buffer = []
+        state["parquet_parts"] = self.part
+
+    def close(self) -> None:
+        pass
+
+
+def _parquet_schema():
+    import pyarrow as pa
+
+    text_columns = {
+        "uuid", "captured_datetime", "gender", "peer_group", "health",
+        "right_glaucoma_risk_level", "left_glaucoma_risk_level",
+        "atherosclerosis_level", "atherosclerosis_relative_label",
+        *_EXTRA_TEXT_COLUMNS,
+    }
+    integer_columns = {"age", "peer_sample_size"}
+    return pa.schema([
+        (name, pa.string() if name in text_columns else pa.int64() if name in integer_columns else pa.float64())
+        for name in EXPORT_COLUMNS
+    ])
+
+
+def load_state(path: str) -> dict:
+    if not os.path.exists(path):
+        return {}
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def save_state(path: str, state: dict) -> None:
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    with os.fdopen(fd, "w", encoding="utf-8") as f:
+        json.dump(state, f, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+
+EXPORT_WRITERS = {"csv": CsvExportWriter, "parquet": ParquetExportWriter}
+
+
+def run_export(client, out: str, fmt: str, state_path: str, resume: bool,
+               page_size: int = STREAM_PAGE_SIZE, rows_per_part: int | None = None) -> dict:
+    """エクスポートを実行し、最終的な状態（書き出し件数・最後のキー）を返す。
+
+    rows_per_part を省略すると、形式ごとの既定（CSV はページごと、Parquet は ROWS_PER_PART）で確定する。
+    """
+    state = load_state(state_path) if resume else {}
+    if state and state.get("format") != fmt:
+        raise ValueError(f"状態ファイルは {state.get('format')} 形式のエクスポートのものです。")
+    state["format"] = fmt
+    state.setdefault("rows", 0)
+    after = StreamCursor.from_dict(state["cursor"]) if state.get("cursor") else None
+
+    writer_class = EXPORT_WRITERS[fmt]
+    writer = writer_class(out, state) if rows_per_part is None else writer_class(out, state, rows_per_part)
+    try:
+        for batch in iter_visit_batches(client, after=after, page_size=page_size):
+            uuids = sorted({streamed.uuid for streamed in batch.visits})
+            rows = build_rows(batch, fetch_latest_feedback(client, uuids))
+            writer.write(rows)
+            state["rows"] += len(rows)
+            state["pending_cursor"] = batch.cursor.to_dict()
+            # 確定していない行がパートの行数に達したら、書き出してからカーソルを進める
+            if writer.pending() >= writer.rows_per_part:
+                _commit(writer, state, state_path)
+                logger.info("exported %d rows (up to %s)", state["rows"], state["cursor"]["captured_datetime"])
+        _commit(writer, state, state_path)
+    finally:
+        writer.close()
+    return state
+
+
+def _commit(writer, state: dict, state_path: str) -> None:
+    """書き出した内容を確定してから、状態ファイルのカーソルを進める。"""
+    writer.flush(state)
+    if "pending_cursor" in state:
+        state["cursor"] = state.pop("pending_cursor")
+    save_state(state_path, state)
+
+
+def main() -> None:
+    from service_client import create_service_client
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--format", choices=("csv", "parquet"), default="csv")
+    parser.add_argument("--out", required=True, help="CSV ファイル、または Parquet の出力ディレクトリ")
+    parser.add_argument("--state", default=None, help="再開用の状態ファイル（既定: <out>.state.json）")
+    parser.add_argument("--resume", action="store_true", help="状態ファイルの続きから再開する")
+    parser.add_argument("--page-size", type=int, default=STREAM_PAGE_SIZE)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    state_path = args.state or f"{args.out.rstrip(os.sep)}.state.json"
+    state = run_export(
+        create_service_client(), args.out, args.format, state_path, args.resume, args.page_size
+    )
+    print(json.dumps({"rows": state["rows"], "cursor": state.get("cursor")}, ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    main()
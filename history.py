@@ -0,0 +1,158 @@
+"""問診履歴・解析結果の取得（本人確認用の存在確認と、timestamp によるキーセットページング）。
+
+問い合わせは outbound の期限・ヘッジ・ブレーカーを通して実行する（失敗は OutboundError）。
+"""
+
+from __future__ import annotations
+
+from cache import NamespacedCache
+from outbound import execute_query
+from records import HistoryEntry, QuestionnaireRecord, VisitResults
+
+HISTORY_PAGE_SIZE = 10
+
+# 履歴リンク一覧の描画に必要な列だけを取得する
+HISTORY_LIST_COLUMNS = "timestamp"
+
+# 結果ページ（基本情報・年齢計算・PDF）で使う問診の列
+QUESTIONNAIRE_DETAIL_COLUMNS = "uuid, bday, gender, height, weight, health, timestamp"
+
+# 受付キオスクで最新の撮影を引くときの results の列（PDF と内容ハッシュに必要な列のみ）
+LATEST_RESULT_COLUMNS = "eye, image_url, fundus_age, glaucoma_risk, atherosclerosis_risk, captured_datetime"
+
+
+def probe_latest_timestamp(client, uuid: str, bday: str) -> str | None:
+    """uuid と誕生日が一致する問診があれば最新の timestamp を、なければ None を返す。"""
+    response = execute_query(
+        client.table("questionnaires").select(HISTORY_LIST_COLUMNS)
+        .eq("uuid", uuid)
+        .eq("bday", bday)
+        .order("timestamp", desc=True)
+        .limit(1)
+    )
+    if not response.data:
+        return None
+    return response.data[0]["timestamp"]
+
+
+def fetch_history_page(
+    client,
+    uuid: str,
+    bday: str,
+    before: str | None = None,
+    page_size: int = HISTORY_PAGE_SIZE,
+) -> tuple[list[HistoryEntry], bool]:
+    """新しい順に履歴を1ページ取得する。
+
+    before を指定すると、その timestamp より古い履歴だけを返す（キーセットページング）。
+    戻り値は (履歴のリスト, さらに古い履歴があるか)。
+    """
+    query = client.table("questionnaires").select(HISTORY_LIST_COLUMNS) \
+        .eq("uuid", uuid) \
+        .eq("bday", bday)
+    if before:
+        query = query.lt("timestamp", before)
+    # 1件多く取得して、次のページの有無を判定する
+    response = execute_query(query.order("timestamp", desc=True).limit(page_size + 1))
+    rows = response.data or []
+    return [HistoryEntry.from_row(row) for row in rows[:page_size]], len(rows) > page_size
+
+
+def fetch_questionnaire(
+    client, uuid: str, bday: str, timestamp: str, cache: NamespacedCache | None = None
+) -> QuestionnaireRecord | None:
+    """表示対象の問診1件を取得する。見つからなければ None。
+
+    cache（rows 名前空間）を渡すと、取得した行を再利用する。
+    """
+    key = f"questionnaire:{uuid}:{bday}:{timestamp}"
+    row = cache.get(key) if cache else None
+    if row is None:
+        response = execute_query(
+            client.table("questionnaires").select(QUESTIONNAIRE_DETAIL_COLUMNS)
+            .eq("uuid", uuid)
+            .eq("bday", bday)
+            .eq("timestamp", timestamp)
+            .limit(1)
+        )
+        if not response.data:
+            return None
+        row = response.data[0]
+        if cache:
+            cache.set(key, row)
+    return QuestionnaireRecord.from_row(row)
+
+
+def fetch_questionnaire_by_timestamp(
+    client, uuid: str, timestamp: str, cache: NamespacedCache | None = None
+) -> QuestionnaireRecord | None:
+    """スタッフ・バッチ用: 誕生日なしで問診1件を取得する（サービスキーで使う）。
+
+    cache（rows 名前空間）を渡すと、取得した行を再利用する。
+    """
+    key = f"questionnaire_by_timestamp:{uuid}:{timestamp}"
+    row = cache.get(key) if cache else None
+    if row is None:
+        response = execute_query(
+            client.table("questionnaires").select(QUESTIONNAIRE_DETAIL_COLUMNS)
+            .eq("uuid", uuid)
+            .eq("timestamp", timestamp)
+            .limit(1)
+        )
+        if not response.data:
+            return None
+        row = response.data[0]
+        if cache:
+            cache.set(key, row)
+    return QuestionnaireRecord.from_row(row)
+
+
+def fetch_latest_visit_results(client, uuid: str) -> tuple[str, VisitResults] | None:
+    """スタッフ用: 解析結果のある最新の撮影を取得する。
+
+    最新の撮影日時を1行だけ引いてから、その撮影日時の行（左右）をすべて読む。
+    撮影日時が NULL の行は DESC で先頭に来るので除く。
+    戻り値は (DB 上の表記の撮影日時, 左右の結果)。結果がなければ None。
+    """
+    latest = execute_query(
+        client.table("results").select("captured_datetime")
+        .eq("questionnaire_uuid", uuid)
+        .not_.is_("captured_datetime", "null")
+        .order("captured_datetime", desc=True, nullsfirst=False)
+        .limit(1)
+    )
+    if not latest.data:
+        return None
+    captured_datetime = latest.data[0]["captured_datetime"]
+    response = execute_query(
+        client.table("results").select(LATEST_RESULT_COLUMNS)
+        .eq("questionnaire_uuid", uuid)
+        .eq("captured_datetime", captured_datetime)
+    )
+    if not response.data:
+        return None
+    return captured_datetime, VisitResults.from_rows(response.data)
+
+
+def fetch_visit_results(
+    client, uuid: str, timestamp: str, cache: NamespacedCache | None = None
+) -> VisitResults | None:
+    """撮影日時の左右の解析結果を取得する。まだ結果がなければ None。
+
+    cache（rows 名前空間）を渡すと、取得した行を再利用する（結果がない状態は保存しない）。
+    """
+    key = f"results:{uuid}:{timestamp}"
+    rows = cache.get(key) if cache else None
+    if rows is None:
+        # T付きのまま検索
+        response = execute_query(
+            client.table("results").select("*")
+            .eq("questionnaire_uuid", uuid)
+            .eq("captured_datetime", timestamp)
+        )
+        if not response.data:
+            return None
+        rows = response.data
+        if cache:
+            cache.set(key, rows)
+    return VisitResults.from_rows(rows)
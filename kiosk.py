@@ -0,0 +1,193 @@
+"""スタッフ用: 受付キオスク。受付ID（Code128 のバーコード）を読み取ると最新のレポートをすぐに出す。
+
+    streamlit run kiosk.py
+
+受付での再印刷のために、患者用ページの誕生日確認と全体の描画を通らずに、
+読み取った uuid から解析結果のある最新の撮影日時と、その撮影の左右の行を引き、
+保存済みの PDF（ReportStore → アーカイブの順）をそのまま返す。なければその場で描画して保存する。
+フォントの登録・Supabase への接続・reportlab とバーコードの初期化はページを開いたときに
+済ませておき、読み取りから PDF を出すまでを1秒以内に収める（超えたら画面と記録に残す）。
+
+PDF はダウンロードボタンで渡す。キオスク端末のブラウザは PDF を開いて印刷する設定にしておく。
+"""
+
+import logging
+import time
+import uuid as uuid_lib
+
+import streamlit as st
+
+from cache import get_cache
+from history import fetch_latest_visit_results, fetch_questionnaire_by_timestamp
+from outbound import OutboundError, execute_query
+from records import QuestionnaireRecord
+from report import download_images, generate_pdf, register_fonts, report_etag
+from report_archive import get_archive
+from report_store import ReportStore
+from service_client import create_service_client
+from staff_auth import require_staff
+
+logger = logging.getLogger(__name__)
+
+# 読み取りから PDF を出すまでの目標
+KIOSK_BUDGET_SECONDS = 1.0
+# 画面に残す直近の読み取りの件数
+KIOSK_LOG_SIZE = 20
+
+# 初期化用の描画に使う架空の問診
+WARMUP_QUESTIONNAIRE_ROW = {
+    "uuid": "00000000-0000-0000-0000-000000000000", "bday": "1970-01-01", "gender": "M",
+    "height": None, "weight": None, "health": None, "timestamp": "2025-01-01T00:00:00+00:00",
+}
+
+
+class KioskResult:
+    """1回の読み取りの結果。
+
+    status: "ok" / "no_results"（解析結果がない） / "no_questionnaire"（撮影に対応する問診がない）
+    source: PDF の出どころ（"cache" / "archive" / "rendered"）
+    """
+
+    __slots__ = ("status", "uuid", "captured_datetime", "etag", "pdf", "source", "timings")
+
+    def __init__(self, status: str, uuid: str, captured_datetime: str | None = None,
+                 etag: str | None = None, pdf: bytes | None = None, source: str | None = None,
+                 timings: list[tuple[str, float]] | None = None):
+        self.status = status
+        self.uuid = uuid
+        self.captured_datetime = captured_datetime
+        self.etag = etag
+        self.pdf = pdf
+        self.source = source
+        self.timings = timings or []
+
+    @property
+    def total_seconds(self) -> float:
+        return sum(seconds for _stage, seconds in self.timings)
+
+
+def serve_latest_report(client, store: ReportStore, archive, rows, uuid_value: str) -> KioskResult:
+    """uuid の最新の撮影のレポートを用意する。段階ごとの所要時間を timings に記録する。"""
+    timings: list[tuple[str, float]] = []
+    last = time.perf_counter()
+
+    def lap(stage: str) -> None:
+        nonlocal last
+        now = time.perf_counter()
+        timings.append((stage, now - last))
+        last = now
+
+    latest = fetch_latest_visit_results(client, uuid_value)
+    lap("resolve")
+    if latest is None:
+        return KioskResult("no_results", uuid_value, timings=timings)
+    captured_datetime, visit = latest
+
+    # 問診は提出後に変わらないので、rows 名前空間にあれば問い合わせない
+    questionnaire = fetch_questionnaire_by_timestamp(client, uuid_value, captured_datetime, cache=rows)
+    lap("questionnaire")
+    if questionnaire is None:
+        return KioskResult("no_questionnaire", uuid_value, captured_datetime, timings=timings)
+
+    etag = report_etag(questionnaire, visit)
+    captured_at = questionnaire.captured_at
+    source = "cache"
+    pdf_bytes = store.get_pdf(uuid_value, captured_at, etag)
+    if pdf_bytes is None:
+        source = "archive"
+        pdf_bytes = archive.get(uuid_value, captured_at, etag)
+        if pdf_bytes is not None:
+            store.put_pdf(uuid_value, captured_at, etag, pdf_bytes)
+    if pdf_bytes is None:
+        source = "rendered"
+        # 左右の画像は並行して取得する（順に取ると画像だけで予算を超える）
+        images = download_images([visit.right, visit.left])
+        pdf_bytes = generate_pdf(questionnaire, visit.right, visit.left, questionnaire.real_age, images=images)
+        store.put_pdf(uuid_value, captured_at, etag, pdf_bytes)
+        archive.put(uuid_value, captured_at, etag, pdf_bytes)
+    pdf_bytes = bytes(pdf_bytes)
+    lap("report")
+    return KioskResult("ok", uuid_value, captured_datetime, etag, pdf_bytes, source, timings)
+
+
+@st.cache_resource
+def warm_up():
+    """プロセスで1回だけ、フォント登録と接続・描画の初期化を済ませる。"""
+    register_fonts()
+    client = create_service_client()
+    store = ReportStore()
+    archive = get_archive()
+    rows = get_cache().namespace("rows")
+    # 最初の読み取りで TLS 接続を張る時間を払わないよう、軽い問い合わせを1回しておく
+    try:
+        execute_query(client.table("results").select("captured_datetime").limit(1))
+    except OutboundError:
+        logger.warning("kiosk warm-up query failed", exc_info=True)
+    # reportlab のフォント解析・バーコード生成の初期化（結果は捨てる）
+    warmup = QuestionnaireRecord.from_row(WARMUP_QUESTIONNAIRE_ROW)
+    generate_pdf(warmup, None, None, warmup.real_age)
+    return client, store, archive, rows
+
+
+st.set_page_config(page_title="受付キオスク（スタッフ用）")
+st.title("受付キオスク（スタッフ用）")
+
+# --- スタッフ認証 ---
+require_staff()
+
+with st.spinner("準備しています…"):
+    client, store, archive, rows = warm_up()
+
+if "kiosk_log" not in st.session_state:
+    st.session_state.kiosk_log = []  # 直近の読み取り（新しい順）
+
+# バーコードリーダーは読み取った文字列に続けて Enter を送るので、フォームの送信になる
+with st.form("kiosk_scan", clear_on_submit=True):
+    scanned = st.text_input("受付ID", placeholder="バーコードを読み取ってください")
+    submitted = st.form_submit_button("レポートを出す", type="primary")
+
+if submitted and scanned.strip():
+    uuid_value = scanned.strip()
+    try:
+        uuid_lib.UUID(uuid_value)
+    except ValueError:
+        st.error("受付IDの形式が正しくありません。もう一度読み取ってください。")
+        st.stop()
+
+    try:
+        result = serve_latest_report(client, store, archive, rows, uuid_value)
+    except OutboundError:
+        st.error("サーバーが混み合っています。少し待ってからもう一度読み取ってください。")
+        st.stop()
+
+    st.session_state.kiosk_log.insert(0, {
+        "受付ID": f"…{uuid_value[-4:]}",
+        "撮影日時": result.captured_datetime,
+        "結果": result.status,
+        "PDF": result.source,
+        "所要時間(ms)": round(result.total_seconds * 1000),
+    })
+    del st.session_state.kiosk_log[KIOSK_LOG_SIZE:]
+
+    if result.status == "no_results":
+        st.warning("この受付IDの解析結果はまだありません。")
+    elif result.status == "no_questionnaire":
+        st.warning("最新の撮影に対応する問診が見つかりません。")
+    else:
+        st.success(f"撮影日時 {result.captured_datetime} のレポートを用意しました。")
+        st.download_button(
+            label="PDFレポートを開く",
+            data=result.pdf,
+            file_name=f"Health_Report_{uuid_value}_{result.etag[:12]}.pdf",
+            mime="application/pdf",
+            type="primary",
+            on_click="ignore",
+        )
+    if result.total_seconds > KIOSK_BUDGET_SECONDS:
+        logger.warning("kiosk scan took %.0f ms: %s", result.total_seconds * 1000, result.timings)
+        st.caption(f"⚠️ {result.total_seconds * 1000:.0f} ms かかりました（目標 {KIOSK_BUDGET_SECONDS * 1000:.0f} ms）")
+    st.caption(" / ".join(f"{stage} {seconds * 1000:.0f} ms" for stage, seconds in result.timings))
+
+if st.session_state.kiosk_log:
+    st.markdown("#### 直近の読み取り")
+    st.dataframe(st.session_state.kiosk_log, hide_index=True)
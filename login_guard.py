@@ -0,0 +1,155 @@
+"""誕生日による本人確認の失敗を、データベースに問い合わせる前に止める。
+
+- 不一致だった (uuid, 誕生日) は一定時間キャッシュし、同じ組み合わせは問い合わせずに不一致を返す
+- 失敗回数を (uuid, クライアント) ごとと uuid ごとに数え、一定回数を超えたら
+  指数的に伸びる待ち時間のあいだは問い合わせずに断る
+- uuid は QR コードに印字されているので、uuid ごとの待ち時間は短く抑える（他人が誤入力を
+  続けても本人は長く締め出されない）。長い待ち時間は失敗したクライアント（セッション）にだけかける
+- 結果（問い合わせ・キャッシュで不一致・待ち時間中で拒否・成功）をカウンタに記録する
+
+失敗の記録はキャッシュの login 名前空間に置くので、同じホスト（ディスク）または
+同じ Redis を使うレプリカのあいだで共有される。失敗回数は incr（Redis の INCR、
+メモリとディスクはロックの中での読み書き）で数えるので、同時の試行でも数え漏れない。
+uuid・誕生日・クライアントはハッシュにしてから保存する。
+
+    outcome = get_login_guard().attempt(uuid, "1980-01-01", session_id, lambda: probe(...))
+    if outcome.status == "throttled":
+        st.warning(f"約{round(outcome.retry_after)}秒後に再度お試しください。")
+"""
+
+from __future__ import annotations
+
+import collections
+import hashlib
+import threading
+import time
+from typing import Callable
+
+from cache import NamespacedCache, get_cache
+
+# 不一致だった組み合わせを覚えておく時間（秒）
+NEGATIVE_TTL_SECONDS = 5 * 60
+# 待ち時間なしで許す失敗回数と、それ以降の待ち時間（base * 2^(超過回数-1)、上限つき）
+FREE_FAILURES_PER_CLIENT = 3
+FREE_FAILURES_PER_UUID = 10
+BACKOFF_BASE_SECONDS = 2.0
+BACKOFF_MAX_SECONDS = 300.0
+# uuid ごとの待ち時間の上限。本人が締め出されないよう短くする
+UUID_BACKOFF_MAX_SECONDS = 30.0
+
+
+class LoginOutcome:
+    """本人確認の結果。
+
+    status: "ok"（一致） / "not_found"（不一致） / "throttled"（待ち時間中のため未確認）
+    """
+
+    __slots__ = ("status", "latest_timestamp", "retry_after", "source")
+
+    def __init__(self, status: str, latest_timestamp: str | None = None,
+                 retry_after: float = 0.0, source: str = "db"):
+        self.status = status
+        self.latest_timestamp = latest_timestamp
+        self.retry_after = retry_after  # throttled のとき、次に試せるまでの秒数
+        self.source = source  # "db" / "negative_cache" / "client_backoff" / "uuid_backoff"
+
+
+def backoff_seconds(failures: int, free_failures: int, max_seconds: float = BACKOFF_MAX_SECONDS) -> float:
+    """失敗回数に対する待ち時間。free_failures 回までは待ち時間なし。"""
+    excess = failures - free_failures
+    if excess <= 0:
+        return 0.0
+    return min(BACKOFF_BASE_SECONDS * 2 ** (excess - 1), max_seconds)
+
+
+def _digest(*parts: str) -> str:
+    return hashlib.sha256("\0".join(parts).encode("utf-8")).hexdigest()
+
+
+class LoginGuard:
+    """本人確認の前段で、不一致のキャッシュと失敗回数による待ち時間を適用する。"""
+
+    def __init__(self, cache: NamespacedCache | None = None):
+        self.cache = cache or get_cache().namespace("login")
+        self._lock = threading.Lock()
+        self._counters: collections.Counter[str] = collections.Counter()
+
+    def _count(self, name: str) -> None:
+        with self._lock:
+            self._counters[name] += 1
+
+    @staticmethod
+    def _negative_key(uuid: str, bday: str) -> str:
+        return f"miss:{_digest(uuid, bday)}"
+
+    @staticmethod
+    def _scopes(uuid: str, client_id: str) -> list[tuple[str, str, int, float]]:
+        """(source, キー, 待ち時間なしの失敗回数, 待ち時間の上限) の一覧。"""
+        return [
+            ("client_backoff", f"client:{_digest(uuid, client_id)}", FREE_FAILURES_PER_CLIENT, BACKOFF_MAX_SECONDS),
+            ("uuid_backoff", f"uuid:{_digest(uuid)}", FREE_FAILURES_PER_UUID, UUID_BACKOFF_MAX_SECONDS),
+        ]
+
+    def attempt(self, uuid: str, bday: str, client_id: str,
+                probe: Callable[[], str | None]) -> LoginOutcome:
+        """本人確認を1回試みる。probe() は一致する問診の最新 timestamp（なければ None）を返す。
+
+        client_id は試行しているクライアントの識別子（Streamlit のセッション ID）。
+        probe() の例外はそのまま伝わり、失敗回数には数えない。
+        """
+        self._count("attempts")
+        now = time.time()
+        scopes = self._scopes(uuid, client_id)
+
+        for source, key, _, _ in scopes:
+            blocked_until = self.cache.get(f"{key}:until") or 0.0
+            if blocked_until > now:
+                self._count(f"throttled_{source.removesuffix('_backoff')}")
+                return LoginOutcome("throttled", retry_after=blocked_until - now, source=source)
+
+        negative = self.cache.get(self._negative_key(uuid, bday))
+        if negative is not None and negative["until"] > now:
+            self._count("negative_cache_hits")
+            self._record_failure(scopes, now)
+            return LoginOutcome("not_found", source="negative_cache")
+
+        self._count("db_checks")
+        latest_timestamp = probe()
+        if latest_timestamp is None:
+            self._count("failures")
+            self.cache.set(self._negative_key(uuid, bday), {"until": now + NEGATIVE_TTL_SECONDS})
+            self._record_failure(scopes, now)
+            return LoginOutcome("not_found")
+
+        self._count("successes")
+        for _, key, _, _ in scopes:
+            self.cache.delete(f"{key}:failures")
+            self.cache.delete(f"{key}:until")
+        return LoginOutcome("ok", latest_timestamp=latest_timestamp)
+
+    def _record_failure(self, scopes: list[tuple[str, str, int, float]], now: float) -> None:
+        for _, key, free_failures, max_seconds in scopes:
+            failures = self.cache.incr(f"{key}:failures")
+            if failures is None:
+                continue
+            wait = backoff_seconds(failures, free_failures, max_seconds)
+            if wait:
+                # 同時の失敗はほぼ同じ値を書くので、後から書いた方が残ってよい
+                self.cache.set(f"{key}:until", now + wait)
+
+    def metrics(self) -> dict:
+        with self._lock:
+            return dict(self._counters)
+
+
+_default_guard: LoginGuard | None = None
+_default_lock = threading.Lock()
+
+
+def get_login_guard() -> LoginGuard:
+    """プロセス内で共有する LoginGuard（カウンタはセッション間で共有する）。"""
+    global _default_guard
+    with _default_lock:
+        if _default_guard is None:
+            _default_guard = LoginGuard()
+        return _default_guard
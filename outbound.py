@@ -0,0 +1,367 @@
+"""外部呼び出し（画像ストレージ・Supabase）の期限・ヘッジ・再試行・サーキットブレーカー。
+
+    response = call(IMAGE_POLICY, host, lambda timeout: requests.get(url, timeout=timeout))
+    rows = execute_query(query).data
+
+- 期限: 1回の呼び出し全体（再試行を含む）の上限。超えたら DeadlineExceeded
+- ヘッジ: 最初の試行が最近の成功の p95 を過ぎても返らなければ、同じ呼び出しをもう1本出し、
+  先に成功した方を使う（冪等な読み出しのみ）
+- 再試行: 一時的な失敗（タイムアウト・接続エラー・5xx）なら期限内で回数を限って再試行する
+- サーキットブレーカー: 宛先ごとに一時的な失敗が続いたら一定時間すぐに CircuitOpen を返し、
+  呼び出し側はプレースホルダー表示などに切り替える
+- 呼び出し側の誤りによる失敗（画像の 404・不正なフィルタの APIError 等）は宛先の障害ではないので、
+  再試行もブレーカーへの記録もせず、元の例外をそのまま投げる
+
+呼び出しは共有のスレッドプールで実行する。fn には残り時間を渡し、fn はそれを HTTP クライアントの
+timeout に使う（execute_query は postgrest のリクエストに渡す）ので、期限を過ぎた試行のスレッドも
+ほぼ期限どおりに終わり、プールを塞ぎ続けない。
+
+期限のないポリシー（deadline=None、書き込み用）は、呼び出し元のスレッドで実際の結果が出るまで待つ。
+書き込みを途中で打ち切ると、実際には反映された行を失敗として扱い、再送で重複させてしまうため。
+"""
+
+from __future__ import annotations
+
+import collections
+import copy
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Callable, TypeVar
+from urllib.parse import urlsplit
+
+import httpx
+import requests
+from postgrest.exceptions import APIError
+
+T = TypeVar("T")
+
+# ヘッジの判定に使う直近の成功の所要時間の件数
+LATENCY_WINDOW = 200
+# p95 を計算するのに必要な最低件数（それまでは policy.hedge_after を使う）
+LATENCY_MIN_SAMPLES = 20
+OUTBOUND_WORKERS = 32
+
+TRANSIENT_EXCEPTIONS = (
+    TimeoutError, ConnectionError,
+    requests.Timeout, requests.ConnectionError,
+    httpx.TimeoutException, httpx.NetworkError, httpx.RemoteProtocolError,
+)
+# 一時的とみなす PostgREST のエラー（DB への接続失敗・接続プールの枯渇）
+TRANSIENT_PGRST_CODES = frozenset({"PGRST000", "PGRST001", "PGRST002", "PGRST003"})
+# 一時的とみなす SQLSTATE のクラス（接続例外・資源不足・文のタイムアウトなどの中断）
+TRANSIENT_SQLSTATE_CLASSES = ("08", "53", "57")
+
+
+class OutboundError(Exception):
+    """外部呼び出しが期限内に成功しなかった。"""
+
+
+class DeadlineExceeded(OutboundError):
+    pass
+
+
+class CircuitOpen(OutboundError):
+    """宛先のサーキットブレーカーが開いているため呼び出さなかった。"""
+
+
+def is_transient(error: BaseException) -> bool:
+    """再試行とブレーカーの対象になる一時的な失敗か（タイムアウト・接続エラー・5xx）。"""
+    if isinstance(error, TRANSIENT_EXCEPTIONS):
+        return True
+    # requests.HTTPError / httpx.HTTPStatusError は応答のステータスで判断する
+    status = getattr(getattr(error, "response", None), "status_code", None)
+    if status is not None:
+        return status >= 500
+    if isinstance(error, APIError):
+        code = error.code
+        # JSON でない応答（ゲートウェイのエラーページ等）は HTTP のステータスが code に入る
+        if isinstance(code, int):
+            return code >= 500
+        code = str(code or "")
+        return code in TRANSIENT_PGRST_CODES or code.startswith(TRANSIENT_SQLSTATE_CLASSES)
+    return False
+
+
+class CallPolicy:
+    """呼び出しの種類ごとの設定。
+
+    deadline: 再試行を含めた全体の上限（秒）。None なら HTTP クライアントの timeout まで待つ
+    hedge: ヘッジするか（冪等な呼び出しのみ True にする）
+    hedge_after: 所要時間の統計が揃うまでのヘッジまでの待ち時間（秒）
+    max_retries: 失敗時の再試行回数
+    """
+
+    __slots__ = ("name", "deadline", "hedge", "hedge_after", "max_retries", "retry_backoff")
+
+    def __init__(self, name: str, deadline: float | None, hedge: bool = True, hedge_after: float = 1.0,
+                 max_retries: int = 1, retry_backoff: float = 0.1):
+        self.name = name
+        self.deadline = deadline
+        self.hedge = hedge
+        self.hedge_after = hedge_after
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+
+
+IMAGE_POLICY = CallPolicy("image", deadline=6.0, hedge_after=1.5, max_retries=1)
+DB_READ_POLICY = CallPolicy("db_read", deadline=5.0, hedge_after=0.8, max_retries=1)
+# 書き込みは重複させない（ヘッジ・再試行なし、期限で打ち切らずに実際の結果を待つ）
+DB_WRITE_POLICY = CallPolicy("db_write", deadline=None, hedge=False, max_retries=0)
+
+
+class CircuitBreaker:
+    """宛先ごとの連続失敗を数え、閾値を超えたら cooldown 秒のあいだ呼び出しを止める。
+
+    cooldown が過ぎたら1本だけ試し（half-open）、成功すれば閉じ、失敗すればまた開く。
+    """
+
+    def __init__(self, failure_threshold: int = 5, cooldown: float = 30.0):
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at: float | None = None
+        self._trial_in_flight = False
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            if self._opened_at is None:
+                return "closed"
+            if time.monotonic() - self._opened_at >= self.cooldown:
+                return "half_open"
+            return "open"
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            if time.monotonic() - self._opened_at < self.cooldown or self._trial_in_flight:
+                return False
+            self._trial_in_flight = True
+            return True
+
+    def record_success(self) -> None:
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._trial_in_flight = False
+
+    def release(self) -> None:
+        """宛先の状態が分からなかった試行（呼び出し側の誤り）の後、half-open の試し枠だけを返す。"""
+        with self._lock:
+            self._trial_in_flight = False
+
+    def record_failure(self) -> bool:
+        """失敗を記録する。この失敗でブレーカーが開いたら True。"""
+        with self._lock:
+            self._failures += 1
+            was_trial = self._trial_in_flight
+            self._trial_in_flight = False
+            if was_trial or (self._opened_at is None and self._failures >= self.failure_threshold):
+                self._opened_at = time.monotonic()
+                return True
+            return False
+
+
+class OutboundCaller:
+    """ポリシーごとの所要時間・カウンタと、宛先ごとのブレーカーを持つ呼び出し口。"""
+
+    def __init__(self, workers: int = OUTBOUND_WORKERS):
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="outbound")
+        self._lock = threading.Lock()
+        self._latencies: dict[str, collections.deque[float]] = {}
+        self._breakers: dict[str, CircuitBreaker] = {}
+        self._counters: dict[str, collections.Counter[str]] = {}
+
+    def breaker(self, host: str) -> CircuitBreaker:
+        with self._lock:
+            if host not in self._breakers:
+                self._breakers[host] = CircuitBreaker()
+            return self._breakers[host]
+
+    def _count(self, policy: CallPolicy, name: str, n: int = 1) -> None:
+        with self._lock:
+            self._counters.setdefault(policy.name, collections.Counter())[name] += n
+
+    def _record_latency(self, policy: CallPolicy, seconds: float) -> None:
+        with self._lock:
+            self._latencies.setdefault(policy.name, collections.deque(maxlen=LATENCY_WINDOW)).append(seconds)
+
+    def p95(self, policy_name: str) -> float | None:
+        """直近の成功の所要時間の p95（件数が足りなければ None）。"""
+        with self._lock:
+            samples = sorted(self._latencies.get(policy_name, ()))
+        if len(samples) < LATENCY_MIN_SAMPLES:
+            return None
+        return samples[min(len(samples) - 1, int(len(samples) * 0.95))]
+
+    def hedge_delay(self, policy: CallPolicy) -> float:
+        """ヘッジを出すまでの待ち時間（直近の成功の p95、統計が揃うまでは hedge_after）。"""
+        p95 = self.p95(policy.name)
+        return policy.hedge_after if p95 is None else p95
+
+    def call(self, policy: CallPolicy, host: str, fn: Callable[[float | None], T]) -> T:
+        """fn(残り時間) をポリシーに従って呼び出す（期限のないポリシーでは fn(None)）。
+
+        一時的な失敗で成功しなければ OutboundError（DeadlineExceeded / CircuitOpen /
+        最後の例外を原因に持つもの）。呼び出し側の誤りによる失敗は、その例外をすぐに投げる。
+        """
+        breaker = self.breaker(host)
+        self._count(policy, "calls")
+        if not breaker.allow():
+            self._count(policy, "breaker_rejected")
+            raise CircuitOpen(f"{host} は一時的に呼び出しを止めています")
+
+        if policy.deadline is None:
+            return self._call_unbounded(policy, breaker, fn)
+
+        deadline = time.monotonic() + policy.deadline
+        last_error: BaseException | None = None
+        for attempt in range(policy.max_retries + 1):
+            if attempt:
+                self._count(policy, "retries")
+                time.sleep(min(policy.retry_backoff * 2 ** (attempt - 1), max(0.0, deadline - time.monotonic())))
+            if time.monotonic() >= deadline:
+                break
+            try:
+                result = self._attempt(policy, fn, deadline)
+            except DeadlineExceeded as e:
+                last_error = e
+                break
+            except Exception as e:
+                if not is_transient(e):
+                    self._count(policy, "client_errors")
+                    breaker.release()
+                    raise
+                last_error = e
+                self._count(policy, "errors")
+                continue
+            breaker.record_success()
+            self._count(policy, "successes")
+            return result
+
+        if breaker.record_failure():
+            self._count(policy, "breaker_opened")
+        if isinstance(last_error, DeadlineExceeded) or last_error is None:
+            self._count(policy, "deadline_exceeded")
+            raise DeadlineExceeded(f"{policy.name}: {policy.deadline}s 以内に応答がありませんでした")
+        raise OutboundError(f"{policy.name}: {last_error}") from last_error
+
+    def _call_unbounded(self, policy: CallPolicy, breaker: CircuitBreaker, fn: Callable[[float | None], T]) -> T:
+        """期限のないポリシーの呼び出し。呼び出し元のスレッドで1回だけ実行し、結果を待つ。"""
+        started = time.monotonic()
+        try:
+            result = fn(None)
+        except Exception as e:
+            if not is_transient(e):
+                self._count(policy, "client_errors")
+                breaker.release()
+                raise
+            self._count(policy, "errors")
+            if breaker.record_failure():
+                self._count(policy, "breaker_opened")
+            raise OutboundError(f"{policy.name}: {e}") from e
+        self._record_latency(policy, time.monotonic() - started)
+        breaker.record_success()
+        self._count(policy, "successes")
+        return result
+
+    def _attempt(self, policy: CallPolicy, fn: Callable[[float], T], deadline: float) -> T:
+        """1回の試行（必要ならヘッジを1本追加）。どちらも失敗したら最後の例外を投げる。
+
+        最初の試行がヘッジ前に失敗した場合はヘッジを出さず、呼び出し側の再試行に任せる。
+        """
+        started = time.monotonic()
+        futures = {self._executor.submit(fn, deadline - started): "primary"}
+        hedged = False
+        error: BaseException | None = None
+        while futures:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise DeadlineExceeded(policy.name)
+            timeout = remaining
+            if policy.hedge and not hedged:
+                timeout = min(remaining, max(0.0, started + self.hedge_delay(policy) - time.monotonic()))
+            done, _pending = wait(futures, timeout=timeout, return_when=FIRST_COMPLETED)
+            if not done:
+                if policy.hedge and not hedged and time.monotonic() < deadline:
+                    hedged = True
+                    self._count(policy, "hedges")
+                    futures[self._executor.submit(fn, deadline - time.monotonic())] = "hedge"
+                continue
+            for future in done:
+                kind = futures.pop(future)
+                try:
+                    result = future.result()
+                except Exception as e:
+                    error = e
+                    continue
+                self._record_latency(policy, time.monotonic() - started)
+                if kind == "hedge":
+                    self._count(policy, "hedge_wins")
+                return result
+        raise error if error is not None else DeadlineExceeded(policy.name)
+
+    def metrics(self) -> dict:
+        """ポリシーごとのカウンタと p95、宛先ごとのブレーカーの状態。"""
+        with self._lock:
+            counters = {name: dict(counter) for name, counter in self._counters.items()}
+            breakers = dict(self._breakers)
+        for name, counter in counters.items():
+            p95 = self.p95(name)
+            counter["p95_ms"] = None if p95 is None else round(p95 * 1000, 1)
+        return {
+            "policies": counters,
+            "breakers": {host: breaker.state for host, breaker in breakers.items()},
+        }
+
+
+_default_caller: OutboundCaller | None = None
+_default_lock = threading.Lock()
+
+
+def get_caller() -> OutboundCaller:
+    """プロセス内で共有する呼び出し口（ブレーカーとカウンタはセッション間で共有する）。"""
+    global _default_caller
+    with _default_lock:
+        if _default_caller is None:
+            _default_caller = OutboundCaller()
+        return _default_caller
+
+
+def host_of(url: str) -> str:
+    return urlsplit(url).netloc or url
+
+
+def call(policy: CallPolicy, host: str, fn: Callable[[float | None], T]) -> T:
+    return get_caller().call(policy, host, fn)
+
+
+class _TimeoutSession:
+    """postgrest のリクエストに timeout を付けて、共有の httpx クライアントに渡す。"""
+
+    __slots__ = ("_session", "_timeout")
+
+    def __init__(self, session, timeout: float):
+        self._session = session
+        self._timeout = timeout
+
+    def request(self, *args, **kwargs):
+        return self._session.request(*args, timeout=self._timeout, **kwargs)
+
+
+def with_timeout(query, timeout: float | None):
+    """残り時間を HTTP の timeout にしたクエリの複製（ヘッジと並行して使えるよう元は変えない）。"""
+    session = getattr(query, "session", None)
+    if timeout is None or session is None:
+        return query
+    bounded = copy.copy(query)
+    bounded.session = _TimeoutSession(session, max(timeout, 0.001))
+    return bounded
+
+
+def execute_query(query, policy: CallPolicy = DB_READ_POLICY, host: str = "supabase"):
+    """Supabase のクエリビルダーの execute() をポリシーに従って実行する。"""
+    return call(policy, host, lambda timeout: with_timeout(query, timeout).execute())
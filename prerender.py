@@ -0,0 +1,244 @@
+"""新しい解析結果が届いたらレポートを事前生成するワーカー。
+
+results テーブルを created_at でポーリング（または submit で通知）し、
+PDF・画像サムネイルを ReportStore に、静的HTMLを snapshot に書き込む。
+患者がページを開いたときには生成済みの成果物を読むだけで済む。
+
+    python prerender.py --workers 4 --queue-size 200 --interval 5
+"""
+
+from __future__ import annotations
+
+import argparse
+import collections
+import json
+import logging
+import os
+import queue
+import threading
+import time
+
+from athero_percentiles import evaluate_visit
+from history import fetch_questionnaire_by_timestamp, fetch_visit_results
+from report import download_image, generate_pdf, make_thumbnail, register_fonts, report_etag
+from report_archive import get_archive
+from report_store import ReportStore
+from snapshot import export_snapshot, snapshot_hash, snapshot_path
+
+logger = logging.getLogger(__name__)
+
+POLL_PAGE_SIZE = 100
+LAG_WINDOW = 500
+
+
+def prerender_visit(client, store: ReportStore, uuid: str, captured_datetime: str) -> str:
+    """1回の撮影分の成果物を生成して保存する。
+
+    戻り値は "completed"（生成した）/ "unchanged"（同じ内容ハッシュの PDF とスナップショットが
+    保存済みなので何もしなかった）/ "skipped"（問診か結果がない）。
+    """
+    questionnaire = fetch_questionnaire_by_timestamp(client, uuid, captured_datetime)
+    visit = fetch_visit_results(client, uuid, captured_datetime)
+    if questionnaire is None or visit is None:
+        return "skipped"
+    captured_at = questionnaire.captured_at
+
+    etag = report_etag(questionnaire, visit)
+    if store.get_pdf(uuid, captured_at, etag) is not None and \
+            os.path.exists(snapshot_path(snapshot_hash(questionnaire, visit))):
+        return "unchanged"
+
+    thumbnails: dict[str, bytes] = {}
+    for eye_result in visit.eyes():
+        if eye_result.image_url:
+            img = download_image(eye_result.image_url)
+            if img:
+                thumbnails[eye_result.eye] = make_thumbnail(img)
+                store.put_thumbnail(uuid, captured_at, eye_result.eye, thumbnails[eye_result.eye])
+
+    peer_report = evaluate_visit(questionnaire.gender, questionnaire.real_age, visit)
+
+    pdf_bytes = generate_pdf(
+        questionnaire, visit.right, visit.left, questionnaire.real_age, peer_report=peer_report
+    )
+    store.put_pdf(uuid, captured_at, etag, pdf_bytes)
+    # 生成した PDF は保管期間の要件のためすべてアーカイブに残す
+    get_archive().put(uuid, captured_at, etag, pdf_bytes)
+    export_snapshot(questionnaire, visit, thumbnails, peer_report=peer_report)
+    return "completed"
+
+
+class PrerenderJob:
+    __slots__ = ("uuid", "captured_datetime", "enqueued_at")
+
+    def __init__(self, uuid: str, captured_datetime: str):
+        self.uuid = uuid
+        self.captured_datetime = captured_datetime
+        self.enqueued_at = time.monotonic()
+
+
+class PrerenderWorker:
+    """上限付きキューと固定数のワーカースレッドで事前生成を行う。"""
+
+    def __init__(self, client, store: ReportStore, workers: int = 2, queue_size: int = 100):
+        self.client = client
+        self.store = store
+        self.workers = workers
+        self._queue: queue.Queue[PrerenderJob | None] = queue.Queue(maxsize=queue_size)
+        self._pending: dict[tuple[str, str], PrerenderJob] = {}
+        self._lock = threading.Lock()
+        self._threads: list[threading.Thread] = []
+        self._lags: collections.deque[float] = collections.deque(maxlen=LAG_WINDOW)
+        self._counts = collections.Counter()
+
+    def submit(self, uuid: str, captured_datetime: str, block: bool = True) -> bool:
+        """撮影1回分のジョブを積む。処理待ちの重複は無視する。
+
+        block=False でキューが満杯なら積まずに False を返す（dropped として計上）。
+        """
+        key = (uuid, captured_datetime)
+        with self._lock:
+            if key in self._pending:
+                self._counts["deduplicated"] += 1
+                return True
+            job = PrerenderJob(uuid, captured_datetime)
+            self._pending[key] = job
+        try:
+            self._queue.put(job, block=block)
+        except queue.Full:
+            with self._lock:
+                del self._pending[key]
+                self._counts["dropped"] += 1
+            return False
+        with self._lock:
+            self._counts["enqueued"] += 1
+        return True
+
+    def start(self) -> None:
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._run, name=f"prerender-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self) -> None:
+        for _ in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+        self._threads.clear()
+
+    def _run(self) -> None:
+        while True:
+            job = self._queue.get()
+            if job is None:
+                return
+            key = (job.uuid, job.captured_datetime)
+            # 処理開始時点で pending から外し、処理中に届いた更新で再生成されるようにする
+            with self._lock:
+                self._pending.pop(key, None)
+            try:
+                status = prerender_visit(self.client, self.store, job.uuid, job.captured_datetime)
+            except Exception:
+                logger.exception("prerender failed: %s %s", job.uuid, job.captured_datetime)
+                with self._lock:
+                    self._counts["failed"] += 1
+                continue
+            lag = time.monotonic() - job.enqueued_at
+            with self._lock:
+                self._counts[status] += 1
+                self._lags.append(lag)
+
+    def metrics(self) -> dict:
+        """キュー長・待ち時間・処理遅延（キュー投入から保存完了まで）の指標を返す。"""
+        now = time.monotonic()
+        with self._lock:
+            oldest_wait = max((now - job.enqueued_at for job in self._pending.values()), default=0.0)
+            lags = sorted(self._lags)
+            counts = dict(self._counts)
+        metrics = {
+            "queue_depth": self._queue.qsize(),
+            "queue_capacity": self._queue.maxsize,
+            "workers": self.workers,
+            "oldest_wait_seconds": round(oldest_wait, 3),
+            **counts,
+        }
+        if lags:
+            metrics["lag_p50_seconds"] = round(lags[len(lags) // 2], 3)
+            metrics["lag_p95_seconds"] = round(lags[min(len(lags) - 1, int(len(lags) * 0.95))], 3)
+            metrics["lag_max_seconds"] = round(lags[-1], 3)
+        return metrics
+
+
+class ResultPoller:
+    """results の新着行を (created_at, id) 昇順の複合キーセットでポーリングする。
+
+    一括取り込みで同じ created_at の行が page_size 件を超えても、id で順序が決まるので
+    同じページを繰り返したり行を飛ばしたりしない。
+    """
+
+    def __init__(self, client, since: str | None = None, page_size: int = POLL_PAGE_SIZE):
+        self.client = client
+        # 最後に処理した行の (created_at, id)。since だけ指定されたときは id なし（その時刻以降）
+        self.cursor = since
+        self.cursor_id = None
+        self.page_size = page_size
+
+    def poll(self) -> list[tuple[str, str]]:
+        """新着の (uuid, 撮影日時) を返し、カーソルを進める。"""
+        query = self.client.table("results") \
+            .select("id, questionnaire_uuid, captured_datetime, eye, created_at")
+        if self.cursor and self.cursor_id is not None:
+            created_at, row_id = f'"{self.cursor}"', f'"{self.cursor_id}"'
+            query = query.or_(
+                f"created_at.gt.{created_at},"
+                f"and(created_at.eq.{created_at},id.gt.{row_id})"
+            )
+        elif self.cursor:
+            query = query.gte("created_at", self.cursor)
+        response = query.order("created_at").order("id").limit(self.page_size).execute()
+
+        visits: list[tuple[str, str]] = []
+        for row in response.data or []:
+            self.cursor, self.cursor_id = row["created_at"], row["id"]
+            visit = (row["questionnaire_uuid"], row["captured_datetime"])
+            if visit not in visits:
+                visits.append(visit)
+        return visits
+
+
+def main() -> None:
+    from service_client import create_service_client
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument("--queue-size", type=int, default=100)
+    parser.add_argument("--interval", type=float, default=5.0, help="ポーリング間隔（秒）")
+    parser.add_argument("--since", default=None, help="この created_at 以降の結果から処理する")
+    parser.add_argument("--metrics-interval", type=float, default=60.0)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    register_fonts()
+    client = create_service_client()
+    worker = PrerenderWorker(client, ReportStore(), workers=args.workers, queue_size=args.queue_size)
+    poller = ResultPoller(client, since=args.since)
+    worker.start()
+
+    last_metrics = time.monotonic()
+    try:
+        while True:
+            for uuid, captured_datetime in poller.poll():
+                # キューが満杯ならここで待ち、カーソルを先に進めない
+                worker.submit(uuid, captured_datetime, block=True)
+            if time.monotonic() - last_metrics >= args.metrics_interval:
+                logger.info("prerender metrics %s", json.dumps(worker.metrics()))
+                last_metrics = time.monotonic()
+            time.sleep(args.interval)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        worker.stop()
+
+
+if __name__ == "__main__":
+    main()
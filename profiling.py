@@ -0,0 +1,176 @@
+"""スクリプト実行（rerun）ごとのサンプリングプロファイラ。
+
+別スレッドから一定間隔でスクリプト実行スレッドのスタックを採取し、
+スクリプト本体のフレームがスタックから消えた時点（正常終了・st.stop・st.rerun の
+いずれでも）を実行の終わりとして、collapsed stack 形式（flamegraph.pl / speedscope で
+読める）と speedscope JSON をディレクトリに書き出す。
+
+有効にする方法:
+    VIEWER_PROFILE=1                         すべての実行を計測する
+    ?profile=1                               サイドバーでスタッフキーを入力したセッションだけ計測する
+                                             （キーは URL に載せない）
+"""
+
+from __future__ import annotations
+
+import collections
+import datetime
+import json
+import os
+import sys
+import threading
+import time
+
+PROFILE_DIR = os.environ.get(
+    "VIEWER_PROFILE_DIR", os.path.join(os.path.dirname(__file__), ".profiles")
+)
+SAMPLE_INTERVAL_SECONDS = 0.005
+# 1回の実行で採取するサンプル数の上限（止まらない実行でメモリを使い切らないため）
+MAX_SAMPLES = 200_000
+
+
+def profiling_requested(query_params, is_staff: bool) -> bool:
+    """環境変数、またはスタッフ認証済みのセッションのクエリパラメータで計測が要求されているか。"""
+    if os.environ.get("VIEWER_PROFILE") == "1":
+        return True
+    return is_staff and query_params.get("profile") == "1"
+
+
+def _frame_label(code) -> str:
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+class RerunProfiler:
+    """1回のスクリプト実行を計測するサンプリングプロファイラ。"""
+
+    def __init__(self, script_path: str, interval: float = SAMPLE_INTERVAL_SECONDS,
+                 output_dir: str = PROFILE_DIR):
+        self.script_path = os.path.abspath(script_path)
+        self.interval = interval
+        self.output_dir = output_dir
+        self.thread_id = threading.get_ident()
+        # 計測対象の実行のスクリプト本体フレーム。同じスレッドで次の実行が始まっても
+        # 区別できるよう、フレームそのものを（計測が終わるまで）保持する
+        self._module_frame = self._find_module_frame(sys._getframe())
+        self.started_at = datetime.datetime.now()
+        self.stacks: collections.Counter[tuple[str, ...]] = collections.Counter()
+        self.sample_count = 0
+        self.duration = 0.0
+        self.output_paths: list[str] = []
+        self.finished = threading.Event()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._sample_loop, name="rerun-profiler", daemon=True)
+
+    @classmethod
+    def start(cls, script_path: str, **kwargs) -> RerunProfiler:
+        """呼び出したスレッド（スクリプト実行スレッド）の計測を始める。"""
+        profiler = cls(script_path, **kwargs)
+        profiler._thread.start()
+        return profiler
+
+    def stop(self) -> None:
+        self._stop.set()
+        self.finished.wait()
+
+    def _find_module_frame(self, frame):
+        while frame is not None:
+            if frame.f_code.co_filename == self.script_path and frame.f_code.co_name == "<module>":
+                return frame
+            frame = frame.f_back
+        return None
+
+    def _script_stack(self, frame) -> tuple[str, ...] | None:
+        """スクリプト本体のフレームから末端までのスタック（根→葉）。本体がなければ None。"""
+        labels = []
+        while frame is not None:
+            labels.append(_frame_label(frame.f_code))
+            if frame is self._module_frame:
+                return tuple(reversed(labels))
+            frame = frame.f_back
+        return None
+
+    def _sample_loop(self) -> None:
+        start = time.perf_counter()
+        try:
+            while not self._stop.is_set() and self.sample_count < MAX_SAMPLES:
+                frame = sys._current_frames().get(self.thread_id)
+                stack = self._script_stack(frame) if frame is not None else None
+                if stack is None:
+                    # スクリプト本体が終わった（または実行スレッドが終了した）
+                    break
+                self.stacks[stack] += 1
+                self.sample_count += 1
+                time.sleep(self.interval)
+            self.duration = time.perf_counter() - start
+            self._write()
+        finally:
+            self._module_frame = None
+            self.finished.set()
+
+    # --- 書き出し ---
+
+    def collapsed(self) -> str:
+        """collapsed stack 形式（1行 = "根;...;葉 サンプル数"）。"""
+        return "".join(f"{';'.join(stack)} {count}\n" for stack, count in self.stacks.most_common())
+
+    def speedscope(self) -> dict:
+        frames: list[dict] = []
+        index: dict[str, int] = {}
+        samples = []
+        weights = []
+        seconds_per_sample = self.duration / self.sample_count if self.sample_count else self.interval
+        for stack, count in self.stacks.items():
+            ids = []
+            for label in stack:
+                if label not in index:
+                    index[label] = len(frames)
+                    frames.append({"name": label})
+                ids.append(index[label])
+            samples.append(ids)
+            weights.append(count * seconds_per_sample)
+        return {
+            "$schema": "https://www.speedscope.app/file-format-schema.json",
+            "shared": {"frames": frames},
+            "profiles": [{
+                "type": "sampled",
+                "name": f"rerun {self.started_at.isoformat(timespec='seconds')}",
+                "unit": "seconds",
+                "startValue": 0,
+                "endValue": sum(weights),
+                "samples": samples,
+                "weights": weights,
+            }],
+            "exporter": "oculomics-result-viewer",
+        }
+
+    def _write(self) -> None:
+        if not self.sample_count:
+            return
+        os.makedirs(self.output_dir, exist_ok=True)
+        stem = os.path.join(
+            self.output_dir,
+            f"{self.started_at.strftime('%Y%m%dT%H%M%S%f')}-{os.getpid()}",
+        )
+        with open(f"{stem}.collapsed", "w", encoding="utf-8") as f:
+            f.write(self.collapsed())
+        with open(f"{stem}.speedscope.json", "w", encoding="utf-8") as f:
+            json.dump(self.speedscope(), f, ensure_ascii=False)
+        self.output_paths = [f"{stem}.collapsed", f"{stem}.speedscope.json"]
+
+    def top(self, n: int = 10) -> list[dict]:
+        """自己時間の長い関数の上位 n 件（累積時間つき、ミリ秒）。"""
+        ms_per_sample = (self.duration / self.sample_count * 1000) if self.sample_count else 0.0
+        self_counts: collections.Counter[str] = collections.Counter()
+        total_counts: collections.Counter[str] = collections.Counter()
+        for stack, count in self.stacks.items():
+            self_counts[stack[-1]] += count
+            for label in set(stack):
+                total_counts[label] += count
+        return [
+            {
+                "function": label,
+                "self_ms": round(count * ms_per_sample, 1),
+                "total_ms": round(total_counts[label] * ms_per_sample, 1),
+            }
+            for label, count in self_counts.most_common(n)
+        ]
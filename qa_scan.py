@@ -0,0 +1,242 @@
+"""results / questionnaires のデータ品質チェック（夜間バッチ用）。
+
+    python qa_scan.py --out qa_anomalies.jsonl
+    python qa_scan.py --out qa_anomalies.jsonl --max-per-check 200 --page-size 1000
+
+visit_stream で全件を1ページずつ読み、左右の結果を1回の撮影にまとめたうえで、
+ページごとに NumPy の列演算でまとめて検査する。撮影時年齢は結果ページと同じく
+問診の誕生日と撮影日から計算する（QuestionnaireRecord.real_age）。
+
+撮影日時が NULL の行は visit_stream では読めないので、別の1回の問い合わせで数える。
+誕生日や撮影日時が読めない行も検査を止めずに異常として書き出す。
+
+見つかった異常は1件1行の JSON Lines に書き出し（検査ごとの件数上限つき）、
+検査ごとの件数などの集計を標準出力に出す。患者が結果ページを開いて初めて
+「データなし」やエラーになるような行を、事前に見つけるためのもの。
+"""
+
+from __future__ import annotations
+
+import argparse
+import collections
+import json
+import logging
+import time
+
+import numpy as np
+
+from athero_percentiles import GENDERS
+from visit_stream import STREAM_PAGE_SIZE, iter_visit_batches
+
+logger = logging.getLogger(__name__)
+
+# 眼底年齢と撮影時年齢の差がこれを超えたら異常とする（年）
+FUNDUS_AGE_GAP_YEARS = 20
+# 撮影時年齢として妥当な範囲（誕生日の入力誤りを見つける）
+AGE_RANGE = (0, 110)
+# リスクスコアの範囲
+RISK_RANGE = (0.0, 1.0)
+# 検査ごとに書き出す異常の件数の上限（件数の集計は上限なしで数える）
+MAX_PER_CHECK = 1000
+
+EYES = (("R", "right"), ("L", "left"))
+SCORE_COLUMNS = ("fundus_age", "glaucoma_risk", "atherosclerosis_risk")
+
+QA_CHECKS = {
+    "missing_captured_datetime": "撮影日時が空（どの撮影にも属さず、結果ページに表示されない）",
+    "invalid_captured_datetime": "撮影日時を日時として読めない",
+    "missing_questionnaire": "撮影日時と timestamp が一致する問診がない（結果ページに表示されない）",
+    "timestamp_text_mismatch": "問診の timestamp と撮影日時が同じ時刻だが表記が異なる",
+    "missing_bday": "問診に誕生日がない（撮影時年齢を計算できない）",
+    "invalid_bday": "問診の誕生日を日付として読めない（撮影時年齢を計算できない）",
+    "implausible_age": "撮影時年齢が妥当な範囲外（誕生日の入力誤りの可能性）",
+    "unknown_gender": "性別が M/F 以外（同年代・同性との比較ができない）",
+    "missing_eye": "左右どちらかの結果がない",
+    "unassigned_rows": "左右に振り分けられなかった行（eye の値が不正、または同じ眼の重複）",
+    "missing_score": "スコアが空",
+    "risk_out_of_range": "リスクスコアが 0〜1 の範囲外",
+    "fundus_age_gap": f"眼底年齢と撮影時年齢の差が {FUNDUS_AGE_GAP_YEARS} 年を超える",
+    "missing_image": "画像 URL がない",
+}
+
+
+class Anomaly:
+    """1件の異常。eye は眼ごとの検査のときだけ入る。"""
+
+    __slots__ = ("check", "uuid", "captured_datetime", "eye", "value")
+
+    def __init__(self, check: str, uuid: str, captured_datetime: str | None, eye: str | None = None, value=None):
+        self.check = check
+        self.uuid = uuid
+        self.captured_datetime = captured_datetime
+        self.eye = eye
+        self.value = value
+
+    def to_dict(self) -> dict:
+        data = {"check": self.check, "uuid": self.uuid, "captured_datetime": self.captured_datetime}
+        if self.eye is not None:
+            data["eye"] = self.eye
+        if self.value is not None:
+            data["value"] = self.value
+        return data
+
+
+def _float_column(values) -> np.ndarray:
+    return np.array([np.nan if value is None else float(value) for value in values], dtype=float)
+
+
+def _round(value: float):
+    return None if np.isnan(value) else round(float(value), 4)
+
+
+def scan_batch(batch) -> list[Anomaly]:
+    """1バッチ分の撮影を検査し、見つかった異常を返す。"""
+    visits = batch.visits
+    if not visits:
+        return []
+    uuids = [streamed.uuid for streamed in visits]
+    captured = [streamed.captured_datetime for streamed in visits]
+    anomalies: list[Anomaly] = []
+
+    def report(check: str, mask: np.ndarray, eye: str | None = None, values: np.ndarray | None = None):
+        for i in np.flatnonzero(mask):
+            anomalies.append(Anomaly(
+                check, uuids[i], captured[i], eye, _round(values[i]) if values is not None else None
+            ))
+
+    # --- 読めなかった値（visit_stream が撮影をまとめるときに見つけたもの） ---
+    invalid_captured = np.array(["invalid_captured_datetime" in streamed.issues for streamed in visits])
+    invalid_bday = np.array(["invalid_bday" in streamed.issues for streamed in visits])
+    report("invalid_captured_datetime", invalid_captured)
+    report("invalid_bday", invalid_bday)
+
+    # --- 問診（撮影時年齢・性別） ---
+    questionnaires = [streamed.questionnaire for streamed in visits]
+    has_questionnaire = np.array([q is not None for q in questionnaires])
+    has_bday = np.array([q is not None and q.bday is not None for q in questionnaires])
+    real_age = _float_column([q.real_age if q is not None and q.bday is not None else None for q in questionnaires])
+    report("missing_questionnaire", ~has_questionnaire & ~invalid_captured)
+    report("timestamp_text_mismatch", np.array([
+        q is not None and q.timestamp != c for q, c in zip(questionnaires, captured)
+    ]))
+    report("missing_bday", has_questionnaire & ~has_bday & ~invalid_bday)
+    with np.errstate(invalid="ignore"):
+        report("implausible_age", has_bday & ((real_age < AGE_RANGE[0]) | (real_age > AGE_RANGE[1])), values=real_age)
+    report("unknown_gender", np.array([q is not None and q.gender not in GENDERS for q in questionnaires]))
+
+    # --- 左右の結果 ---
+    eye_counts = np.zeros(len(visits), dtype=int)
+    for eye, attribute in EYES:
+        results = [getattr(streamed.visit, attribute) for streamed in visits]
+        present = np.array([result is not None for result in results])
+        eye_counts += present
+        report("missing_eye", ~present, eye)
+        scores = {
+            name: _float_column([getattr(result, name) if result is not None else None for result in results])
+            for name in SCORE_COLUMNS
+        }
+        missing_score = present & np.any([np.isnan(column) for column in scores.values()], axis=0)
+        report("missing_score", missing_score, eye)
+        with np.errstate(invalid="ignore"):
+            for name in ("glaucoma_risk", "atherosclerosis_risk"):
+                column = scores[name]
+                report("risk_out_of_range", (column < RISK_RANGE[0]) | (column > RISK_RANGE[1]), eye, column)
+            gap = scores["fundus_age"] - real_age
+            report("fundus_age_gap", np.abs(gap) > FUNDUS_AGE_GAP_YEARS, eye, gap)
+        report("missing_image", present & np.array([result is not None and not result.image_url for result in results]), eye)
+
+    # ページ内の行数と左右に振り分けた件数の差（撮影ごとには分からないのでバッチ単位で数える）
+    unassigned = batch.rows_read - int(eye_counts.sum())
+    if unassigned > 0:
+        anomalies.append(Anomaly("unassigned_rows", "*", batch.visits[-1].captured_datetime, value=unassigned))
+    return anomalies
+
+
+class QaScanReport:
+    """検査全体の集計と、異常の書き出し（検査ごとの上限つき）。"""
+
+    def __init__(self, out, max_per_check: int = MAX_PER_CHECK):
+        self.out = out
+        self.max_per_check = max_per_check
+        self.counts: collections.Counter[str] = collections.Counter()
+        self.written: collections.Counter[str] = collections.Counter()
+        self.visits = 0
+        self.rows = 0
+        self.last_captured_datetime: str | None = None
+
+    def add_batch(self, batch) -> None:
+        self.visits += len(batch.visits)
+        self.rows += batch.rows_read
+        if batch.visits:
+            self.last_captured_datetime = batch.visits[-1].captured_datetime
+        self.add_anomalies(scan_batch(batch))
+
+    def add_missing_captured_datetime(self, rows: list[dict], total: int) -> None:
+        """撮影日時が NULL の行（書き出すのは rows、件数は total）。"""
+        self.rows += total
+        self.counts["missing_captured_datetime"] += total - len(rows)
+        self.add_anomalies([
+            Anomaly("missing_captured_datetime", row.get("questionnaire_uuid"), None, row.get("eye"))
+            for row in rows
+        ])
+
+    def add_anomalies(self, anomalies: list[Anomaly]) -> None:
+        for anomaly in anomalies:
+            # unassigned_rows は撮影単位ではないので、件数は行数で数える
+            self.counts[anomaly.check] += anomaly.value if anomaly.check == "unassigned_rows" else 1
+            if self.written[anomaly.check] < self.max_per_check:
+                self.written[anomaly.check] += 1
+                self.out.write(json.dumps(anomaly.to_dict(), ensure_ascii=False) + "\n")
+
+    def summary(self) -> dict:
+        return {
+            "visits": self.visits,
+            "rows": self.rows,
+            "last_captured_datetime": self.last_captured_datetime,
+            "anomalies": {check: self.counts[check] for check in QA_CHECKS if self.counts[check]},
+            "truncated": sorted(check for check in self.counts if self.counts[check] > self.written[check]
+                                and check != "unassigned_rows"),
+        }
+
+
+def fetch_missing_captured_datetime(client, limit: int) -> tuple[list[dict], int]:
+    """撮影日時が NULL の results の行（先頭 limit 件）と、その総数。"""
+    response = client.table("results").select("questionnaire_uuid, eye", count="exact") \
+        .is_("captured_datetime", "null") \
+        .limit(limit) \
+        .execute()
+    rows = response.data or []
+    return rows, response.count if response.count is not None else len(rows)
+
+
+def run_scan(client, out_path: str, page_size: int = STREAM_PAGE_SIZE, max_per_check: int = MAX_PER_CHECK) -> dict:
+    """全件を検査して異常を out_path に書き出し、集計を返す。"""
+    started = time.monotonic()
+    with open(out_path, "w", encoding="utf-8") as out:
+        report = QaScanReport(out, max_per_check)
+        report.add_missing_captured_datetime(*fetch_missing_captured_datetime(client, max_per_check))
+        for batch in iter_visit_batches(client, page_size=page_size):
+            report.add_batch(batch)
+            logger.info("scanned %d visits (up to %s)", report.visits, report.last_captured_datetime)
+    summary = report.summary()
+    summary["seconds"] = round(time.monotonic() - started, 1)
+    return summary
+
+
+def main() -> None:
+    from service_client import create_service_client
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--out", required=True, help="異常を書き出す JSON Lines ファイル")
+    parser.add_argument("--page-size", type=int, default=STREAM_PAGE_SIZE)
+    parser.add_argument("--max-per-check", type=int, default=MAX_PER_CHECK,
+                        help="検査ごとに書き出す件数の上限（件数の集計は全件）")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    summary = run_scan(create_service_client(), args.out, args.page_size, args.max_per_check)
+    print(json.dumps(summary, ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    main()
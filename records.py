@@ -0,0 +1,177 @@
+"""セッションに保持する問診・解析結果のコンパクトなレコード型。
+
+Supabase の行 dict をそのまま持たず、必要な列だけを __slots__ 付きの型に詰め、
+日時は取得時に一度だけパースしておく。
+"""
+
+from __future__ import annotations
+
+import datetime
+import hashlib
+import json
+
+
+def parse_timestamp(value: str) -> datetime.datetime:
+    """Supabase / URL の ISO 形式の日時文字列をパースする。"""
+    return datetime.datetime.fromisoformat(value)
+
+
+def calc_age(birth_date: datetime.date, on_date: datetime.date) -> int:
+    """on_date 時点の満年齢を返す。"""
+    return (
+        on_date.year - birth_date.year
+        - ((on_date.month, on_date.day) < (birth_date.month, birth_date.day))
+    )
+
+
+class HistoryEntry:
+    """過去履歴リンク一覧の1行。"""
+
+    __slots__ = ("timestamp", "captured_at")
+
+    def __init__(self, timestamp: str, captured_at: datetime.datetime):
+        self.timestamp = timestamp  # リンクに渡す T付きの元の文字列
+        self.captured_at = captured_at
+
+    @classmethod
+    def from_row(cls, row: dict) -> HistoryEntry:
+        return cls(row["timestamp"], parse_timestamp(row["timestamp"]))
+
+
+class QuestionnaireRecord:
+    """表示対象の問診1件。"""
+
+    __slots__ = (
+        "uuid", "bday", "gender", "height", "weight", "health",
+        "timestamp", "captured_at",
+    )
+
+    def __init__(self, uuid, bday, gender, height, weight, health, timestamp, captured_at):
+        self.uuid = uuid
+        self.bday = bday
+        self.gender = gender
+        self.height = height
+        self.weight = weight
+        self.health = health
+        self.timestamp = timestamp
+        self.captured_at = captured_at
+
+    @classmethod
+    def from_row(cls, row: dict) -> QuestionnaireRecord:
+        bday = row.get("bday")
+        return cls(
+            uuid=row.get("uuid"),
+            bday=datetime.date.fromisoformat(bday[:10]) if bday else None,
+            gender=row.get("gender"),
+            height=row.get("height"),
+            weight=row.get("weight"),
+            health=row.get("health"),
+            timestamp=row["timestamp"],
+            captured_at=parse_timestamp(row["timestamp"]),
+        )
+
+    @property
+    def real_age(self) -> int:
+        """撮影時年齢。"""
+        return calc_age(self.bday, self.captured_at.date())
+
+
+class ResultRecord:
+    """片眼分のAI解析結果。"""
+
+    __slots__ = (
+        "eye", "image_url", "fundus_age", "glaucoma_risk", "atherosclerosis_risk",
+        "captured_datetime", "captured_at",
+    )
+
+    def __init__(self, eye, image_url, fundus_age, glaucoma_risk, atherosclerosis_risk,
+                 captured_datetime, captured_at):
+        self.eye = eye
+        self.image_url = image_url
+        self.fundus_age = fundus_age
+        self.glaucoma_risk = glaucoma_risk
+        self.atherosclerosis_risk = atherosclerosis_risk
+        self.captured_datetime = captured_datetime
+        self.captured_at = captured_at
+
+    @classmethod
+    def from_row(cls, row: dict) -> ResultRecord:
+        captured = row.get("captured_datetime")
+        return cls(
+            eye=row.get("eye"),
+            image_url=row.get("image_url"),
+            fundus_age=row.get("fundus_age"),
+            glaucoma_risk=row.get("glaucoma_risk"),
+            atherosclerosis_risk=row.get("atherosclerosis_risk"),
+            captured_datetime=captured,
+            captured_at=parse_timestamp(captured) if captured else None,
+        )
+
+
+class VisitResults:
+    """1回の撮影の左右の解析結果。"""
+
+    __slots__ = ("right", "left")
+
+    def __init__(self, right: ResultRecord | None, left: ResultRecord | None):
+        self.right = right
+        self.left = left
+
+    @classmethod
+    def from_rows(cls, rows: list[dict]) -> VisitResults:
+        """results の行を右眼(R)と左眼(L)に振り分ける。"""
+        right = None
+        left = None
+        for row in rows:
+            if row.get("eye") == "R":
+                right = ResultRecord.from_row(row)
+            elif row.get("eye") == "L":
+                left = ResultRecord.from_row(row)
+        return cls(right, left)
+
+    def eyes(self) -> list[ResultRecord]:
+        """存在する眼の結果を右・左の順に返す。"""
+        return [r for r in (self.right, self.left) if r is not None]
+
+    def atherosclerosis_average(self) -> float | None:
+        """左右の血管健康リスクの平均。どちらもなければ None。"""
+        scores = [r.atherosclerosis_risk for r in self.eyes() if r.atherosclerosis_risk is not None]
+        if not scores:
+            return None
+        return sum(scores) / len(scores)
+
+
+def build_history_index(entries: list[HistoryEntry]) -> dict[datetime.datetime, HistoryEntry]:
+    """撮影日時をキーにした履歴の索引を作る。"""
+    return {entry.captured_at: entry for entry in entries}
+
+
+def visit_content_payload(questionnaire: QuestionnaireRecord, visit: VisitResults) -> dict:
+    """1回の撮影の表示内容を決める入力（内容ハッシュの計算用）。画像は URL ごとに不変とみなす。"""
+    return {
+        "questionnaire": {
+            "uuid": questionnaire.uuid,
+            "bday": str(questionnaire.bday),
+            "gender": questionnaire.gender,
+            "height": questionnaire.height,
+            "weight": questionnaire.weight,
+            "health": questionnaire.health,
+            "captured_at": questionnaire.captured_at.isoformat(),
+        },
+        "results": [
+            {
+                "eye": r.eye,
+                "image_url": r.image_url,
+                "fundus_age": r.fundus_age,
+                "glaucoma_risk": r.glaucoma_risk,
+                "atherosclerosis_risk": r.atherosclerosis_risk,
+            }
+            for r in visit.eyes()
+        ],
+    }
+
+
+def content_hash(payload: dict) -> str:
+    """dict を正規化した JSON の SHA-256。"""
+    canonical = json.dumps(payload, sort_keys=True, ensure_ascii=False, separators=(",", ":"))
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
@@ -0,0 +1,338 @@
+"""PDFレポート・バーコード・画像サムネイルの生成（Streamlit に依存しない）。"""
+
+from __future__ import annotations
+
+import io
+import mmap
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import barcode
+import requests
+from barcode.writer import ImageWriter
+from PIL import Image
+from reportlab.lib.pagesizes import A4
+from reportlab.lib.units import mm
+from reportlab.lib.utils import ImageReader
+from reportlab.pdfbase import pdfmetrics
+from reportlab.pdfbase.ttfonts import TTFont
+from reportlab.pdfgen import canvas
+
+from athero_percentiles import (
+    REFERENCE_DIGEST,
+    draw_athero_gauge_pdf,
+    evaluate_visit,
+    format_relative_comparison_plain_text,
+)
+import outbound
+from cache import get_cache
+from records import VisitResults, content_hash, visit_content_payload
+
+FONT_PATH = os.path.join(os.path.dirname(__file__), "fonts", "ipaexg.ttf")
+
+THUMBNAIL_SIZE = (300, 300)
+
+# PDF のレイアウトを変えたら上げる（内容ハッシュが変わり、保存済みの PDF は作り直される）
+REPORT_VERSION = 3
+
+PDF_TITLE = "健康チェック結果レポート"
+PDF_AUTHOR = "oculomics-poc-result-viewer"
+
+
+def register_fonts() -> None:
+    """PDF用の日本語フォントを登録する（登録済みなら何もしない）。"""
+    if "IPAexGothic" in pdfmetrics.getRegisteredFontNames():
+        return
+    if not os.path.exists(FONT_PATH):
+        raise FileNotFoundError(f"{FONT_PATH} が見つかりません")
+    pdfmetrics.registerFont(TTFont('IPAexGothic', FONT_PATH))
+
+
+def _render_barcode_png(code: str) -> bytes:
+    CODE128 = barcode.get_barcode_class('code128')
+    barcode_obj = CODE128(code, writer=ImageWriter())
+    buffer = io.BytesIO()
+    barcode_obj.write(buffer)
+    return buffer.getvalue()
+
+
+# バーコード生成関数
+def generate_barcode(code: str) -> Image.Image:
+    png = get_cache().namespace("barcodes").get_or_set(code, lambda: _render_barcode_png(code))
+    return Image.open(io.BytesIO(png))
+
+
+def fetch_image_bytes(url: str) -> bytes | None:
+    """画像のバイト列を取得する。期限切れ・失敗・ブレーカーが開いている場合は None。"""
+
+    def fetch(timeout: float) -> bytes:
+        response = requests.get(url, timeout=timeout)
+        response.raise_for_status()
+        return response.content
+
+    try:
+        return outbound.call(outbound.IMAGE_POLICY, outbound.host_of(url), fetch)
+    except (outbound.OutboundError, requests.RequestException):
+        # 404 などの呼び出し側の誤りは outbound が再試行せずにそのまま投げる
+        return None
+
+
+def download_image(url: str) -> Image.Image | None:
+    """画像を取得する。キャッシュ（images 名前空間）にあればダウンロードしない。
+
+    失敗した場合は None。
+    """
+    data = get_cache().namespace("images").get_or_set(url, lambda: fetch_image_bytes(url))
+    if data is None:
+        return None
+    try:
+        # mmap はファイルとして読めるので、コピーせずにそのまま開く
+        return Image.open(data if isinstance(data, mmap.mmap) else io.BytesIO(data))
+    except Exception:
+        return None
+
+
+def download_images(results) -> dict[str, Image.Image | None]:
+    """左右の画像を並行してダウンロードする。戻り値は 眼(R/L) -> 画像。"""
+    targets = [r for r in results if r is not None and r.image_url]
+    if not targets:
+        return {}
+    with ThreadPoolExecutor(max_workers=len(targets)) as executor:
+        images = executor.map(lambda r: download_image(r.image_url), targets)
+        return {r.eye: img for r, img in zip(targets, images)}
+
+
+def make_thumbnail(img: Image.Image, size: tuple[int, int] = THUMBNAIL_SIZE) -> bytes:
+    """画像を縮小して JPEG のバイト列にする。"""
+    thumb = img.convert("RGB")
+    thumb.thumbnail(size)
+    buffer = io.BytesIO()
+    thumb.save(buffer, format="JPEG", quality=80)
+    return buffer.getvalue()
+
+
+def report_etag(questionnaire, visit: VisitResults) -> str:
+    """PDF の内容ハッシュ（ETag）。入力だけから計算するので、描画せずに作り直しの要否を判定できる。
+
+    画像は URL ごとに不変とみなし、URL をハッシュに含める。
+    """
+    return content_hash({
+        "version": REPORT_VERSION,
+        "reference": REFERENCE_DIGEST,
+        **visit_content_payload(questionnaire, visit),
+    })
+
+
+def generate_pdf(questionnaire_data, right_eye_data, left_eye_data, real_age, images=None,
+                 peer_report=None):
+    """
+    問診と左右の眼の結果からPDFレポートを生成する関数（レイアウト＆バグ修正版）
+
+    images に取得済みの画像（眼 R/L -> Image）を渡すと、ダウンロードし直さずに使う。
+    peer_report に evaluate_visit の結果を渡すと、Web ページと同じ評価結果から描画する。
+    """
+    images = images or {}
+    if peer_report is None:
+        peer_report = evaluate_visit(
+            questionnaire_data.gender, real_age, VisitResults(right_eye_data, left_eye_data)
+        )
+
+    def peer_suffix(evaluation) -> str:
+        """左右別の指標の相対位置（参照データがある場合のみ）。"""
+        if evaluation is None or evaluation.percentile is None:
+            return ""
+        return f"（同年代・同性で{evaluation.relative_label}）"
+
+    def wrap_pdf_text(text: str, max_chars: int = 48) -> list[str]:
+        lines = []
+        remaining = text
+        while remaining:
+            if len(remaining) <= max_chars:
+                lines.append(remaining)
+                break
+            split_at = max(
+                remaining.rfind("。", 0, max_chars + 1),
+                remaining.rfind("、", 0, max_chars + 1),
+            )
+            if split_at <= 0:
+                split_at = max_chars
+            else:
+                split_at += 1
+            lines.append(remaining[:split_at])
+            remaining = remaining[split_at:].lstrip()
+        return lines
+
+    buffer = io.BytesIO()
+    # invariant=1 で作成日時と文書 ID を固定し、同じ入力からは同じバイト列を出力する
+    p = canvas.Canvas(buffer, pagesize=A4, invariant=1)
+    p.setTitle(PDF_TITLE)
+    p.setAuthor(PDF_AUTHOR)
+    p.setCreator(PDF_AUTHOR)
+    p.setSubject(f"report v{REPORT_VERSION}")
+    width, height = A4
+
+    # Y座標の初期位置
+    y_cursor = height - 20 * mm
+
+    # --- ヘッダー ---
+    p.setFont('IPAexGothic', 18)
+    p.drawString(20 * mm, y_cursor, "健康チェック結果レポート")
+    y_cursor -= 6 * mm
+    p.setFont('IPAexGothic', 9)
+    # 出力した日ではなく撮影日を載せる（出力日にすると同じレポートでも日ごとに内容が変わる）
+    p.drawString(150 * mm, y_cursor, f"撮影日: {questionnaire_data.captured_at.strftime('%Y-%m-%d')}")
+    p.line(20 * mm, y_cursor - 2 * mm, width - 20 * mm, y_cursor - 2 * mm)
+    y_cursor -= 5 * mm
+
+    # --- バーコード ---
+    uuid_value = questionnaire_data.uuid
+    if uuid_value:
+        p.drawString(20 * mm, y_cursor, f"受付番号: ")
+        y_cursor -= 21 * mm
+        try:
+            barcode_img = ImageReader(generate_barcode(uuid_value))
+            p.drawImage(barcode_img, 20 * mm, y_cursor, width=80*mm, height=18*mm)
+            y_cursor -= 5 * mm
+            p.setFont('IPAexGothic', 8)
+            p.drawString(20 * mm, y_cursor, "次回以降こちらの受付IDをご利用ください。問診などを省略出来て便利です。")
+        except Exception as e:
+            print(f"Barcode generation failed: {e}")
+    y_cursor -= 15 * mm
+
+    # --- 基本情報 ---
+    p.setFont('IPAexGothic', 12)
+    p.drawString(20 * mm, y_cursor, "■ 基本情報")
+    y_cursor -= 8 * mm
+    p.setFont('IPAexGothic', 10)
+    p.drawString(25 * mm, y_cursor, f"性別: {questionnaire_data.gender or '-'}")
+    p.drawString(70 * mm, y_cursor, f"誕生日: {questionnaire_data.bday or '-'}")
+    p.drawString(120 * mm, y_cursor, f"撮影時年齢: {real_age} 歳")
+    y_cursor -= 15 * mm
+
+    # --- 撮影画像 ---
+    p.setFont('IPAexGothic', 12)
+    p.drawString(20 * mm, y_cursor, "■ 撮影画像")
+    img_y_pos = y_cursor - 55 * mm # 画像描画用のY座標を確保
+
+    if right_eye_data and right_eye_data.image_url:
+        img = images.get("R") or download_image(right_eye_data.image_url)
+        if img:
+            p.drawImage(ImageReader(img), 30 * mm, img_y_pos, width=50*mm, height=50*mm, preserveAspectRatio=True, anchor='c')
+            p.drawCentredString(55 * mm, img_y_pos - 5*mm, "右眼")
+
+    if left_eye_data and left_eye_data.image_url:
+        img = images.get("L") or download_image(left_eye_data.image_url)
+        if img:
+            p.drawImage(ImageReader(img), 115 * mm, img_y_pos, width=50*mm, height=50*mm, preserveAspectRatio=True, anchor='c')
+            p.drawCentredString(140 * mm, img_y_pos - 5*mm, "左眼")
+    y_cursor -= 70 * mm # 画像とキャプションの分だけカーソルを下に移動
+
+    # --- AIによる健康評価 ---
+    # ★★★ このブロック全体がifの外にあることが重要 ★★★
+    p.setFont('IPAexGothic', 12)
+    p.drawString(20 * mm, y_cursor, "■ AIによる目の健康評価")
+    p.line(20 * mm, y_cursor - 2 * mm, width - 20 * mm, y_cursor - 2 * mm)
+    y_cursor -= 12 * mm
+
+    # 眼底年齢・視界の健康リスク（左右別）
+    # 表示する値は保存されている結果から取り、評価は同年代での位置の表示にだけ使う
+    per_eye_rows = (
+        ("眼底年齢", "fundus_age_delta", lambda result: f"{result.fundus_age:g} 歳"),
+        ("視界の健康リスク", "glaucoma_risk", lambda result: f"{result.glaucoma_risk:.2f}"),
+    )
+    eye_results = {"R": right_eye_data, "L": left_eye_data}
+    for title, metric, format_value in per_eye_rows:
+        p.setFont('IPAexGothic', 11)
+        p.drawString(25 * mm, y_cursor, title)
+        p.setFont('IPAexGothic', 10)
+        for x, eye, eye_label in ((70 * mm, "R", "右眼"), (120 * mm, "L", "左眼")):
+            evaluation = peer_report.get(metric, eye)
+            if evaluation is not None and eye_results[eye] is not None:
+                p.drawString(x, y_cursor, f"{eye_label}: {format_value(eye_results[eye])}")
+                suffix = peer_suffix(evaluation)
+                if suffix:
+                    p.setFont('IPAexGothic', 7)
+                    p.drawString(x, y_cursor - 4 * mm, suffix)
+                    p.setFont('IPAexGothic', 10)
+        y_cursor -= 12 * mm
+
+    # 血管健康リスク
+    athero = peer_report.get("atherosclerosis_risk")
+
+    p.setFont('IPAexGothic', 11)
+    p.drawString(25 * mm, y_cursor, "血管健康リスク")
+    p.setFont('IPAexGothic', 10)
+    if athero is not None:
+        p.drawString(70 * mm, y_cursor, f"左右平均: {athero.value:.2f}")
+    y_cursor -= 12 * mm
+
+    if athero is not None and athero.percentile is not None:
+        percentile = athero.percentile
+        peer_label = athero.peer_label
+        sample_size = athero.sample_size
+
+        if y_cursor < 70 * mm:
+            p.showPage()
+            y_cursor = height - 20 * mm
+
+        p.setFont('IPAexGothic', 10)
+        p.drawString(25 * mm, y_cursor, "同年代・同性との比較")
+        y_cursor -= 6 * mm
+        p.setFont('IPAexGothic', 8)
+        p.drawString(
+            25 * mm,
+            y_cursor,
+            "※ 上のスコア（絶対評価）とは別の指標です。",
+        )
+        y_cursor -= 5 * mm
+        p.drawString(
+            25 * mm,
+            y_cursor,
+            "絶対的なリスクが低くても、同年代・同性の中での位置は異なる場合があります。",
+        )
+        y_cursor -= 8 * mm
+
+        bar_height = 8 * mm
+        bar_width = 130 * mm
+        bar_x = 25 * mm
+        bar_y = y_cursor - bar_height
+        draw_athero_gauge_pdf(
+            p, bar_x, bar_y, bar_width, bar_height, percentile
+        )
+        y_cursor = bar_y - 10 * mm
+
+        p.setFont('IPAexGothic', 9)
+        comparison_text = format_relative_comparison_plain_text(
+            peer_label, percentile
+        )
+        for line in wrap_pdf_text(comparison_text):
+            if y_cursor < 40 * mm:
+                p.showPage()
+                y_cursor = height - 20 * mm
+            p.drawString(25 * mm, y_cursor, line)
+            y_cursor -= 5 * mm
+
+        p.setFont('IPAexGothic', 8)
+        p.drawString(
+            25 * mm,
+            y_cursor,
+            f"（同グループの参考データ: n={sample_size}件）",
+        )
+        y_cursor -= 5 * mm
+        if sample_size < 30:
+            p.drawString(
+                25 * mm,
+                y_cursor,
+                "※ 参考データの件数が少ないため、相対位置は参考値としてご覧ください。",
+            )
+            y_cursor -= 5 * mm
+
+    # --- フッター / 注意事項 ---
+    p.setFont('IPAexGothic', 9)
+    disclaimer = "この結果はAIによる健康リスク推定です。診断ではありません。気になる点がある場合は、医療機関にご相談ください。"
+    p.drawString(20 * mm, 30 * mm, disclaimer)
+    p.line(20 * mm, 28 * mm, width - 20 * mm, 28 * mm)
+
+    p.save()
+    buffer.seek(0)
+    return buffer.getvalue()
@@ -0,0 +1,520 @@
+"""生成したレポート PDF をすべて保管する、追記専用のパックファイル方式のアーカイブ。
+
+    archive = get_archive()
+    archive.put(uuid, captured_at, etag, pdf_bytes)
+    pdf_bytes = archive.get(uuid, captured_at, etag)
+
+    python report_archive.py verify
+    python report_archive.py compact [--force]
+
+保管期間の要件のため、generate_pdf が作った PDF は内容ハッシュ（report.report_etag）ごとに
+すべて残す。小さなファイルを大量に置くと一覧・バックアップ・取得が遅くなるので、
+本体は大きなパックファイル（packs/pack-NNNNNN.dat）に追記し、
+(uuid, 撮影日時, 内容ハッシュ) → (パック, オフセット, 長さ) の固定長の索引を持つ。
+
+- index.dat: キーでソートした固定長エントリ。mmap して二分探索する（O(log n)）
+- index.log: index.dat に未統合のエントリ（追記のみ）。一定数たまったら index.dat に統合する
+- パック内のレコードはヘッダー（マジック・長さ・CRC32）とキーを持つので、
+  verify で索引と本体を照合でき、索引が壊れても rebuild_index でパックから作り直せる
+- compact は索引から参照されているレコードだけを新しいパックにキー順で詰め直し、
+  古いパック（書き込み途中で落ちた残骸を含む）を消す。索引にないレコードや途中で切れた末尾が
+  あれば、先に rebuild_index で拾えるよう、force を指定しない限り何もせずに ArchiveIntegrityError にする
+
+書き込みはプロセス間で flock により排他する。読み出しはロックを取らない
+（index.dat は置き換え、index.log とパックは追記のみなので、読み出し中に壊れた値は見えない）。
+"""
+
+from __future__ import annotations
+
+import argparse
+import contextlib
+import datetime
+import fcntl
+import json
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import zlib
+from typing import Callable, Iterator
+
+from report_store import visit_key
+
+REPORT_ARCHIVE_DIR = os.environ.get(
+    "REPORT_ARCHIVE_DIR", os.path.join(os.path.dirname(__file__), ".archive")
+)
+# パック1つの大きさの上限（超えたら次のパックに書く）
+PACK_MAX_BYTES = int(os.environ.get("REPORT_ARCHIVE_PACK_BYTES", 1024 ** 3))
+# index.log のエントリがこの数を超えたら index.dat に統合する
+MERGE_THRESHOLD = 4096
+
+PACK_MAGIC = b"RPK1"
+# uuid, 撮影日時（visit_key）, 内容ハッシュ（SHA-256）。バイト列の順序がそのまま索引の順序になる
+KEY = struct.Struct("<36s22s32s")
+# パック内のレコード: マジック, 本体の長さ, 本体の CRC32, キー（続けて本体）
+RECORD_HEADER = struct.Struct(f"<4sII{KEY.size}s")
+# 索引のエントリ: キー, パック番号, レコードのオフセット, 本体の長さ, 本体の CRC32
+INDEX_ENTRY = struct.Struct(f"<{KEY.size}sIQII")
+
+
+def pack_key(uuid: str, captured_at: datetime.datetime, content_hash: str) -> bytes:
+    """索引とパックで使う固定長のキー。"""
+    uuid_bytes = uuid.encode("ascii")
+    if len(uuid_bytes) > 36:
+        raise ValueError(f"uuid が長すぎます: {uuid!r}")
+    return KEY.pack(uuid_bytes, visit_key(captured_at).encode("ascii"), bytes.fromhex(content_hash))
+
+
+class ArchiveIntegrityError(Exception):
+    """パックに索引から外れたレコードがあり、compact で消えてしまう。report は verify の結果。"""
+
+    def __init__(self, message: str, report: dict):
+        super().__init__(message)
+        self.report = report
+
+
+class ArchiveEntry:
+    """索引の1エントリ。"""
+
+    __slots__ = ("key", "pack", "offset", "length", "crc")
+
+    def __init__(self, key: bytes, pack: int, offset: int, length: int, crc: int):
+        self.key = key
+        self.pack = pack
+        self.offset = offset
+        self.length = length
+        self.crc = crc
+
+    @classmethod
+    def unpack(cls, data, offset: int = 0) -> ArchiveEntry:
+        return cls(*INDEX_ENTRY.unpack_from(data, offset))
+
+    def pack_entry(self) -> bytes:
+        return INDEX_ENTRY.pack(self.key, self.pack, self.offset, self.length, self.crc)
+
+    @property
+    def uuid(self) -> str:
+        return KEY.unpack(self.key)[0].rstrip(b"\0").decode("ascii")
+
+    @property
+    def visit(self) -> str:
+        return KEY.unpack(self.key)[1].decode("ascii")
+
+    @property
+    def content_hash(self) -> str:
+        return KEY.unpack(self.key)[2].hex()
+
+    def to_dict(self) -> dict:
+        return {
+            "uuid": self.uuid, "visit": self.visit, "content_hash": self.content_hash,
+            "pack": self.pack, "offset": self.offset, "length": self.length,
+        }
+
+
+class ReportArchive:
+    """パックファイルと固定長索引によるレポートのアーカイブ。"""
+
+    def __init__(self, root: str = REPORT_ARCHIVE_DIR, pack_max_bytes: int = PACK_MAX_BYTES):
+        self.root = root
+        self.pack_max_bytes = pack_max_bytes
+        os.makedirs(os.path.join(root, "packs"), exist_ok=True)
+        self._lock = threading.RLock()
+        self._lock_file = open(os.path.join(root, "archive.lock"), "a+b")
+        # index.dat の mmap と、それを開いたときのファイルの識別子（他プロセスの統合を検知する）
+        self._index_map: mmap.mmap | bytes = b""
+        self._index_id: tuple[int, int, int] | None = None
+        # index.log から読み込んだ未統合のエントリと、読み込んだ位置
+        self._pending: dict[bytes, ArchiveEntry] = {}
+        self._log_position = 0
+        self._pack_maps: dict[int, mmap.mmap] = {}
+
+    # --- パス ---
+
+    @property
+    def index_path(self) -> str:
+        return os.path.join(self.root, "index.dat")
+
+    @property
+    def log_path(self) -> str:
+        return os.path.join(self.root, "index.log")
+
+    def pack_path(self, pack: int) -> str:
+        return os.path.join(self.root, "packs", f"pack-{pack:06d}.dat")
+
+    def pack_numbers(self) -> list[int]:
+        return sorted(
+            int(name[5:11]) for name in os.listdir(os.path.join(self.root, "packs"))
+            if name.startswith("pack-") and name.endswith(".dat")
+        )
+
+    # --- 索引の読み込み ---
+
+    def _refresh(self) -> None:
+        """他プロセスが index.dat を置き換えたり index.log に追記したりしていれば読み直す。"""
+        try:
+            stat = os.stat(self.index_path)
+            # 置き換え後に同じ inode・同じ大きさになることもあるので、更新時刻でも見分ける
+            index_id = (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+        except FileNotFoundError:
+            index_id = None
+        if index_id != self._index_id:
+            if isinstance(self._index_map, mmap.mmap):
+                self._index_map.close()
+            self._index_map = b""
+            if index_id is not None and index_id[1]:
+                with open(self.index_path, "rb") as f:
+                    self._index_map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self._index_id = index_id
+            # compact で消えたパックと番号が重ならないよう、パックの mmap も開き直す
+            for pack_map in self._pack_maps.values():
+                pack_map.close()
+            self._pack_maps = {}
+            # 統合されたエントリは index.log から消えているので読み直す
+            self._pending = {}
+            self._log_position = 0
+
+        try:
+            log_size = os.path.getsize(self.log_path)
+        except FileNotFoundError:
+            log_size = 0
+        if log_size < self._log_position:
+            self._pending = {}
+            self._log_position = 0
+        # 書き込み途中の末尾は読まない（エントリ単位でのみ進める）
+        usable = (log_size - self._log_position) // INDEX_ENTRY.size * INDEX_ENTRY.size
+        if usable:
+            with open(self.log_path, "rb") as f:
+                f.seek(self._log_position)
+                data = f.read(usable)
+            for offset in range(0, len(data), INDEX_ENTRY.size):
+                entry = ArchiveEntry.unpack(data, offset)
+                self._pending[entry.key] = entry
+            self._log_position += usable
+
+    def _index_count(self) -> int:
+        return len(self._index_map) // INDEX_ENTRY.size
+
+    def _lower_bound(self, prefix: bytes) -> int:
+        """index.dat で、キーが prefix 以上になる最初の位置（二分探索）。"""
+        lo, hi = 0, self._index_count()
+        width = len(prefix)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            start = mid * INDEX_ENTRY.size
+            if self._index_map[start:start + width] < prefix:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def _find(self, key: bytes) -> ArchiveEntry | None:
+        entry = self._pending.get(key)
+        if entry is not None:
+            return entry
+        position = self._lower_bound(key)
+        if position < self._index_count():
+            entry = ArchiveEntry.unpack(self._index_map, position * INDEX_ENTRY.size)
+            if entry.key == key:
+                return entry
+        return None
+
+    def _iter_index(self) -> Iterator[ArchiveEntry]:
+        for position in range(self._index_count()):
+            yield ArchiveEntry.unpack(self._index_map, position * INDEX_ENTRY.size)
+
+    def entries(self) -> list[ArchiveEntry]:
+        """索引の全エントリ（キー順）。"""
+        with self._lock:
+            self._refresh()
+            merged = {entry.key: entry for entry in self._iter_index()}
+            merged.update(self._pending)
+            return [merged[key] for key in sorted(merged)]
+
+    # --- 読み出し ---
+
+    def _pack_map(self, pack: int, end: int) -> mmap.mmap:
+        """パックの mmap（end までが見えていなければ開き直す）。"""
+        pack_map = self._pack_maps.get(pack)
+        if pack_map is None or len(pack_map) < end:
+            if pack_map is not None:
+                pack_map.close()
+            with open(self.pack_path(pack), "rb") as f:
+                pack_map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self._pack_maps[pack] = pack_map
+        return pack_map
+
+    def _read_record(self, entry: ArchiveEntry) -> bytes:
+        """エントリが指すレコードの本体。ヘッダーが索引と一致しなければ ValueError。"""
+        data_start = entry.offset + RECORD_HEADER.size
+        pack_map = self._pack_map(entry.pack, data_start + entry.length)
+        magic, length, crc, key = RECORD_HEADER.unpack_from(pack_map, entry.offset)
+        if magic != PACK_MAGIC or length != entry.length or crc != entry.crc or key != entry.key:
+            raise ValueError(f"pack {entry.pack} offset {entry.offset} のレコードが索引と一致しません")
+        return pack_map[data_start:data_start + entry.length]
+
+    def get(self, uuid: str, captured_at: datetime.datetime, content_hash: str) -> bytes | None:
+        """保管した PDF を返す。なければ None。"""
+        key = pack_key(uuid, captured_at, content_hash)
+        with self._lock:
+            self._refresh()
+            entry = self._find(key)
+            if entry is None:
+                return None
+            try:
+                return self._read_record(entry)
+            except FileNotFoundError:
+                # compact でパックが置き換わった直後。索引を読み直してもう一度だけ試す
+                self._index_id = None
+                self._refresh()
+                entry = self._find(key)
+                return self._read_record(entry) if entry is not None else None
+
+    # --- 書き込み ---
+
+    @contextlib.contextmanager
+    def _exclusive(self) -> Iterator[None]:
+        """プロセス間・スレッド間で排他する書き込み区間。"""
+        with self._lock:
+            fcntl.flock(self._lock_file.fileno(), fcntl.LOCK_EX)
+            try:
+                self._refresh()
+                yield
+            finally:
+                fcntl.flock(self._lock_file.fileno(), fcntl.LOCK_UN)
+
+    def put(self, uuid: str, captured_at: datetime.datetime, content_hash: str, data: bytes) -> ArchiveEntry:
+        """PDF を保管する。同じキー（同じ内容）が保管済みなら何もしない。"""
+        key = pack_key(uuid, captured_at, content_hash)
+        data = bytes(data)
+        with self._exclusive():
+            existing = self._find(key)
+            if existing is not None:
+                return existing
+            packs = self.pack_numbers()
+            entry = self._append_record(self._target_pack(packs[-1] if packs else 1, len(data)), key, data)
+            # 本体を書いてから索引に載せる（索引が指す先は常に書き終わっている）
+            with open(self.log_path, "ab") as f:
+                f.write(entry.pack_entry())
+                f.flush()
+                os.fsync(f.fileno())
+            self._refresh()
+            if len(self._pending) >= MERGE_THRESHOLD:
+                self._merge_locked()
+            return entry
+
+    def _target_pack(self, pack: int, length: int) -> int:
+        """length バイトの本体を書くパック（pack が上限を超えるなら次の番号）。"""
+        try:
+            size = os.path.getsize(self.pack_path(pack))
+        except FileNotFoundError:
+            return pack
+        return pack + 1 if size and size + RECORD_HEADER.size + length > self.pack_max_bytes else pack
+
+    def _append_record(self, pack: int, key: bytes, data: bytes) -> ArchiveEntry:
+        crc = zlib.crc32(data)
+        with open(self.pack_path(pack), "ab") as f:
+            offset = f.tell()
+            f.write(RECORD_HEADER.pack(PACK_MAGIC, len(data), crc, key))
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        return ArchiveEntry(key, pack, offset, len(data), crc)
+
+    def _write_index_locked(self, entries: list[ArchiveEntry]) -> None:
+        """キー順のエントリで index.dat を置き換え、index.log を空にする。"""
+        fd, tmp_path = tempfile.mkstemp(dir=self.root, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                for entry in entries:
+                    f.write(entry.pack_entry())
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.index_path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            raise
+        # 置き換えの後で落ちても、index.log の重複は読み込み時に同じキーとしてまとまる
+        with open(self.log_path, "wb"):
+            pass
+        self._index_id = None
+        self._refresh()
+
+    def _merge_locked(self) -> None:
+        merged = {entry.key: entry for entry in self._iter_index()}
+        merged.update(self._pending)
+        self._write_index_locked([merged[key] for key in sorted(merged)])
+
+    def merge(self) -> None:
+        """index.log のエントリを index.dat に統合する。"""
+        with self._exclusive():
+            self._merge_locked()
+
+    # --- 保守 ---
+
+    def _scan_pack(self, pack: int) -> Iterator[tuple[ArchiveEntry | None, int]]:
+        """パックのレコードを先頭から読む。(エントリ, オフセット) を返し、
+        壊れた・書き込み途中のレコードに当たったら (None, そのオフセット) を返して終わる。"""
+        with open(self.pack_path(pack), "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            if not size:
+                return
+            pack_map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            offset = 0
+            while offset < size:
+                if offset + RECORD_HEADER.size > size:
+                    yield None, offset
+                    return
+                magic, length, crc, key = RECORD_HEADER.unpack_from(pack_map, offset)
+                data_start = offset + RECORD_HEADER.size
+                if magic != PACK_MAGIC or data_start + length > size or \
+                        zlib.crc32(pack_map[data_start:data_start + length]) != crc:
+                    yield None, offset
+                    return
+                yield ArchiveEntry(key, pack, offset, length, crc), offset
+                offset = data_start + length
+        finally:
+            pack_map.close()
+
+    def verify(self) -> dict:
+        """索引の全エントリの本体（ヘッダーと CRC32）と、索引にないレコードを確認する。"""
+        entries = self.entries()
+        report = {"entries": len(entries), "ok": 0, "corrupt": [], "missing_pack": [],
+                  "unindexed_records": 0, "torn_tails": []}
+        indexed = set()
+        for entry in entries:
+            indexed.add((entry.pack, entry.offset))
+            try:
+                data = self._read_record(entry)
+            except FileNotFoundError:
+                report["missing_pack"].append(entry.to_dict())
+                continue
+            except (ValueError, struct.error):
+                report["corrupt"].append(entry.to_dict())
+                continue
+            if zlib.crc32(data) != entry.crc:
+                report["corrupt"].append(entry.to_dict())
+            else:
+                report["ok"] += 1
+        for pack in self.pack_numbers():
+            for scanned, offset in self._scan_pack(pack):
+                if scanned is None:
+                    report["torn_tails"].append({"pack": pack, "offset": offset})
+                elif (pack, offset) not in indexed:
+                    report["unindexed_records"] += 1
+        return report
+
+    def rebuild_index(self) -> int:
+        """パックを走査して索引を作り直す（索引が失われた・壊れたとき用）。エントリ数を返す。"""
+        with self._exclusive():
+            rebuilt: dict[bytes, ArchiveEntry] = {}
+            for pack in self.pack_numbers():
+                for scanned, _offset in self._scan_pack(pack):
+                    if scanned is not None:
+                        rebuilt.setdefault(scanned.key, scanned)
+            self._write_index_locked([rebuilt[key] for key in sorted(rebuilt)])
+            return len(rebuilt)
+
+    def compact(self, keep: Callable[[ArchiveEntry], bool] | None = None, force: bool = False) -> dict:
+        """索引が参照するレコードを新しいパックにキー順で詰め直し、古いパックを消す。
+
+        keep を渡すと、keep(entry) が False のエントリ（保管期間を過ぎたものなど）を落とす。
+        CRC が合わないレコードは詰め直さず、結果の corrupt に記録する。
+        verify で索引にないレコードか途中で切れた末尾が見つかったら、force でない限り
+        ArchiveIntegrityError にする（rebuild_index で索引に戻せるレコードまで消さないため）。
+        """
+        with self._exclusive():
+            self._merge_locked()
+            report = self.verify()
+            if not force and (report["unindexed_records"] or report["torn_tails"]):
+                raise ArchiveIntegrityError(
+                    f"索引にないレコード {report['unindexed_records']} 件・途中で切れた末尾 "
+                    f"{len(report['torn_tails'])} 件があります。rebuild-index で確認するか --force で実行してください",
+                    report,
+                )
+            old_packs = self.pack_numbers()
+            pack = (old_packs[-1] + 1) if old_packs else 1
+            new_packs = set()
+            kept, dropped, corrupt = [], 0, []
+            for entry in list(self._iter_index()):
+                if keep is not None and not keep(entry):
+                    dropped += 1
+                    continue
+                try:
+                    data = self._read_record(entry)
+                except (FileNotFoundError, ValueError, struct.error):
+                    corrupt.append(entry.to_dict())
+                    continue
+                if zlib.crc32(data) != entry.crc:
+                    corrupt.append(entry.to_dict())
+                    continue
+                pack = self._target_pack(pack, len(data))
+                new_packs.add(pack)
+                kept.append(self._append_record(pack, entry.key, data))
+            self._write_index_locked(kept)
+
+            bytes_before = sum(os.path.getsize(self.pack_path(old)) for old in old_packs)
+            for old in old_packs:
+                os.unlink(self.pack_path(old))
+            bytes_after = sum(os.path.getsize(self.pack_path(new)) for new in new_packs)
+            return {"entries": len(kept), "dropped": dropped, "corrupt": corrupt,
+                    "bytes_before": bytes_before, "bytes_after": bytes_after}
+
+    def stats(self) -> dict:
+        with self._lock:
+            self._refresh()
+            packs = self.pack_numbers()
+            return {
+                "indexed": self._index_count(),
+                "pending": len(self._pending),
+                "packs": len(packs),
+                "pack_bytes": sum(os.path.getsize(self.pack_path(pack)) for pack in packs),
+            }
+
+
+_default_archive: ReportArchive | None = None
+_default_lock = threading.Lock()
+
+
+def get_archive() -> ReportArchive:
+    """プロセス内で共有するアーカイブ。"""
+    global _default_archive
+    with _default_lock:
+        if _default_archive is None:
+            _default_archive = ReportArchive()
+        return _default_archive
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("command", choices=("stats", "verify", "compact", "merge", "rebuild-index"))
+    parser.add_argument("--root", default=REPORT_ARCHIVE_DIR)
+    parser.add_argument("--force", action="store_true",
+                        help="compact: 索引にないレコード・途中で切れた末尾があっても詰め直す")
+    args = parser.parse_args()
+
+    archive = ReportArchive(args.root)
+    if args.command == "stats":
+        result = archive.stats()
+    elif args.command == "verify":
+        result = archive.verify()
+    elif args.command == "compact":
+        try:
+            result = archive.compact(force=args.force)
+        except ArchiveIntegrityError as e:
+            print(json.dumps(e.report, ensure_ascii=False, indent=2))
+            raise SystemExit(str(e))
+    elif args.command == "merge":
+        archive.merge()
+        result = archive.stats()
+    else:
+        result = {"entries": archive.rebuild_index()}
+    print(json.dumps(result, ensure_ascii=False, indent=2))
+    if args.command == "verify" and (result["corrupt"] or result["missing_pack"]):
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,46 @@
+"""事前生成したレポート成果物（PDF・サムネイル）の保存先。
+
+ワーカーが書き込み、結果ページが読み出す。キーは (uuid, 撮影日時)。
+PDF はさらに内容ハッシュ（report.report_etag）ごとに保存するので、問診・結果・参照データが
+変わった撮影では古い PDF は読まれず、変わっていなければ描画を省ける。
+実体はキャッシュの reports 名前空間（既定ではホスト内で共有するディスクキャッシュ）で、
+期限切れや容量超過で消えた場合は呼び出し側で再生成する。
+"""
+
+from __future__ import annotations
+
+import datetime
+
+from cache import NamespacedCache, get_cache
+
+
+def visit_key(captured_at: datetime.datetime) -> str:
+    """撮影日時をキーに使える UTC 表記にする。"""
+    if captured_at.tzinfo is not None:
+        captured_at = captured_at.astimezone(datetime.timezone.utc)
+    return captured_at.strftime("%Y%m%dT%H%M%S%fZ")
+
+
+class ReportStore:
+    """(uuid, 撮影日時) ごとの成果物をキャッシュに保存する。
+
+    get_pdf / get_thumbnail はバックエンドの値（ディスクなら mmap）をそのまま返す。
+    """
+
+    def __init__(self, cache: NamespacedCache | None = None):
+        self.cache = cache or get_cache().namespace("reports")
+
+    def _key(self, uuid: str, captured_at: datetime.datetime, name: str) -> str:
+        return f"{uuid}:{visit_key(captured_at)}:{name}"
+
+    def get_pdf(self, uuid: str, captured_at: datetime.datetime, etag: str) -> bytes | None:
+        return self.cache.get(self._key(uuid, captured_at, f"report-{etag}.pdf"))
+
+    def put_pdf(self, uuid: str, captured_at: datetime.datetime, etag: str, data: bytes) -> None:
+        self.cache.set(self._key(uuid, captured_at, f"report-{etag}.pdf"), data)
+
+    def get_thumbnail(self, uuid: str, captured_at: datetime.datetime, eye: str) -> bytes | None:
+        return self.cache.get(self._key(uuid, captured_at, f"thumb_{eye}.jpg"))
+
+    def put_thumbnail(self, uuid: str, captured_at: datetime.datetime, eye: str, data: bytes) -> None:
+        self.cache.set(self._key(uuid, captured_at, f"thumb_{eye}.jpg"), data)
@@ -0,0 +1,155 @@
+"""Redis プロトコル（RESP2）のローカル代替サーバー（開発・テスト用）。
+
+cache.RespBackend が使うコマンド（PING / GET / SET [EX|PX] / INCR / PEXPIRE / DEL /
+SELECT / FLUSHDB / DBSIZE）だけをメモリ上で実装する。本番では Redis を使う。
+
+    python resp_server.py --port 6380
+"""
+
+from __future__ import annotations
+
+import argparse
+import socketserver
+import threading
+import time
+
+
+class RespStore:
+    """db 番号ごとの key -> (value, expires_at) を持つ。"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.dbs: dict[int, dict[bytes, tuple[bytes, float | None]]] = {}
+
+    def db(self, index: int) -> dict[bytes, tuple[bytes, float | None]]:
+        return self.dbs.setdefault(index, {})
+
+
+def _encode(reply) -> bytes:
+    if reply is None:
+        return b"$-1\r\n"
+    if isinstance(reply, Exception):
+        return f"-ERR {reply}\r\n".encode()
+    if isinstance(reply, str):
+        return f"+{reply}\r\n".encode()
+    if isinstance(reply, int):
+        return f":{reply}\r\n".encode()
+    return b"$%d\r\n%s\r\n" % (len(reply), reply)
+
+
+class RespHandler(socketserver.StreamRequestHandler):
+    def setup(self) -> None:
+        super().setup()
+        self.db_index = 0
+
+    def _read_command(self) -> list[bytes] | None:
+        line = self.rfile.readline()
+        if not line:
+            return None
+        if not line.startswith(b"*"):
+            # インライン形式（telnet などから）
+            return line.strip().split()
+        args = []
+        for _ in range(int(line[1:-2])):
+            length = int(self.rfile.readline()[1:-2])
+            args.append(self.rfile.read(length + 2)[:-2])
+        return args
+
+    def handle(self) -> None:
+        while True:
+            args = self._read_command()
+            if args is None:
+                return
+            if not args:
+                continue
+            try:
+                reply = self._execute(args[0].upper(), args[1:])
+            except Exception as e:
+                reply = e
+            self.wfile.write(_encode(reply))
+
+    def _execute(self, command: bytes, args: list[bytes]):
+        store: RespStore = self.server.store
+        with store.lock:
+            db = store.db(self.db_index)
+            if command == b"PING":
+                return "PONG"
+            if command == b"SELECT":
+                self.db_index = int(args[0])
+                return "OK"
+            if command == b"GET":
+                item = db.get(args[0])
+                if item is None:
+                    return None
+                value, expires_at = item
+                if expires_at is not None and expires_at <= time.monotonic():
+                    del db[args[0]]
+                    return None
+                return value
+            if command == b"SET":
+                expires_at = None
+                options = [a.upper() for a in args[2:]]
+                if b"EX" in options:
+                    expires_at = time.monotonic() + int(args[2 + options.index(b"EX") + 1])
+                if b"PX" in options:
+                    expires_at = time.monotonic() + int(args[2 + options.index(b"PX") + 1]) / 1000
+                db[args[0]] = (args[1], expires_at)
+                return "OK"
+            if command == b"INCR":
+                item = db.get(args[0])
+                if item is not None and item[1] is not None and item[1] <= time.monotonic():
+                    item = None
+                value, expires_at = item if item is not None else (b"0", None)
+                try:
+                    number = int(value) + 1
+                except ValueError:
+                    raise ValueError("value is not an integer or out of range") from None
+                db[args[0]] = (str(number).encode(), expires_at)
+                return number
+            if command == b"PEXPIRE":
+                item = db.get(args[0])
+                if item is None or (item[1] is not None and item[1] <= time.monotonic()):
+                    return 0
+                db[args[0]] = (item[0], time.monotonic() + int(args[1]) / 1000)
+                return 1
+            if command == b"DEL":
+                return sum(1 for key in args if db.pop(key, None) is not None)
+            if command == b"FLUSHDB":
+                db.clear()
+                return "OK"
+            if command == b"DBSIZE":
+                return len(db)
+        raise ValueError(f"unknown command '{command.decode(errors='replace')}'")
+
+
+class RespServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address: tuple[str, int] = ("127.0.0.1", 0)):
+        super().__init__(address, RespHandler)
+        self.store = RespStore()
+
+    @property
+    def port(self) -> int:
+        return self.server_address[1]
+
+    def start_background(self) -> threading.Thread:
+        """別スレッドで待ち受けを始める（テスト用）。"""
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+        return thread
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Redis プロトコルのローカル代替サーバー")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=6379)
+    args = parser.parse_args()
+    with RespServer((args.host, args.port)) as server:
+        print(f"listening on {args.host}:{server.port}")
+        server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
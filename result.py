@@ -1,29 +1,58 @@
-import io
-import os
 import datetime
-import barcode
-from barcode.writer import ImageWriter
-from PIL import Image
-from reportlab.pdfgen import canvas
-from reportlab.lib.pagesizes import A4
-from reportlab.lib.units import mm
-from reportlab.lib.utils import ImageReader
+import logging
 import streamlit as st
+from streamlit.runtime.scriptrunner import get_script_run_ctx
 from supabase import create_client
-from reportlab.pdfbase import pdfmetrics
-from reportlab.pdfbase.ttfonts import TTFont
-import requests
-from io import BytesIO
 from athero_percentiles import (
     build_athero_gauge_figure,
-    draw_athero_gauge_pdf,
-    format_peer_group_label,
+    evaluate_visit,
     format_relative_comparison_message,
-    format_relative_comparison_plain_text,
-    get_age_group,
-    lookup_percentiles,
-    score_to_percentile,
 )
+from cache import get_cache
+from history import (
+    fetch_history_page,
+    fetch_questionnaire,
+    fetch_visit_results,
+    probe_latest_timestamp,
+)
+from login_guard import get_login_guard
+from outbound import DB_WRITE_POLICY, OutboundError, execute_query, get_caller
+from profiling import RerunProfiler, profiling_requested
+from records import build_history_index, parse_timestamp
+from report import download_images, generate_pdf, register_fonts, report_etag
+from report_archive import get_archive
+from report_store import ReportStore
+from result_watch import RESULT_WATCH_INTERVAL, SupabaseResultSource, get_result_watcher
+from session_memory import get_registry
+from staff_auth import is_staff, staff_sidebar_login
+
+logger = logging.getLogger(__name__)
+
+# --- 実行ごとのプロファイル（環境変数 VIEWER_PROFILE=1、または ?profile=1 でスタッフキーを入力したセッション） ---
+if st.query_params.get("profile") == "1" and not is_staff():
+    staff_sidebar_login("計測を始める")
+if profiling_requested(st.query_params, is_staff()):
+    # 実行中の計測結果はまだ揃っていないので、サイドバーには前回の実行の結果を出す
+    previous_profiler = st.session_state.get("rerun_profiler")
+    st.session_state.rerun_profiler = RerunProfiler.start(__file__)
+    st.sidebar.markdown("### ⏱ 前回の実行のプロファイル")
+    if previous_profiler and previous_profiler.finished.is_set():
+        st.sidebar.caption(
+            f"{previous_profiler.duration * 1000:.0f} ms / {previous_profiler.sample_count} サンプル"
+        )
+        st.sidebar.dataframe(previous_profiler.top(10), hide_index=True)
+        for path in previous_profiler.output_paths:
+            st.sidebar.caption(path)
+    else:
+        st.sidebar.caption("次の実行から表示されます。")
+    st.sidebar.markdown("### キャッシュ")
+    st.sidebar.json(get_cache().stats(), expanded=False)
+    st.sidebar.markdown("### 外部呼び出し（ヘッジ・ブレーカー）")
+    st.sidebar.json(get_caller().metrics(), expanded=False)
+    st.sidebar.markdown("### 本人確認の制限")
+    st.sidebar.json(get_login_guard().metrics(), expanded=False)
+    st.sidebar.markdown("### セッションのメモリ")
+    st.sidebar.json(get_registry().metrics(), expanded=False)
 
 # --- Supabase 設定 ---
 SUPABASE_URL = st.secrets["SUPABASE_URL"]
@@ -37,19 +66,35 @@ if 'feedback_submitted_success' not in st.session_state:
     st.session_state.feedback_submitted_success = False
 if 'uuid_value' not in st.session_state:
     st.session_state.uuid_value = ""
-if 'questionnaire_data' not in st.session_state:
-    st.session_state.questionnaire_data = None
 if 'all_history' not in st.session_state:
     st.session_state.all_history = None
+if 'history_index' not in st.session_state:
+    st.session_state.history_index = {}  # 撮影日時 -> HistoryEntry
+if 'history_has_more' not in st.session_state:
+    st.session_state.history_has_more = False
+if 'auth_bday' not in st.session_state:
+    st.session_state.auth_bday = None
 if 'target_timestamp' not in st.session_state:
     st.session_state.target_timestamp = None
+if 'feedback_status' not in st.session_state:
+    st.session_state.feedback_status = {}  # uuid -> 回答済みか
+
+
+# 問診・解析結果・デコード済み画像は session_state に置かず、プロセス全体の上限つきの
+# セッション別の領域に置く（操作の古いセッションから追い出され、戻ってきたら作り直す）
+session_id = get_script_run_ctx().session_id
+heavy_state = get_registry().session(session_id)
+# session_state に残す状態（履歴の一覧など）はサイズの計測だけ行う
+get_registry().measure_light_state(session_id, st.session_state.to_dict())
 
 
 # フォント登録
-FONT_PATH = os.path.join(os.path.dirname(__file__), "fonts", "ipaexg.ttf")
-if not os.path.exists(FONT_PATH):
-    raise FileNotFoundError(f"{FONT_PATH} が見つかりません")
-pdfmetrics.registerFont(TTFont('IPAexGothic', FONT_PATH))
+register_fonts()
+
+# 事前生成ワーカー（prerender.py）と共有するレポート成果物の保存先
+report_store = ReportStore()
+# Supabase の行のキャッシュ（再実行で問い合わせを減らす。個人情報を含むのでプロセス内にだけ置く）
+row_cache = get_cache().namespace("rows")
 
 # --- タイトル ---
 st.title("健康チェック結果ページ 🩺")
@@ -82,14 +127,13 @@ if ts_from_url:
 # 3. セッションに保存された 'ts' を使う
 st.session_state.target_timestamp_from_url = st.session_state.get("ts_value_from_url", None)
 
-# バーコード生成関数
-def generate_barcode(code: str) -> Image.Image:
-    CODE128 = barcode.get_barcode_class('code128')
-    barcode_obj = CODE128(code, writer=ImageWriter())
-    buffer = io.BytesIO()
-    barcode_obj.write(buffer)
-    buffer.seek(0)
-    return Image.open(buffer)
+# --- 外部呼び出しが期限内に終わらない・ブレーカーが開いている場合の表示 ---
+SERVICE_BUSY_MESSAGE = "ただいまサーバーが混み合っています。しばらくしてからページを再読み込みしてください。"
+
+
+def show_service_busy():
+    st.error(SERVICE_BUSY_MESSAGE)
+    st.stop()
 
 
 # --- フィードバックをSupabaseに保存する関数 ---
@@ -101,7 +145,7 @@ def save_feedback(uuid, ux_rating, duration_rating, ux_comment,
     """
     try:
         # Supabaseへのデータ挿入
-        supabase.table("feedback").insert({
+        execute_query(supabase.table("feedback").insert({
             "uuid": uuid,
             "ux_rating": ux_rating,
             "duration_rating": duration_rating,
@@ -113,16 +157,17 @@ def save_feedback(uuid, ux_rating, duration_rating, ux_comment,
             "healthcheck_rating": healthcheck,
             "free_comment": free_comment,
             "created_at": datetime.datetime.now().isoformat()
-        }).execute()
+        }), policy=DB_WRITE_POLICY)
         
         # ★ 修正点: 保存成功フラグを設定 ★
         st.session_state['feedback_submitted_success'] = True
         return True
 
-    except Exception as e:
-        # 失敗フラグを設定し、エラー内容をログに出力
+    except Exception:
+        # 失敗フラグを設定し、エラー内容をログに出力（画面には詳細を出さない）
+        logger.exception("feedback insert failed")
         st.session_state['feedback_submitted_success'] = False
-        st.error(f"データベースへの保存中にエラーが発生しました: {e}") # ユーザーにエラーを通知
+        st.error("データベースへの保存中にエラーが発生しました。") # ユーザーにエラーを通知
         return False
 
 # --- フィードバックフォームを表示する関数 ---
@@ -233,9 +278,156 @@ def show_feedback_form(uuid_value):
                     recommendation_score, healthcheck, free_comment
                 )
                 
-                # 保存が成功した場合のみ画面を再描画して成功メッセージを表示
+                # 保存が成功した場合のみフォームの部分を再描画して成功メッセージを表示
                 if success:
-                    st.rerun()
+                    st.session_state.feedback_status[uuid_value] = True
+                    st.rerun(scope="fragment")
+
+
+# --- フィードバック欄（フラグメント: 操作しても結果の表示部分は再実行しない） ---
+@st.fragment
+def feedback_section(uuid_value):
+    # 回答済みかどうかはセッションで1回だけ確認する
+    if uuid_value not in st.session_state.feedback_status:
+        try:
+            # uuidに一致するレコードを検索
+            response_fb = execute_query(supabase.table("feedback").select("uuid").eq("uuid", uuid_value).limit(1))
+            # レコードの数で回答済みか判定
+            st.session_state.feedback_status[uuid_value] = len(response_fb.data) > 0
+        except Exception:
+            # 接続エラーやテーブルエラーの場合、念のためフォームは非表示にしておく（次の実行で再確認する）
+            logger.exception("feedback lookup failed")
+            st.error("フィードバック履歴の確認中にエラーが発生しました。")
+            st.info("✅ アンケートは回答済みです。ご協力ありがとうございました。")
+            return
+
+    if not st.session_state.feedback_status[uuid_value] or st.session_state.feedback_submitted_success:
+        # 未回答の場合（と、送信直後の完了メッセージ）はフォームを表示
+        show_feedback_form(uuid_value)
+    else:
+        # 回答済みの場合にメッセージを表示
+        st.info("✅ アンケートは回答済みです。ご協力ありがとうございました。")
+
+
+# --- 過去履歴の一覧（フラグメント: 古い履歴の追加読み込みは一覧だけを再実行する） ---
+@st.fragment
+def history_section(uuid_value, target_captured_at):
+    st.subheader("📅 過去履歴")
+    for h in st.session_state.all_history:
+        display_date = h.captured_at.strftime("%Y-%m-%d %H:%M")
+
+        if h.captured_at == target_captured_at:
+            st.markdown(f"- **{display_date} (表示中)**")
+        else:
+            # リンクには T付き の元データを渡す
+            history_link = f"?uuid={uuid_value}&ts={h.timestamp}"
+            st.markdown(f"- [{display_date}]({history_link})")
+
+    if st.session_state.history_has_more and st.button("さらに古い履歴を表示"):
+        # 表示中の最も古い履歴より前のページを追加で読み込む
+        try:
+            older_page, has_more = fetch_history_page(
+                supabase,
+                uuid_value,
+                st.session_state.auth_bday,
+                before=st.session_state.all_history[-1].timestamp,
+            )
+        except OutboundError:
+            st.warning(SERVICE_BUSY_MESSAGE)
+            return
+        st.session_state.all_history = st.session_state.all_history + older_page
+        st.session_state.history_index.update(build_history_index(older_page))
+        st.session_state.history_has_more = has_more
+        st.rerun(scope="fragment")
+
+
+# --- 撮影ごとの問診・解析結果（heavy_state に置き、追い出されていたら取り直す） ---
+def load_questionnaire(uuid_value, target_captured_at, target_timestamp):
+    return heavy_state.get_or_build(
+        ("questionnaire", uuid_value, target_captured_at),
+        lambda: fetch_questionnaire(
+            supabase, uuid_value, st.session_state.auth_bday, target_timestamp, cache=row_cache,
+        ),
+    )
+
+
+def load_visit_results(uuid_value, target_captured_at, target_timestamp):
+    return heavy_state.get_or_build(
+        ("results", uuid_value, target_captured_at),
+        lambda: fetch_visit_results(supabase, uuid_value, target_timestamp, cache=row_cache),
+    )
+
+
+# --- レポートのダウンロード（フラグメント: PDF は撮影ごとに1回だけ用意する） ---
+# 引数はキーだけにする（フラグメントの引数はセッションに保持され続け、
+# 問診や結果のオブジェクトを渡すと heavy_state が追い出しても解放されないため）
+@st.fragment
+def download_section(uuid_value, target_captured_at, target_timestamp):
+    st.subheader("📄 レポートのダウンロード")
+
+    try:
+        questionnaire = load_questionnaire(uuid_value, target_captured_at, target_timestamp)
+        visit_results = load_visit_results(uuid_value, target_captured_at, target_timestamp)
+    except OutboundError:
+        st.error(SERVICE_BUSY_MESSAGE)
+        return
+    if not questionnaire or visit_results is None:
+        st.error("レポートを用意できませんでした。ページを再読み込みしてください。")
+        return
+
+    # 事前生成済みで内容ハッシュが同じPDFがあればそれを使い（キャッシュから消えていれば
+    # アーカイブから読む）、なければここで生成して保存する
+    etag = report_etag(questionnaire, visit_results)
+    pdf_bytes = report_store.get_pdf(uuid_value, target_captured_at, etag)
+    if pdf_bytes is None:
+        pdf_bytes = get_archive().get(uuid_value, target_captured_at, etag)
+        if pdf_bytes is not None:
+            report_store.put_pdf(uuid_value, target_captured_at, etag, pdf_bytes)
+    if pdf_bytes is None:
+        eye_images = heavy_state.get_or_build(
+            ("images", uuid_value, target_captured_at),
+            lambda: download_images([visit_results.right, visit_results.left]),
+        )
+        real_age = questionnaire.real_age
+        pdf_bytes = generate_pdf(
+            questionnaire, visit_results.right, visit_results.left, real_age, images=eye_images,
+            peer_report=evaluate_visit(questionnaire.gender, real_age, visit_results),
+        )
+        report_store.put_pdf(uuid_value, target_captured_at, etag, pdf_bytes)
+        get_archive().put(uuid_value, target_captured_at, etag, pdf_bytes)
+
+    # ダウンロードしても再実行しない
+    st.download_button(
+        label="PDFレポートをダウンロード",
+        data=bytes(pdf_bytes),
+        # 内容が同じなら同じファイル名になるので、保存済みのものと重複しているか判別できる
+        file_name=f"Health_Report_{uuid_value}_{etag[:12]}.pdf",
+        mime="application/pdf",
+        on_click="ignore",
+    )
+
+# --- 解析待ち（フラグメント: 結果が届くまで自動で確認し、届いたらページ全体を更新する） ---
+# 撮影からこれ以上たっても結果がない場合は、解析待ちではなく結果なしとして扱う
+PENDING_MAX_AGE = datetime.timedelta(hours=24)
+
+
+@st.fragment(run_every=RESULT_WATCH_INTERVAL)
+def pending_results_section(uuid_value, target_captured_at):
+    # 問い合わせは全セッション共有のウォッチャーがまとめて行い、ここでは到着を確認するだけ
+    watch = get_result_watcher(lambda: SupabaseResultSource(supabase)).watch(uuid_value, target_captured_at)
+    if watch.ready:
+        # ウォッチャーが到着を見つけても、このページの問い合わせ（timestamp の表記で引く）で
+        # 見えるとは限らない。見えるまでは全体を再実行せず、run_every の周期で確認し直す
+        # （すぐに st.rerun() すると、再実行のたびにここへ戻って再実行が止まらなくなる）
+        try:
+            visible = load_visit_results(uuid_value, target_captured_at, st.session_state.target_timestamp)
+        except OutboundError:
+            visible = None
+        if visible is not None:
+            st.rerun()
+    st.info("AI解析中です。結果が届くとこのページが自動で更新されます（再読み込みは不要です）。")
+    st.caption(f"待ち時間: {watch.waited_seconds:.0f} 秒")
+
 
 # --- 誕生日確認 ---
 if not st.session_state.authenticated:
@@ -269,26 +461,37 @@ if not st.session_state.authenticated:
             if not bday_input:
                 st.error("誕生日を入力してください。")
             else:
-                # Supabaseに問診データを確認しにいく
-                response_q = supabase.table("questionnaires").select("*") \
-                    .eq("uuid", uuid_value) \
-                    .eq("bday", bday_input.isoformat()) \
-                    .order("timestamp", desc=True) \
-                    .execute()
-                
-                if not response_q.data:
+                # Supabaseに問診の有無だけを確認しにいく（最新の timestamp のみ取得）
+                # 不一致が続く場合は問い合わせる前に断る（login_guard）
+                try:
+                    outcome = get_login_guard().attempt(
+                        uuid_value, bday_input.isoformat(), session_id,
+                        lambda: probe_latest_timestamp(supabase, uuid_value, bday_input.isoformat()),
+                    )
+                except OutboundError:
+                    show_service_busy()
+                latest_ts = outcome.latest_timestamp
+
+                if outcome.status == "throttled":
+                    st.warning(
+                        f"確認の試行が続いたため、一時的に受け付けを停止しています。"
+                        f"約{max(1, round(outcome.retry_after))}秒後に再度お試しください。"
+                    )
+                elif not latest_ts:
                     st.warning("入力された情報と一致する問診がありませんでした。")
                 else:
                     # ★★★ここが最重要★★★
                     st.session_state.authenticated = True
-                    st.session_state.all_history = response_q.data # 取得した履歴も記憶
+                    st.session_state.auth_bday = bday_input.isoformat()
+                    st.session_state.all_history = None # 履歴は表示時に1ページずつ読み込む
+                    st.session_state.history_index = {}
                     
                     # ★★★ 修正ここから ★★★
                     # 1. セッションから 'ts' を読み込む（スクリプト先頭で *修復・保存* したもの）
                     ts_from_session = st.session_state.get("target_timestamp_from_url", None)
                     
                     # 2. デフォルト（最新）の T付き ts を取得
-                    default_ts_with_t = response_q.data[0]['timestamp']
+                    default_ts_with_t = latest_ts
 
                     # 3. セッションに'ts'があればそれを使い、なければ最新を使う
                     target_ts = ts_from_session if ts_from_session else default_ts_with_t
@@ -327,466 +530,218 @@ else:
         if "target_timestamp_from_url" in st.session_state:
             del st.session_state.target_timestamp_from_url
     
+    # 履歴の1ページ目（リンク一覧に必要な列のみ）を読み込む
+    if st.session_state.all_history is None:
+        try:
+            first_page, has_more = fetch_history_page(
+                supabase, uuid_value, st.session_state.auth_bday
+            )
+        except OutboundError:
+            show_service_busy()
+        st.session_state.all_history = first_page
+        st.session_state.history_index = build_history_index(first_page)
+        st.session_state.history_has_more = has_more
+
     # もし target_timestamp がまだ設定されていなければ（QR直後など）、
     # all_history の最新（[0]番目）を使う
     if "target_timestamp" not in st.session_state or not st.session_state.target_timestamp:
-        st.session_state.target_timestamp = st.session_state.all_history[0]['timestamp']
+        st.session_state.target_timestamp = st.session_state.all_history[0].timestamp
     # ★★★ 修正ここまで ★★★
 
+    # 撮影日時は文字列のまま比較せず、パース済みの datetime をキーに使う
+    if st.session_state.get("target_timestamp_parsed_from") != st.session_state.target_timestamp:
+        try:
+            target_captured_at = parse_timestamp(st.session_state.target_timestamp)
+        except ValueError:
+            # URL の ts が壊れている（途中で切れた・"+" が空白になった等）
+            st.error("指定された履歴のデータが見つかりませんでした。")
+            st.stop()
+        st.session_state.target_captured_at = target_captured_at
+        st.session_state.target_timestamp_parsed_from = st.session_state.target_timestamp
+    target_captured_at = st.session_state.target_captured_at
+
+    # 読み込み済みの履歴にあれば、問い合わせには DB 上の表記の timestamp を使う
+    target_entry = st.session_state.history_index.get(target_captured_at)
+    if target_entry is not None:
+        st.session_state.target_timestamp = target_entry.timestamp
+        st.session_state.target_timestamp_parsed_from = target_entry.timestamp
+
 
     st.success("本人確認ができました ✅ 結果をご確認ください。")
 
-    # T付き同士で比較
-    questionnaire = next(
-        (q for q in st.session_state.all_history if q['timestamp'] == st.session_state.target_timestamp), 
-        None
-    )
+    # 表示対象の問診だけを取得する（一度表示した撮影日時は、追い出されるまで再取得しない）
+    try:
+        questionnaire = load_questionnaire(uuid_value, target_captured_at, st.session_state.target_timestamp)
+    except OutboundError:
+        show_service_busy()
 
     if not questionnaire:
         st.error("指定された履歴のデータが見つかりませんでした。")
         st.stop()
 
-    # T付き同士で比較
-    st.subheader("📅 過去履歴")
-    for h in st.session_state.all_history: # all_history には T付き の元データが入っている
-        
-        ts_value_with_t = h["timestamp"] # 'T'付き
-        
-        display_date = datetime.datetime.fromisoformat(ts_value_with_t).strftime("%Y-%m-%d %H:%M")
+    history_section(uuid_value, target_captured_at)
 
-        # T付き 同士で比較
-        if ts_value_with_t == st.session_state.target_timestamp:
-            st.markdown(f"- **{display_date} (表示中)**")
+    # 解析結果は揃っていれば撮影日時ごとに記憶し、再実行のたびに問い合わせない
+    # 右眼(R)と左眼(L)に振り分けた結果を取得する
+    try:
+        visit_results = load_visit_results(uuid_value, target_captured_at, st.session_state.target_timestamp)
+    except OutboundError:
+        show_service_busy()
+
+    if visit_results is None:
+        if target_captured_at.tzinfo is not None and \
+                datetime.datetime.now(datetime.timezone.utc) - target_captured_at < PENDING_MAX_AGE:
+            pending_results_section(uuid_value, target_captured_at)
         else:
-            # リンクには T付き の元データを渡す
-            history_link = f"?uuid={uuid_value}&ts={ts_value_with_t}"
-            st.markdown(f"- [{display_date}]({history_link})")
-
-    # T付きのまま検索
-    response_res = supabase.table("results").select("*") \
-    .eq("questionnaire_uuid", uuid_value) \
-    .eq("captured_datetime", st.session_state.target_timestamp) \
-    .execute()
-
-    if not response_res.data:
-        st.info("この撮影日時のAI解析結果はありません。")
+            st.info("この撮影日時のAI解析結果はありません。")
         st.stop()
 
-    # --- 取得した結果を右眼(R)と左眼(L)のデータに振り分ける ---
-    right_eye_data = None
-    left_eye_data = None
-    for record in response_res.data:
-        if record.get('eye') == 'R':
-            right_eye_data = record
-        elif record.get('eye') == 'L':
-            left_eye_data = record
+    right_eye_data = visit_results.right
+    left_eye_data = visit_results.left
 
     # --- 撮影時年齢の計算 ---
-    birth_date = datetime.datetime.fromisoformat(questionnaire['bday']).date()
-    capture_datetime_str = questionnaire.get("timestamp") or st.session_state.target_timestamp
-    capture_date = datetime.datetime.fromisoformat(capture_datetime_str).date()
-    real_age = (
-        capture_date.year - birth_date.year
-        - ((capture_date.month, capture_date.day) < (birth_date.month, birth_date.day))
-    )
+    capture_date = questionnaire.captured_at.date()
+    real_age = questionnaire.real_age
 
     st.warning("⚠️ この結果はAIによる健康リスク推定です。診断ではありません。こちらは現在東北大学において開発中のアルゴリズムを使用しております。")
     st.caption("気になる点がある場合は、医療機関にご相談ください。")
 
     # 基本情報表示
     st.subheader("📋 基本情報")
-    st.write(f"- 性別: {questionnaire.get('gender', '未登録')}")
-    st.write(f"- 誕生日: {questionnaire.get('bday', '未登録')}")
-    st.write(f"- 身長: {questionnaire.get('height', '未登録')} cm")
-    st.write(f"- 体重: {questionnaire.get('weight', '未登録')} kg")
-    st.write(f"- 健康状態: {questionnaire.get('health', '未登録')}")
+    st.write(f"- 性別: {questionnaire.gender or '未登録'}")
+    st.write(f"- 誕生日: {questionnaire.bday or '未登録'}")
+    st.write(f"- 身長: {questionnaire.height or '未登録'} cm")
+    st.write(f"- 体重: {questionnaire.weight or '未登録'} kg")
+    st.write(f"- 健康状態: {questionnaire.health or '未登録'}")
     st.write(f"- 撮影日: {capture_date}")
 
-    # 画像表示
-    def load_image_from_url(url: str) -> Image.Image:
-        response = requests.get(url)
-        response.raise_for_status()
-        return Image.open(BytesIO(response.content))
-
     # 画像表示（右目・左目）
+    # 画像のダウンロードを待たずに下の評価セクションを先に表示するため、
+    # ここでは枠だけを確保し、画像はページの最後で差し込む
     st.subheader("👁️ 撮影画像")
 
     # 横並びにする
     cols = st.columns(2)
-    thumb_width = 300
-    thumb_height = 300
-
-    # 右目
-    if right_eye_data and right_eye_data.get("image_url"):
-        right_img = load_image_from_url(right_eye_data["image_url"])
-        cols[0].image(right_img, caption="右目", use_container_width=True)
-    else:
-        cols[0].info("右目の画像はありません。")
-
-    # 左目
-    if left_eye_data and left_eye_data.get("image_url"):
-        left_img = load_image_from_url(left_eye_data["image_url"])
-        cols[1].image(left_img, caption="左目", use_container_width=True)
-    else:
-        cols[1].info("左目の画像はありません。")
+    image_slots = {}
+    for col, eye_data, eye, caption in (
+        (cols[0], right_eye_data, "R", "右目"),
+        (cols[1], left_eye_data, "L", "左目"),
+    ):
+        if eye_data and eye_data.image_url:
+            slot = col.empty()
+            # 事前生成済みの低解像度サムネイルがあれば先に表示する
+            thumbnail = report_store.get_thumbnail(uuid_value, target_captured_at, eye)
+            if thumbnail:
+                slot.image(bytes(thumbnail), caption=caption, use_container_width=True)
+            else:
+                slot.info(f"{caption}の画像を読み込み中です…")
+            image_slots[eye] = (slot, caption, bool(thumbnail))
+        else:
+            col.info(f"{caption}の画像はありません。")
     
     # -------------------------
     # AIによる目の健康評価
     # -------------------------
 
+    # 全指標の同年代・同性との比較を一度に計算し、以下の表示と PDF の両方で使う
+    peer_report = evaluate_visit(questionnaire.gender, real_age, visit_results)
+
+    def render_peer_caption(evaluation):
+        """左右別の指標の、同年代・同性の中での位置（参照データがある場合のみ）。"""
+        if evaluation is not None and evaluation.percentile is not None:
+            st.caption(
+                f"{evaluation.peer_label}の中で「{evaluation.relative_label}」"
+                f"（下から約{evaluation.percentile:.0f}%、n={evaluation.sample_size}件）"
+            )
+
     # 1. 眼底年齢 (左右別々に表示)
     st.markdown("### 👁️ 眼底年齢")
     st.write(f"**撮影時年齢**: {real_age}歳")
 
     age_cols = st.columns(2)
-    if right_eye_data and right_eye_data.get("fundus_age") is not None:
-        age_cols[0].metric(
-            label="右眼の眼底年齢",
-            value=f"{right_eye_data['fundus_age']} 歳",
-            delta=f"{right_eye_data['fundus_age'] - real_age} 歳",
-            delta_color="inverse"
-        )
-    else:
-        age_cols[0].info("右眼の年齢データなし")
-
-    if left_eye_data and left_eye_data.get("fundus_age") is not None:
-        age_cols[1].metric(
-            label="左眼の眼底年齢",
-            value=f"{left_eye_data['fundus_age']} 歳",
-            delta=f"{left_eye_data['fundus_age'] - real_age} 歳",
-            delta_color="inverse"
-        )
-    else:
-        age_cols[1].info("左眼の年齢データなし")
+    for col, eye_data, eye_label in ((age_cols[0], right_eye_data, "右眼"), (age_cols[1], left_eye_data, "左眼")):
+        evaluation = peer_report.get("fundus_age_delta", eye_data.eye) if eye_data else None
+        with col:
+            if evaluation is not None:
+                st.metric(
+                    label=f"{eye_label}の眼底年齢",
+                    value=f"{eye_data.fundus_age} 歳",
+                    delta=f"{eye_data.fundus_age - real_age} 歳",
+                    delta_color="inverse"
+                )
+                render_peer_caption(evaluation)
+            else:
+                st.info(f"{eye_label}の年齢データなし")
     st.caption("Δは撮影時年齢との差")
     st.markdown("---")
 
     # 2. リスク評価
-    def risk_level(score: float) -> str:
-        if score < 0.3: return "low"
-        elif score < 0.7: return "medium"
-        else: return "high"
-    def render_risk(label: str, score: float):
-        level = risk_level(score)
+    def render_risk(label: str, evaluation):
+        score = evaluation.value
         st.markdown(f"**{label}**")
-        if level == "low": st.success(f"スコア: {score:.2f} (リスク：低 🟢 )")
-        elif level == "medium": st.warning(f"スコア: {score:.2f} (リスク：中 🟡 )")
+        if evaluation.absolute_level == "low": st.success(f"スコア: {score:.2f} (リスク：低 🟢 )")
+        elif evaluation.absolute_level == "medium": st.warning(f"スコア: {score:.2f} (リスク：中 🟡 )")
         else: st.error(f"スコア: {score:.2f} (リスク：高 🔴 )")
 
     # 2a. 視界の健康リスク (左右別々に表示)
     st.markdown("### 視界の健康リスク")
     st.caption("左右の眼でリスクが異なる場合があるため、個別に表示しています。")
     glaucoma_cols = st.columns(2)
-    with glaucoma_cols[0]:
-        if right_eye_data and right_eye_data.get("glaucoma_risk") is not None:
-            render_risk("右眼", right_eye_data["glaucoma_risk"])
-        else:
-            st.info("右眼のデータなし")
-    with glaucoma_cols[1]:
-        if left_eye_data and left_eye_data.get("glaucoma_risk") is not None:
-            render_risk("左眼", left_eye_data["glaucoma_risk"])
-        else:
-            st.info("左眼のデータなし")
+    for col, eye, eye_label in ((glaucoma_cols[0], "R", "右眼"), (glaucoma_cols[1], "L", "左眼")):
+        evaluation = peer_report.get("glaucoma_risk", eye)
+        with col:
+            if evaluation is not None:
+                render_risk(eye_label, evaluation)
+                render_peer_caption(evaluation)
+            else:
+                st.info(f"{eye_label}のデータなし")
     st.markdown("---")
 
     # 2b. 血管健康リスク (平均値を表示)
     st.markdown("### 血管健康リスク")
-    atherosclerosis_scores = []
-    if right_eye_data and right_eye_data.get("atherosclerosis_risk") is not None:
-        atherosclerosis_scores.append(right_eye_data["atherosclerosis_risk"])
-    if left_eye_data and left_eye_data.get("atherosclerosis_risk") is not None:
-        atherosclerosis_scores.append(left_eye_data["atherosclerosis_risk"])
-
-    if atherosclerosis_scores:
-        average_score = sum(atherosclerosis_scores) / len(atherosclerosis_scores)
-        render_risk("左右の平均", average_score)
+    athero = peer_report.get("atherosclerosis_risk")
+    if athero is not None:
+        render_risk("左右の平均", athero)
 
         st.markdown("#### 同年代・同性との比較")
         st.caption(
             "※ 上のスコア（絶対評価）とは別の指標です。"
             "絶対的なリスクが低くても、同年代・同性の中での位置は異なる場合があります。"
         )
-        gender = questionnaire.get("gender")
-        if gender in ("M", "F"):
-            age_group = get_age_group(real_age)
-            ref_data = lookup_percentiles(gender, age_group)
-            if ref_data:
-                percentile = score_to_percentile(average_score, ref_data["percentiles"])
-                peer_label = format_peer_group_label(gender, age_group)
-                sample_size = ref_data["sample_size"]
-
-                st.plotly_chart(
-                    build_athero_gauge_figure(percentile),
-                    use_container_width=True,
+        if peer_report.peer_label is None:
+            st.info("性別が未登録のため、同年代・同性との比較は表示できません。")
+        elif athero.percentile is not None:
+            st.plotly_chart(
+                build_athero_gauge_figure(athero.percentile),
+                use_container_width=True,
+            )
+            st.markdown(format_relative_comparison_message(athero.peer_label, athero.percentile))
+            st.caption(f"（同グループの参考データ: n={athero.sample_size}件）")
+            if athero.sample_size < 30:
+                st.caption(
+                    "※ 参考データの件数が少ないため、相対位置は参考値としてご覧ください。"
                 )
-                st.markdown(format_relative_comparison_message(peer_label, percentile))
-                st.caption(f"（同グループの参考データ: n={sample_size}件）")
-                if sample_size < 30:
-                    st.caption(
-                        "※ 参考データの件数が少ないため、相対位置は参考値としてご覧ください。"
-                    )
-            else:
-                st.info("この性別・年代に対応する参考データがありません。")
         else:
-            st.info("性別が未登録のため、同年代・同性との比較は表示できません。")
+            st.info("この性別・年代に対応する参考データがありません。")
     else:
         st.info("血管健康リスクのデータがありません。")
 
     ### ★★★ ここに脚注を追加 ★★★
     st.caption("※ 各リスクスコアは0から1の範囲で算出され、1に近いほどAIが推定するリスクが高いことを示します。")
 
-# --------------------------------
-# PDF生成
-# --------------------------------
-
-    # 日本語フォントの登録（既にあれば不要）
-    # FONT_PATH = ...
-    # pdfmetrics.registerFont(TTFont('IPAexGothic', FONT_PATH))
-
-    def generate_pdf(questionnaire_data, right_eye_data, left_eye_data, real_age):
-        """
-        問診と左右の眼の結果からPDFレポートを生成する関数（レイアウト＆バグ修正版）
-        """
-        def wrap_pdf_text(text: str, max_chars: int = 48) -> list[str]:
-            lines = []
-            remaining = text
-            while remaining:
-                if len(remaining) <= max_chars:
-                    lines.append(remaining)
-                    break
-                split_at = max(
-                    remaining.rfind("。", 0, max_chars + 1),
-                    remaining.rfind("、", 0, max_chars + 1),
-                )
-                if split_at <= 0:
-                    split_at = max_chars
-                else:
-                    split_at += 1
-                lines.append(remaining[:split_at])
-                remaining = remaining[split_at:].lstrip()
-            return lines
-
-        buffer = io.BytesIO()
-        p = canvas.Canvas(buffer, pagesize=A4)
-        width, height = A4
-
-        # Y座標の初期位置
-        y_cursor = height - 20 * mm
-
-        # --- ヘッダー ---
-        p.setFont('IPAexGothic', 18)
-        p.drawString(20 * mm, y_cursor, "健康チェック結果レポート")
-        y_cursor -= 6 * mm
-        p.setFont('IPAexGothic', 9)
-        p.drawString(150 * mm, y_cursor, f"作成日: {datetime.date.today().strftime('%Y-%m-%d')}")
-        p.line(20 * mm, y_cursor - 2 * mm, width - 20 * mm, y_cursor - 2 * mm)
-        y_cursor -= 5 * mm
-
-        # --- バーコード ---
-        uuid_value = questionnaire_data.get('uuid')
-        if uuid_value:
-            p.drawString(20 * mm, y_cursor, f"受付番号: ")
-            y_cursor -= 21 * mm
-            try:
-                barcode_obj = barcode.get_barcode_class('code128')(uuid_value, writer=ImageWriter())
-                barcode_buffer = io.BytesIO()
-                barcode_obj.write(barcode_buffer)
-                barcode_buffer.seek(0)
-                barcode_img = ImageReader(Image.open(barcode_buffer))
-                p.drawImage(barcode_img, 20 * mm, y_cursor, width=80*mm, height=18*mm)
-                y_cursor -= 5 * mm
-                p.setFont('IPAexGothic', 8)
-                p.drawString(20 * mm, y_cursor, "次回以降こちらの受付IDをご利用ください。問診などを省略出来て便利です。")
-            except Exception as e:
-                print(f"Barcode generation failed: {e}")
-        y_cursor -= 15 * mm
-
-        # --- 基本情報 ---
-        p.setFont('IPAexGothic', 12)
-        p.drawString(20 * mm, y_cursor, "■ 基本情報")
-        y_cursor -= 8 * mm
-        p.setFont('IPAexGothic', 10)
-        p.drawString(25 * mm, y_cursor, f"性別: {questionnaire_data.get('gender', '-')}")
-        p.drawString(70 * mm, y_cursor, f"誕生日: {questionnaire_data.get('bday', '-')}")
-        p.drawString(120 * mm, y_cursor, f"撮影時年齢: {real_age} 歳")
-        y_cursor -= 15 * mm
-        
-        # --- 撮影画像 ---
-        p.setFont('IPAexGothic', 12)
-        p.drawString(20 * mm, y_cursor, "■ 撮影画像")
-        img_y_pos = y_cursor - 55 * mm # 画像描画用のY座標を確保
-        
-        def download_image(url):
-            try:
-                response = requests.get(url, timeout=10)
-                response.raise_for_status()
-                return Image.open(io.BytesIO(response.content))
-            except Exception:
-                return None
-
-        if right_eye_data and right_eye_data.get("image_url"):
-            img = download_image(right_eye_data["image_url"])
-            if img:
-                p.drawImage(ImageReader(img), 30 * mm, img_y_pos, width=50*mm, height=50*mm, preserveAspectRatio=True, anchor='c')
-                p.drawCentredString(55 * mm, img_y_pos - 5*mm, "右眼")
-        
-        if left_eye_data and left_eye_data.get("image_url"):
-            img = download_image(left_eye_data["image_url"])
-            if img:
-                p.drawImage(ImageReader(img), 115 * mm, img_y_pos, width=50*mm, height=50*mm, preserveAspectRatio=True, anchor='c')
-                p.drawCentredString(140 * mm, img_y_pos - 5*mm, "左眼")
-        y_cursor -= 70 * mm # 画像とキャプションの分だけカーソルを下に移動
-
-        # --- AIによる健康評価 ---
-        # ★★★ このブロック全体がifの外にあることが重要 ★★★
-        p.setFont('IPAexGothic', 12)
-        p.drawString(20 * mm, y_cursor, "■ AIによる目の健康評価")
-        p.line(20 * mm, y_cursor - 2 * mm, width - 20 * mm, y_cursor - 2 * mm)
-        y_cursor -= 12 * mm
-        
-        # 眼底年齢
-        p.setFont('IPAexGothic', 11)
-        p.drawString(25 * mm, y_cursor, "眼底年齢")
-        p.setFont('IPAexGothic', 10)
-        if right_eye_data and right_eye_data.get('fundus_age') is not None:
-            p.drawString(70 * mm, y_cursor, f"右眼: {right_eye_data.get('fundus_age')} 歳")
-        if left_eye_data and left_eye_data.get('fundus_age') is not None:
-            p.drawString(120 * mm, y_cursor, f"左眼: {left_eye_data.get('fundus_age')} 歳")
-        y_cursor -= 12 * mm
-
-        # 視界の健康リスク
-        p.setFont('IPAexGothic', 11)
-        p.drawString(25 * mm, y_cursor, "視界の健康リスク")
-        p.setFont('IPAexGothic', 10)
-        if right_eye_data and right_eye_data.get('glaucoma_risk') is not None:
-            p.drawString(70 * mm, y_cursor, f"右眼: {right_eye_data.get('glaucoma_risk'):.2f}")
-        if left_eye_data and left_eye_data.get('glaucoma_risk') is not None:
-            p.drawString(120 * mm, y_cursor, f"左眼: {left_eye_data.get('glaucoma_risk'):.2f}")
-        y_cursor -= 12 * mm
-
-        # 血管健康リスク
-        scores = []
-        if right_eye_data and right_eye_data.get("atherosclerosis_risk") is not None:
-            scores.append(right_eye_data["atherosclerosis_risk"])
-        if left_eye_data and left_eye_data.get("atherosclerosis_risk") is not None:
-            scores.append(left_eye_data["atherosclerosis_risk"])
-        avg_score = (sum(scores) / len(scores)) if scores else -1.0
-
-        p.setFont('IPAexGothic', 11)
-        p.drawString(25 * mm, y_cursor, "血管健康リスク")
-        p.setFont('IPAexGothic', 10)
-        if avg_score >= 0:
-            p.drawString(70 * mm, y_cursor, f"左右平均: {avg_score:.2f}")
-        y_cursor -= 12 * mm
-
-        if avg_score >= 0:
-            gender = questionnaire_data.get("gender")
-            if gender in ("M", "F"):
-                age_group = get_age_group(real_age)
-                ref_data = lookup_percentiles(gender, age_group)
-                if ref_data:
-                    percentile = score_to_percentile(avg_score, ref_data["percentiles"])
-                    peer_label = format_peer_group_label(gender, age_group)
-                    sample_size = ref_data["sample_size"]
-
-                    if y_cursor < 70 * mm:
-                        p.showPage()
-                        y_cursor = height - 20 * mm
-
-                    p.setFont('IPAexGothic', 10)
-                    p.drawString(25 * mm, y_cursor, "同年代・同性との比較")
-                    y_cursor -= 6 * mm
-                    p.setFont('IPAexGothic', 8)
-                    p.drawString(
-                        25 * mm,
-                        y_cursor,
-                        "※ 上のスコア（絶対評価）とは別の指標です。",
-                    )
-                    y_cursor -= 5 * mm
-                    p.drawString(
-                        25 * mm,
-                        y_cursor,
-                        "絶対的なリスクが低くても、同年代・同性の中での位置は異なる場合があります。",
-                    )
-                    y_cursor -= 8 * mm
-
-                    bar_height = 8 * mm
-                    bar_width = 130 * mm
-                    bar_x = 25 * mm
-                    bar_y = y_cursor - bar_height
-                    draw_athero_gauge_pdf(
-                        p, bar_x, bar_y, bar_width, bar_height, percentile
-                    )
-                    y_cursor = bar_y - 10 * mm
-
-                    p.setFont('IPAexGothic', 9)
-                    comparison_text = format_relative_comparison_plain_text(
-                        peer_label, percentile
-                    )
-                    for line in wrap_pdf_text(comparison_text):
-                        if y_cursor < 40 * mm:
-                            p.showPage()
-                            y_cursor = height - 20 * mm
-                        p.drawString(25 * mm, y_cursor, line)
-                        y_cursor -= 5 * mm
-
-                    p.setFont('IPAexGothic', 8)
-                    p.drawString(
-                        25 * mm,
-                        y_cursor,
-                        f"（同グループの参考データ: n={sample_size}件）",
-                    )
-                    y_cursor -= 5 * mm
-                    if sample_size < 30:
-                        p.drawString(
-                            25 * mm,
-                            y_cursor,
-                            "※ 参考データの件数が少ないため、相対位置は参考値としてご覧ください。",
-                        )
-                        y_cursor -= 5 * mm
-        
-        # --- フッター / 注意事項 ---
-        p.setFont('IPAexGothic', 9)
-        disclaimer = "この結果はAIによる健康リスク推定です。診断ではありません。気になる点がある場合は、医療機関にご相談ください。"
-        p.drawString(20 * mm, 30 * mm, disclaimer)
-        p.line(20 * mm, 28 * mm, width - 20 * mm, 28 * mm)
-
-        p.save()
-        buffer.seek(0)
-        return buffer.getvalue()
-
-    st.markdown("---")
-    st.subheader("📄 レポートのダウンロード")
-
-    # PDF生成ボタン
-    # generate_pdf関数に、取得済みのデータを渡す
-    pdf_bytes = generate_pdf(questionnaire, right_eye_data, left_eye_data, real_age)
-
-    st.download_button(
-        label="PDFレポートをダウンロード",
-        data=pdf_bytes,
-        file_name=f"Health_Report_{uuid_value}.pdf",
-        mime="application/pdf",
+    # --- 撮影画像の差し込み（フル解像度、左右を並行して取得） ---
+    eye_images = heavy_state.get_or_build(
+        ("images", uuid_value, target_captured_at),
+        lambda: download_images([right_eye_data, left_eye_data]),
     )
+    for eye, (slot, caption, has_thumbnail) in image_slots.items():
+        if eye_images.get(eye):
+            slot.image(eye_images[eye], caption=caption, use_container_width=True)
+        elif not has_thumbnail:
+            slot.warning(f"{caption}の画像を取得できませんでした。")
 
     st.markdown("---")
+    download_section(uuid_value, target_captured_at, st.session_state.target_timestamp)
 
-    # 1. Supabaseのfeedbackテーブルに該当UUIDのレコードがあるか確認
-    try:
-        # uuidに一致するレコードを検索
-        response_fb = supabase.table("feedback").select("uuid").eq("uuid", uuid_value).execute()
-        
-        # レコードの数で回答済みか判定
-        is_feedback_submitted = len(response_fb.data) > 0
-
-    except Exception as e:
-        # 接続エラーやテーブルエラーの場合、念のためフォームは非表示にしておく
-        st.error("フィードバック履歴の確認中にエラーが発生しました。")
-        is_feedback_submitted = True # エラー時は表示しない
-
-    if not is_feedback_submitted:
-        # 未回答の場合のみフォームを表示
-        show_feedback_form(uuid_value)
-    else:
-        # 回答済みの場合、またはエラー発生時にメッセージを表示
-        st.info("✅ アンケートは回答済みです。ご協力ありがとうございました。")
\ No newline at end of file
+    st.markdown("---")
+    feedback_section(uuid_value)
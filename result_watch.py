@@ -0,0 +1,201 @@
+"""解析待ちの撮影について、結果の到着を全セッション共有の1本のポーリングで見張る。
+
+    watcher = get_result_watcher(lambda: SupabaseResultSource(client))
+    if watcher.watch(uuid, captured_at).ready:
+        ...  # 結果が届いた
+
+解析が終わる前にリンクを開いた患者は、結果が出るまで再読み込みを繰り返しがちで、
+そのたびに問診・結果の問い合わせとスクリプト全体が走る。待っているセッションは
+watch() で関心を登録するだけにし、プロセス内の1本のスレッドが、待たれている全撮影の
+結果の有無を interval 秒ごとに1回の問い合わせでまとめて確認する。
+
+- 結果ページはフラグメントの run_every で watch() を呼び続け、ready になったら全体を再実行する
+- 一定時間 watch() が呼ばれなくなった撮影（タブを閉じた等）は見張りをやめる
+- 結果の取得元は ResultSource。本番は SupabaseResultSource、テストや手元の確認には
+  LocalResultSource（add() で結果の到着を模擬する）を使う
+"""
+
+from __future__ import annotations
+
+import collections
+import datetime
+import logging
+import threading
+import time
+from typing import Callable
+
+from outbound import execute_query
+from records import parse_timestamp
+
+logger = logging.getLogger(__name__)
+
+# 結果の有無を確認する間隔（秒）
+RESULT_WATCH_INTERVAL = 3.0
+# この時間 watch() が呼ばれなかった撮影は見張りをやめる（秒）
+WATCH_IDLE_SECONDS = 30.0
+# 1回の問い合わせの in フィルタに入れる uuid の数
+WATCH_QUERY_CHUNK = 100
+
+WatchKey = tuple[str, datetime.datetime]
+
+
+class ResultSource:
+    """待たれている撮影のうち、結果が届いたものを返す。"""
+
+    def arrived(self, keys: list[WatchKey]) -> set[WatchKey]:
+        raise NotImplementedError
+
+
+class SupabaseResultSource(ResultSource):
+    """results を uuid でまとめて問い合わせる（待っている撮影が何件でも、100 uuid ごとに1回）。
+
+    見張っている撮影のうち最も古い撮影日時より前の行は取らない。待たれているのは
+    解析待ちの新しい撮影だけなので、患者の過去の結果を毎回読み直したり、
+    max_rows で応答が切られて新しい行が落ちたりしない。
+    """
+
+    def __init__(self, client):
+        self.client = client
+
+    def arrived(self, keys: list[WatchKey]) -> set[WatchKey]:
+        by_uuid: dict[str, list[datetime.datetime]] = collections.defaultdict(list)
+        for uuid, captured_at in keys:
+            by_uuid[uuid].append(captured_at)
+        uuids = sorted(by_uuid)
+        found: set[WatchKey] = set()
+        for start in range(0, len(uuids), WATCH_QUERY_CHUNK):
+            chunk = uuids[start:start + WATCH_QUERY_CHUNK]
+            earliest = min(captured_at for uuid in chunk for captured_at in by_uuid[uuid])
+            response = execute_query(
+                self.client.table("results").select("questionnaire_uuid, captured_datetime")
+                .in_("questionnaire_uuid", chunk)
+                .gte("captured_datetime", earliest.isoformat())
+            )
+            for row in response.data or []:
+                # 撮影日時は文字列の表記ではなく、パースした時刻で照合する
+                uuid, captured_at = row["questionnaire_uuid"], parse_timestamp(row["captured_datetime"])
+                if captured_at in by_uuid.get(uuid, ()):
+                    found.add((uuid, captured_at))
+        return found
+
+
+class LocalResultSource(ResultSource):
+    """プロセス内だけの結果の取得元（テスト・手元の確認用）。"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._results: set[WatchKey] = set()
+
+    def add(self, uuid: str, captured_at: datetime.datetime) -> None:
+        """結果が届いたことにする。"""
+        with self._lock:
+            self._results.add((uuid, captured_at))
+
+    def arrived(self, keys: list[WatchKey]) -> set[WatchKey]:
+        with self._lock:
+            return self._results.intersection(keys)
+
+
+class PendingWatch:
+    """1回の撮影の見張り。同じ撮影を待つセッションは同じインスタンスを共有する。"""
+
+    __slots__ = ("key", "event", "started_at", "last_interest")
+
+    def __init__(self, key: WatchKey):
+        self.key = key
+        self.event = threading.Event()
+        self.started_at = time.monotonic()
+        self.last_interest = self.started_at
+
+    @property
+    def ready(self) -> bool:
+        return self.event.is_set()
+
+    @property
+    def waited_seconds(self) -> float:
+        return time.monotonic() - self.started_at
+
+    def wait(self, timeout: float | None = None) -> bool:
+        return self.event.wait(timeout)
+
+
+class ResultWatcher:
+    """待たれている撮影をまとめてポーリングするスレッド（最初の watch() で起動する）。"""
+
+    def __init__(self, source: ResultSource, interval: float = RESULT_WATCH_INTERVAL,
+                 idle_seconds: float = WATCH_IDLE_SECONDS):
+        self.source = source
+        self.interval = interval
+        self.idle_seconds = idle_seconds
+        self._cond = threading.Condition()
+        self._watches: dict[WatchKey, PendingWatch] = {}
+        self._thread: threading.Thread | None = None
+        self._counters: collections.Counter[str] = collections.Counter()
+
+    def watch(self, uuid: str, captured_at: datetime.datetime) -> PendingWatch:
+        """撮影の結果を待つ。呼ぶたびに関心があることを記録し、見張りを延長する。"""
+        key = (uuid, captured_at)
+        with self._cond:
+            watch = self._watches.get(key)
+            if watch is None:
+                watch = self._watches[key] = PendingWatch(key)
+                self._counters["watches"] += 1
+                # 見張りがなくて止まっているスレッドを起こす（動いていれば次の周期にまとめて確認する）
+                if len(self._watches) == 1:
+                    self._cond.notify()
+            watch.last_interest = time.monotonic()
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="result-watch", daemon=True)
+                self._thread.start()
+            return watch
+
+    def _run(self) -> None:
+        while True:
+            with self._cond:
+                while not self._watches:
+                    self._cond.wait()
+                now = time.monotonic()
+                for key in [k for k, w in self._watches.items() if now - w.last_interest > self.idle_seconds]:
+                    del self._watches[key]
+                    self._counters["expired"] += 1
+                keys = [key for key, watch in self._watches.items() if not watch.ready]
+
+            if keys:
+                try:
+                    arrived = self.source.arrived(keys)
+                except Exception:
+                    logger.warning("result watch poll failed", exc_info=True)
+                    arrived = set()
+                    with self._cond:
+                        self._counters["errors"] += 1
+                with self._cond:
+                    self._counters["polls"] += 1
+                    for key in arrived:
+                        watch = self._watches.get(key)
+                        if watch is not None and not watch.ready:
+                            watch.event.set()
+                            self._counters["arrived"] += 1
+
+            with self._cond:
+                self._cond.wait(timeout=self.interval)
+
+    def metrics(self) -> dict:
+        with self._cond:
+            return {
+                "watching": sum(not watch.ready for watch in self._watches.values()),
+                "ready": sum(watch.ready for watch in self._watches.values()),
+                **self._counters,
+            }
+
+
+_default_watcher: ResultWatcher | None = None
+_default_lock = threading.Lock()
+
+
+def get_result_watcher(source_factory: Callable[[], ResultSource]) -> ResultWatcher:
+    """プロセス内で共有するウォッチャー。source_factory は最初の呼び出しでだけ使う。"""
+    global _default_watcher
+    with _default_lock:
+        if _default_watcher is None:
+            _default_watcher = ResultWatcher(source_factory())
+        return _default_watcher
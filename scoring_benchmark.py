@@ -0,0 +1,136 @@
+"""scoring_service のスループット計測。
+
+    python scoring_benchmark.py                       # 同じプロセスでサーバーを起動して計測
+    python scoring_benchmark.py --url http://host:8502 --clients 16 --batch 200 --seconds 30
+
+各クライアントは1本の keep-alive 接続で、ランダムな (性別, 年齢, 左右のスコア) のバッチを
+繰り返し POST する。リクエスト数・評価件数の毎秒の値と、レイテンシの p50 / p95 / p99、
+エラー（503 を含む）の件数を JSON で出力する。
+"""
+
+from __future__ import annotations
+
+import argparse
+import http.client
+import json
+import random
+import threading
+import time
+from urllib.parse import urlsplit
+
+
+def make_payload(batch: int, rng: random.Random) -> bytes:
+    items = []
+    for _ in range(batch):
+        eyes = {
+            side: {
+                "fundus_age": rng.randint(20, 90),
+                "glaucoma_risk": round(rng.random(), 4),
+                "atherosclerosis_risk": rng.random() * 1e-3,
+            }
+            for side in ("right", "left") if rng.random() > 0.05
+        }
+        items.append({"gender": rng.choice(("M", "F")), "age": rng.randint(20, 89), **eyes})
+    return json.dumps({"items": items}).encode("utf-8")
+
+
+def run_client(host: str, port: int, payloads: list[bytes], deadline: float, results: list) -> None:
+    latencies: list[float] = []
+    errors = 0
+    connection = http.client.HTTPConnection(host, port, timeout=30)
+    n = 0
+    while time.perf_counter() < deadline:
+        body = payloads[n % len(payloads)]
+        n += 1
+        started = time.perf_counter()
+        try:
+            connection.request("POST", "/v1/score", body, {"Content-Type": "application/json"})
+            response = connection.getresponse()
+            response.read()
+            if response.status != 200:
+                errors += 1
+                if response.getheader("Connection") == "close":
+                    connection.close()
+                continue
+        except (OSError, http.client.HTTPException):
+            errors += 1
+            connection.close()
+            continue
+        latencies.append(time.perf_counter() - started)
+    connection.close()
+    results.append((latencies, errors))
+
+
+def benchmark(host: str, port: int, clients: int, batch: int, seconds: float, warmup: float = 1.0) -> dict:
+    rng = random.Random(0)
+    payloads = [make_payload(batch, rng) for _ in range(16)]
+    # 最初の接続・JIT 的な初期化の分を計測から外す
+    run_client(host, port, payloads, time.perf_counter() + warmup, [])
+
+    results: list = []
+    deadline = time.perf_counter() + seconds
+    threads = [
+        threading.Thread(target=run_client, args=(host, port, payloads, deadline, results))
+        for _ in range(clients)
+    ]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    latencies = sorted(latency for client_latencies, _errors in results for latency in client_latencies)
+    errors = sum(client_errors for _latencies, client_errors in results)
+
+    def percentile(q: float) -> float | None:
+        if not latencies:
+            return None
+        return round(latencies[min(len(latencies) - 1, int(len(latencies) * q))] * 1000, 2)
+
+    return {
+        "clients": clients,
+        "batch": batch,
+        "seconds": round(elapsed, 2),
+        "requests": len(latencies),
+        "errors": errors,
+        "requests_per_second": round(len(latencies) / elapsed, 1),
+        "items_per_second": round(len(latencies) * batch / elapsed, 1),
+        "latency_p50_ms": percentile(0.50),
+        "latency_p95_ms": percentile(0.95),
+        "latency_p99_ms": percentile(0.99),
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--url", default=None, help="計測するサービス（省略時は同じプロセスで起動する）")
+    parser.add_argument("--workers", type=int, default=8, help="同じプロセスで起動するときのワーカー数")
+    parser.add_argument("--clients", type=int, default=8)
+    parser.add_argument("--batch", type=int, default=100)
+    parser.add_argument("--seconds", type=float, default=10.0)
+    args = parser.parse_args()
+
+    server = None
+    if args.url:
+        parts = urlsplit(args.url)
+        host, port = parts.hostname, parts.port or 80
+    else:
+        from scoring_service import ScoringServer
+
+        server = ScoringServer(workers=args.workers)
+        server.start_background()
+        host, port = "127.0.0.1", server.port
+    try:
+        result = benchmark(host, port, args.clients, args.batch, args.seconds)
+        if server is not None:
+            result["server"] = server.metrics()
+        print(json.dumps(result, ensure_ascii=False, indent=2))
+    finally:
+        if server is not None:
+            server.shutdown()
+            server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,279 @@
+"""同年代・同性との比較（百分位・相対ラベル・説明文）を返す、Streamlit に依存しない HTTP サービス。
+
+    python scoring_service.py --port 8502 --workers 8
+
+撮影装置などの内部ツールが、推論直後に結果ページと同じ評価を得るためのもの。
+athero_percentiles.evaluate_visits で、リクエストに含まれる全員・全指標を1回の計算で評価する。
+
+    POST /v1/score
+    {"items": [{"gender": "M", "age": 55,
+                "right": {"fundus_age": 60, "glaucoma_risk": 0.2, "atherosclerosis_risk": 0.0001},
+                "left":  {"fundus_age": 58, "glaucoma_risk": 0.1, "atherosclerosis_risk": 0.0002}}]}
+
+    → {"reference": "<参照データのダイジェスト>",
+       "results": [{"peer_group": "50代・男性", "metrics": [
+           {"metric": "glaucoma_risk", "eye": "R", "value": 0.2, "percentile": 41.3,
+            "relative_label": "平均的", "absolute_level": "low", "sample_size": 120,
+            "message": "あなたの視界の健康リスクは、..."}, ...]}]}
+
+    GET /healthz   稼働確認と参照データのダイジェスト
+    GET /metrics   リクエスト数・評価件数・処理中の接続数など
+
+HTTP/1.1 の keep-alive に対応する。接続は上限つきのワーカープールで処理し、
+空きがなければ一定時間待ってから 503 を返す（接続ごとにスレッドを増やさない）。
+"""
+
+from __future__ import annotations
+
+import argparse
+import collections
+import json
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+from athero_percentiles import REFERENCE_DIGEST, evaluate_visits, format_relative_comparison_plain_text
+from records import ResultRecord, VisitResults
+
+logger = logging.getLogger(__name__)
+
+SCORING_WORKERS = 8
+# ワーカーに空きが出るまで新しい接続を待たせる時間（秒）。過ぎたら 503
+ACCEPT_WAIT_SECONDS = 1.0
+# keep-alive の接続で次のリクエストを待つ時間（秒）。過ぎたら接続を閉じてワーカーを空ける
+KEEPALIVE_TIMEOUT = 5.0
+MAX_BODY_BYTES = 4 * 1024 * 1024
+MAX_BATCH_ITEMS = 10_000
+
+EYE_FIELDS = ("fundus_age", "glaucoma_risk", "atherosclerosis_risk")
+
+
+def _reject_constant(name: str):
+    raise ValueError(f"{name} は使えません")
+
+
+def _number(value, field: str) -> float | None:
+    if value is None:
+        return None
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        raise ValueError(f"{field} は数値で指定してください")
+    return value
+
+
+def parse_items(payload) -> tuple[list[str | None], list[int], list[VisitResults]]:
+    """リクエストの items を (性別, 年齢, 左右の結果) の列にする。不正なら ValueError。"""
+    items = payload.get("items") if isinstance(payload, dict) else None
+    if not isinstance(items, list):
+        raise ValueError("items（配列）を指定してください")
+    if len(items) > MAX_BATCH_ITEMS:
+        raise ValueError(f"items は {MAX_BATCH_ITEMS} 件以下にしてください")
+    genders, ages, visits = [], [], []
+    for n, item in enumerate(items):
+        if not isinstance(item, dict):
+            raise ValueError(f"items[{n}] はオブジェクトで指定してください")
+        age = item.get("age")
+        if isinstance(age, bool) or not isinstance(age, int) or not 0 <= age <= 150:
+            raise ValueError(f"items[{n}].age は 0〜150 の整数で指定してください")
+        eyes = {}
+        for eye, key in (("R", "right"), ("L", "left")):
+            scores = item.get(key)
+            if scores is None:
+                eyes[eye] = None
+                continue
+            if not isinstance(scores, dict):
+                raise ValueError(f"items[{n}].{key} はオブジェクトで指定してください")
+            eyes[eye] = ResultRecord(
+                eye, None,
+                *(_number(scores.get(field), f"items[{n}].{key}.{field}") for field in EYE_FIELDS),
+                None, None,
+            )
+        genders.append(item.get("gender"))
+        ages.append(age)
+        visits.append(VisitResults(eyes["R"], eyes["L"]))
+    return genders, ages, visits
+
+
+def score_batch(payload) -> dict:
+    """リクエストの本文を評価して、レスポンスの本文を返す。"""
+    genders, ages, visits = parse_items(payload)
+    results = []
+    for report in evaluate_visits(genders, ages, visits):
+        metrics = []
+        for entry in report.entries:
+            metrics.append({
+                "metric": entry.metric,
+                "eye": entry.eye,
+                "value": entry.value,
+                "percentile": None if entry.percentile is None else round(entry.percentile, 1),
+                "relative_label": entry.relative_label,
+                "absolute_level": entry.absolute_level,
+                "sample_size": entry.sample_size,
+                "message": (
+                    format_relative_comparison_plain_text(entry.peer_label, entry.percentile, subject=entry.subject)
+                    if entry.percentile is not None else None
+                ),
+            })
+        results.append({"peer_group": report.peer_label, "metrics": metrics})
+    return {"reference": REFERENCE_DIGEST, "results": results}
+
+
+class ScoringHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    timeout = KEEPALIVE_TIMEOUT
+    # ヘッダーと本文を別々に書くので、Nagle と遅延 ACK の組み合わせで応答が待たされないようにする
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args) -> None:
+        logger.debug("%s %s", self.address_string(), format % args)
+
+    def _send_json(self, status: int, body: dict, close: bool = False) -> None:
+        """close なら Connection: close を付けて、応答の後で接続を閉じる（本文を読み捨てられないとき）。"""
+        data = json.dumps(body, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(data)))
+        if close:
+            self.send_header("Connection", "close")
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self) -> None:
+        if self.path == "/healthz":
+            self._send_json(200, {"status": "ok", "reference": REFERENCE_DIGEST})
+        elif self.path == "/metrics":
+            self._send_json(200, self.server.metrics())
+        else:
+            self._send_json(404, {"error": "not found"})
+
+    def do_POST(self) -> None:
+        if self.path != "/v1/score":
+            self._send_json(404, {"error": "not found"})
+            return
+        try:
+            length = int(self.headers.get("Content-Length") or 0)
+        except ValueError:
+            length = -1
+        if length < 0:
+            self.server.count("bad_requests")
+            self._send_json(400, {"error": "Content-Length が正しくありません"}, close=True)
+            return
+        if length > MAX_BODY_BYTES:
+            self._send_json(413, {"error": f"本文は {MAX_BODY_BYTES} バイト以下にしてください"}, close=True)
+            return
+        started = time.perf_counter()
+        try:
+            # NaN / Infinity は JSON の範囲外で、そのまま評価に流れるので受け付けない
+            payload = json.loads(self.rfile.read(length) or b"null", parse_constant=_reject_constant)
+            body = score_batch(payload)
+        except ValueError as e:
+            self.server.count("bad_requests")
+            self._send_json(400, {"error": str(e)})
+            return
+        except Exception:
+            logger.exception("scoring failed")
+            self.server.count("errors")
+            self._send_json(500, {"error": "internal error"})
+            return
+        self.server.record(len(body["results"]), time.perf_counter() - started)
+        self._send_json(200, body)
+
+
+class ScoringServer(HTTPServer):
+    """接続を上限つきのワーカープールで処理する HTTP サーバー。"""
+
+    allow_reuse_address = True
+
+    def __init__(self, address: tuple[str, int] = ("127.0.0.1", 0), workers: int = SCORING_WORKERS,
+                 accept_wait: float = ACCEPT_WAIT_SECONDS):
+        super().__init__(address, ScoringHandler)
+        self.workers = workers
+        self.accept_wait = accept_wait
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="scoring")
+        self._slots = threading.BoundedSemaphore(workers)
+        self._lock = threading.Lock()
+        self._counters: collections.Counter[str] = collections.Counter()
+        self._latencies: collections.deque[float] = collections.deque(maxlen=1000)
+        self._active = 0
+
+    @property
+    def port(self) -> int:
+        return self.server_address[1]
+
+    def count(self, name: str, n: int = 1) -> None:
+        with self._lock:
+            self._counters[name] += n
+
+    def record(self, items: int, seconds: float) -> None:
+        with self._lock:
+            self._counters["requests"] += 1
+            self._counters["items"] += items
+            self._latencies.append(seconds)
+
+    def process_request(self, request, client_address) -> None:
+        # ワーカーに空きがなければ少し待ち、それでも空かなければ 503 を返して閉じる
+        if not self._slots.acquire(timeout=self.accept_wait):
+            self.count("rejected")
+            try:
+                request.sendall(
+                    b"HTTP/1.1 503 Service Unavailable\r\nContent-Length: 0\r\nConnection: close\r\n\r\n"
+                )
+            except OSError:
+                pass
+            self.shutdown_request(request)
+            return
+        self._executor.submit(self._process, request, client_address)
+
+    def _process(self, request, client_address) -> None:
+        with self._lock:
+            self._active += 1
+            self._counters["connections"] += 1
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+            with self._lock:
+                self._active -= 1
+            self._slots.release()
+
+    def metrics(self) -> dict:
+        with self._lock:
+            latencies = sorted(self._latencies)
+            metrics = {"workers": self.workers, "active_connections": self._active, **self._counters}
+        if latencies:
+            metrics["latency_p50_ms"] = round(latencies[len(latencies) // 2] * 1000, 2)
+            metrics["latency_p95_ms"] = round(latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))] * 1000, 2)
+        return metrics
+
+    def server_close(self) -> None:
+        super().server_close()
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def start_background(self) -> threading.Thread:
+        """別スレッドで待ち受けを始める（ベンチマーク・テスト用）。"""
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+        return thread
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8502)
+    parser.add_argument("--workers", type=int, default=SCORING_WORKERS)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    with ScoringServer((args.host, args.port), workers=args.workers) as server:
+        logger.info("scoring service listening on %s:%d (%d workers)", args.host, server.port, args.workers)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,32 @@
+"""Streamlit 外で動くバッチ・ワーカー用の Supabase クライアント生成。"""
+
+from __future__ import annotations
+
+import os
+import tomllib
+
+from supabase import create_client
+
+SECRETS_PATH = os.path.join(os.path.dirname(__file__), ".streamlit", "secrets.toml")
+
+
+def load_setting(name: str, default: str | None = None) -> str | None:
+    """環境変数、なければ .streamlit/secrets.toml から設定値を読む。"""
+    value = os.environ.get(name)
+    if value:
+        return value
+    if os.path.exists(SECRETS_PATH):
+        with open(SECRETS_PATH, "rb") as f:
+            value = tomllib.load(f).get(name)
+        if value:
+            return str(value)
+    return default
+
+
+def create_service_client():
+    """サービスロールキーで Supabase クライアントを作る（RLS を越えて全件を読むため）。"""
+    url = load_setting("SUPABASE_URL")
+    key = load_setting("SUPABASE_SERVICE_ROLE_KEY")
+    if not url or not key:
+        raise RuntimeError("SUPABASE_URL と SUPABASE_SERVICE_ROLE_KEY を設定してください。")
+    return create_client(url, key)
@@ -0,0 +1,224 @@
+"""セッションごとの重い状態（デコード済み画像・問診・解析結果など）のメモリ管理。
+
+Streamlit のセッションは、タブが開いたままなら状態をずっと保持する。受付が続く日には
+放置されたタブの状態が1つのプロセスに溜まるため、作り直せる大きな値は st.session_state に
+置かず、このモジュールのセッション別の領域に置く。
+
+    heavy = get_registry().session(session_id)
+    images = heavy.get_or_build(("images", captured_at), lambda: download_images(...))
+
+- 値ごとにおおよそのサイズを見積もり、セッション別・プロセス全体の使用量を集計する
+- プロセス全体の上限（VIEWER_SESSION_MEMORY_BUDGET）を超えたら、最後に操作されたのが
+  古いセッションから順に値を捨てる（操作中のセッションの値は捨てない）
+- 捨てた値は、そのセッションが戻ってきたときに get_or_build が作り直す
+- 長く操作のないセッションの領域は丸ごと片付ける
+"""
+
+from __future__ import annotations
+
+import collections
+import mmap
+import os
+import sys
+import threading
+import time
+from typing import Any, Callable
+
+SESSION_MEMORY_BUDGET = int(os.environ.get("VIEWER_SESSION_MEMORY_BUDGET", 512 * 1024 ** 2))
+# 上限を超えたときに、ここまで減らす（毎回の追い出しを避ける）
+EVICT_TARGET_RATIO = 0.8
+# この時間操作のないセッションの領域は片付ける（タブを閉じたセッションを含む）
+SESSION_FORGET_SECONDS = 2 * 3600
+# サイズを見積もるときにたどる入れ子の深さ
+SIZE_MAX_DEPTH = 4
+
+
+def estimate_size(value: Any, _depth: int = 0, _seen: set[int] | None = None) -> int:
+    """値のおおよそのメモリ使用量（バイト）。
+
+    PIL の画像はデコード済みの画素分、mmap はページキャッシュを共有するので 0 とする。
+    """
+    if _seen is None:
+        _seen = set()
+    if id(value) in _seen:
+        return 0
+    _seen.add(id(value))
+
+    if isinstance(value, mmap.mmap):
+        return 0
+    if isinstance(value, (bytes, bytearray, memoryview, str)):
+        return sys.getsizeof(value)
+    # PIL.Image.Image（PIL を読み込まずに判定する）
+    if hasattr(value, "getbands") and hasattr(value, "size"):
+        width, height = value.size
+        return width * height * len(value.getbands()) + sys.getsizeof(value)
+
+    size = sys.getsizeof(value)
+    if _depth >= SIZE_MAX_DEPTH:
+        return size
+    if isinstance(value, dict):
+        size += sum(
+            estimate_size(k, _depth + 1, _seen) + estimate_size(v, _depth + 1, _seen)
+            for k, v in value.items()
+        )
+    elif isinstance(value, (list, tuple, set, frozenset)):
+        size += sum(estimate_size(item, _depth + 1, _seen) for item in value)
+    elif hasattr(type(value), "__slots__"):
+        size += sum(
+            estimate_size(getattr(value, name), _depth + 1, _seen)
+            for name in type(value).__slots__ if hasattr(value, name)
+        )
+    elif hasattr(value, "__dict__"):
+        size += estimate_size(vars(value), _depth + 1, _seen)
+    return size
+
+
+class SessionHeavyState:
+    """1セッション分の作り直せる値。読み書きは SessionMemoryRegistry のロックの中で行う。"""
+
+    def __init__(self, registry: SessionMemoryRegistry, session_id: str):
+        self.registry = registry
+        self.session_id = session_id
+        self.entries: collections.OrderedDict[Any, tuple[Any, int]] = collections.OrderedDict()
+        self.evicted_keys: set = set()
+        self.last_active = time.monotonic()
+        self.light_bytes = 0  # st.session_state 側の状態の見積もり（計測のみ）
+
+    @property
+    def heavy_bytes(self) -> int:
+        return sum(size for _value, size in self.entries.values())
+
+    def get_or_build(self, key, builder: Callable[[], Any]) -> Any:
+        """key の値を返す。なければ（追い出されていれば）builder() で作って保存する。
+
+        builder() が None を返した場合は保存しない。
+        """
+        with self.registry.lock:
+            self.last_active = time.monotonic()
+            item = self.entries.get(key)
+            if item is not None:
+                self.entries.move_to_end(key)
+                self.registry.counters["hits"] += 1
+                return item[0]
+            rebuild = key in self.evicted_keys
+
+        value = builder()
+        if value is None:
+            return None
+        size = estimate_size(value)
+        with self.registry.lock:
+            self.entries[key] = (value, size)
+            self.evicted_keys.discard(key)
+            self.registry.counters["rebuilds" if rebuild else "builds"] += 1
+        self.registry.enforce_budget(active=self)
+        return value
+
+    def get(self, key, default=None):
+        with self.registry.lock:
+            item = self.entries.get(key)
+            return item[0] if item is not None else default
+
+    def discard(self, key) -> None:
+        with self.registry.lock:
+            self.entries.pop(key, None)
+
+
+class SessionMemoryRegistry:
+    """プロセス内の全セッションの重い状態と、その合計に対する上限。"""
+
+    def __init__(self, budget: int = SESSION_MEMORY_BUDGET):
+        self.budget = budget
+        self.lock = threading.RLock()
+        self.sessions: dict[str, SessionHeavyState] = {}
+        self.counters: collections.Counter[str] = collections.Counter()
+
+    def session(self, session_id: str) -> SessionHeavyState:
+        """セッションの領域を返し、操作された時刻を更新する。"""
+        with self.lock:
+            self._forget_idle()
+            heavy = self.sessions.get(session_id)
+            if heavy is None:
+                heavy = self.sessions[session_id] = SessionHeavyState(self, session_id)
+            heavy.last_active = time.monotonic()
+            return heavy
+
+    def measure_light_state(self, session_id: str, state: dict) -> None:
+        """st.session_state に残している状態のサイズを記録する（追い出しはしない）。"""
+        size = estimate_size(state)
+        with self.lock:
+            heavy = self.sessions.get(session_id)
+            if heavy is not None:
+                heavy.light_bytes = size
+
+    def total_bytes(self) -> int:
+        with self.lock:
+            return sum(heavy.heavy_bytes for heavy in self.sessions.values())
+
+    def enforce_budget(self, active: SessionHeavyState | None = None) -> None:
+        """上限を超えていたら、操作の古いセッションから値を捨てて目標まで減らす。"""
+        with self.lock:
+            total = self.total_bytes()
+            if total <= self.budget:
+                return
+            target = self.budget * EVICT_TARGET_RATIO
+            candidates = sorted(
+                (heavy for heavy in self.sessions.values() if heavy is not active and heavy.entries),
+                key=lambda heavy: heavy.last_active,
+            )
+            for heavy in candidates:
+                while heavy.entries and total > target:
+                    key, (_value, size) = heavy.entries.popitem(last=False)
+                    heavy.evicted_keys.add(key)
+                    total -= size
+                    self.counters["evictions"] += 1
+                    self.counters["evicted_bytes"] += size
+                if total <= target:
+                    break
+            if total > self.budget:
+                # 操作中のセッションだけで上限を超えている（その値は捨てない）
+                self.counters["over_budget"] += 1
+
+    def _forget_idle(self) -> None:
+        now = time.monotonic()
+        for session_id in [
+            sid for sid, heavy in self.sessions.items() if now - heavy.last_active > SESSION_FORGET_SECONDS
+        ]:
+            del self.sessions[session_id]
+            self.counters["forgotten_sessions"] += 1
+
+    def metrics(self, top: int = 5) -> dict:
+        with self.lock:
+            now = time.monotonic()
+            sessions = sorted(
+                self.sessions.values(), key=lambda heavy: heavy.heavy_bytes + heavy.light_bytes, reverse=True
+            )
+            return {
+                "sessions": len(self.sessions),
+                "heavy_bytes": self.total_bytes(),
+                "light_bytes": sum(heavy.light_bytes for heavy in self.sessions.values()),
+                "budget_bytes": self.budget,
+                **self.counters,
+                "largest_sessions": [
+                    {
+                        "session": heavy.session_id[:8],
+                        "heavy_bytes": heavy.heavy_bytes,
+                        "light_bytes": heavy.light_bytes,
+                        "entries": len(heavy.entries),
+                        "idle_seconds": round(now - heavy.last_active, 1),
+                    }
+                    for heavy in sessions[:top]
+                ],
+            }
+
+
+_default_registry: SessionMemoryRegistry | None = None
+_default_lock = threading.Lock()
+
+
+def get_registry() -> SessionMemoryRegistry:
+    """プロセス内で共有するレジストリ。"""
+    global _default_registry
+    with _default_lock:
+        if _default_registry is None:
+            _default_registry = SessionMemoryRegistry()
+        return _default_registry
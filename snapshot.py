@@ -0,0 +1,262 @@
+"""結果ページの静的HTMLスナップショット。
+
+解析後の (uuid, 撮影日時) の内容は変わらないため、基本情報・画像・眼底年齢・
+リスク評価・ゲージを自己完結した1枚のHTML（サムネイルは data URI、ゲージは SVG）に
+書き出し、入力の内容ハッシュをファイル名にしてディスクに保存する。
+同じ入力なら再描画せず既存のファイルを返すので、静的ホスティングから
+Streamlit を通さずに配信できる。ハッシュには誕生日も含まれるため、
+uuid だけからファイル名を推測することはできない。
+
+    python snapshot.py --uuid <uuid> --ts <captured_datetime>
+"""
+
+from __future__ import annotations
+
+import argparse
+import base64
+import html
+import os
+import tempfile
+
+from athero_percentiles import (
+    REFERENCE_DIGEST,
+    VisitPeerReport,
+    build_athero_gauge_svg,
+    evaluate_visit,
+    format_relative_comparison_plain_text,
+)
+from records import QuestionnaireRecord, VisitResults, content_hash, visit_content_payload
+from report import download_image, make_thumbnail
+
+SNAPSHOT_VERSION = 2
+
+SNAPSHOT_DIR = os.environ.get(
+    "SNAPSHOT_DIR", os.path.join(os.path.dirname(__file__), ".snapshots")
+)
+
+RISK_STYLES = {
+    "low": ("#d4edda", "#155724", "リスク：低 🟢"),
+    "medium": ("#fff3cd", "#856404", "リスク：中 🟡"),
+    "high": ("#f8d7da", "#721c24", "リスク：高 🔴"),
+}
+
+PAGE_STYLE = """
+body { font-family: sans-serif; max-width: 720px; margin: 0 auto; padding: 16px; color: #262730; }
+h1 { font-size: 1.6em; } h2 { font-size: 1.25em; margin-top: 1.6em; }
+.cols { display: flex; gap: 16px; } .cols > div { flex: 1; }
+.box { border-radius: 6px; padding: 10px 14px; margin: 6px 0; }
+.info { background: #e8f0fe; color: #1c4f91; }
+.warn { background: #fff3cd; color: #856404; }
+.caption { color: #808495; font-size: 0.85em; }
+.metric .label { font-size: 0.9em; } .metric .value { font-size: 1.8em; }
+img { max-width: 100%; border-radius: 4px; }
+hr { border: none; border-top: 1px solid #ddd; margin: 20px 0; }
+"""
+
+
+def snapshot_hash(questionnaire: QuestionnaireRecord, visit: VisitResults) -> str:
+    """スナップショットの入力から内容ハッシュを計算する（描画せずに判定できる）。"""
+    return content_hash({
+        "version": SNAPSHOT_VERSION,
+        "reference": REFERENCE_DIGEST,
+        **visit_content_payload(questionnaire, visit),
+    })
+
+
+def snapshot_path(content_hash: str, root: str = SNAPSHOT_DIR) -> str:
+    return os.path.join(root, content_hash[:2], f"{content_hash}.html")
+
+
+def _risk_block(label: str, evaluation) -> str:
+    background, color, text = RISK_STYLES[evaluation.absolute_level]
+    return (
+        f"<p><strong>{html.escape(label)}</strong></p>"
+        f'<div class="box" style="background:{background};color:{color}">'
+        f"スコア: {evaluation.value:.2f} ({text} )</div>"
+    )
+
+
+def _peer_caption(evaluation) -> str:
+    """左右別の指標の、同年代・同性の中での位置（参照データがある場合のみ）。"""
+    if evaluation is None or evaluation.percentile is None:
+        return ""
+    return (
+        f'<p class="caption">{html.escape(evaluation.peer_label)}の中で「{evaluation.relative_label}」'
+        f"（下から約{evaluation.percentile:.0f}%、n={evaluation.sample_size}件）</p>"
+    )
+
+
+def _info(text: str) -> str:
+    return f'<div class="box info">{html.escape(text)}</div>'
+
+
+def render_snapshot_html(
+    questionnaire: QuestionnaireRecord,
+    visit: VisitResults,
+    thumbnails: dict[str, bytes],
+    peer_report: VisitPeerReport | None = None,
+) -> str:
+    """結果ページと同じ構成の自己完結したHTMLを生成する。thumbnails は眼(R/L) -> JPEG。"""
+    real_age = questionnaire.real_age
+    right, left = visit.right, visit.left
+    if peer_report is None:
+        peer_report = evaluate_visit(questionnaire.gender, real_age, visit)
+    parts: list[str] = []
+
+    parts.append("<h1>健康チェック結果ページ 🩺</h1>")
+    parts.append(
+        '<div class="box warn">⚠️ この結果はAIによる健康リスク推定です。診断ではありません。'
+        "こちらは現在東北大学において開発中のアルゴリズムを使用しております。</div>"
+    )
+    parts.append('<p class="caption">気になる点がある場合は、医療機関にご相談ください。</p>')
+
+    # 基本情報
+    parts.append("<h2>📋 基本情報</h2><ul>")
+    for label, value, unit in (
+        ("性別", questionnaire.gender, ""),
+        ("誕生日", questionnaire.bday, ""),
+        ("身長", questionnaire.height, " cm"),
+        ("体重", questionnaire.weight, " kg"),
+        ("健康状態", questionnaire.health, ""),
+    ):
+        parts.append(f"<li>{label}: {html.escape(str(value or '未登録'))}{unit}</li>")
+    parts.append(f"<li>撮影日: {questionnaire.captured_at.date()}</li></ul>")
+
+    # 撮影画像
+    parts.append('<h2>👁️ 撮影画像</h2><div class="cols">')
+    for eye, caption in (("R", "右目"), ("L", "左目")):
+        thumb = thumbnails.get(eye)
+        if thumb:
+            data_uri = "data:image/jpeg;base64," + base64.b64encode(thumb).decode("ascii")
+            parts.append(
+                f'<div><img src="{data_uri}" alt="{caption}">'
+                f'<p class="caption" style="text-align:center">{caption}</p></div>'
+            )
+        else:
+            parts.append(f"<div>{_info(f'{caption}の画像はありません。')}</div>")
+    parts.append("</div>")
+
+    # 眼底年齢
+    parts.append(f"<h2>👁️ 眼底年齢</h2><p><strong>撮影時年齢</strong>: {real_age}歳</p>")
+    parts.append('<div class="cols">')
+    for result, label in ((right, "右眼"), (left, "左眼")):
+        if result and result.fundus_age is not None:
+            delta = result.fundus_age - real_age
+            delta_color = "#d33" if delta > 0 else "#09ab3b"
+            parts.append(
+                f'<div class="metric"><div class="label">{label}の眼底年齢</div>'
+                f'<div class="value">{result.fundus_age} 歳</div>'
+                f'<div style="color:{delta_color}">{delta:+} 歳</div>'
+                f'{_peer_caption(peer_report.get("fundus_age_delta", result.eye))}</div>'
+            )
+        else:
+            parts.append(f"<div>{_info(f'{label}の年齢データなし')}</div>")
+    parts.append('</div><p class="caption">Δは撮影時年齢との差</p><hr>')
+
+    # 視界の健康リスク
+    parts.append("<h2>視界の健康リスク</h2>")
+    parts.append('<p class="caption">左右の眼でリスクが異なる場合があるため、個別に表示しています。</p>')
+    parts.append('<div class="cols">')
+    for eye, label in (("R", "右眼"), ("L", "左眼")):
+        evaluation = peer_report.get("glaucoma_risk", eye)
+        if evaluation is not None:
+            parts.append(f"<div>{_risk_block(label, evaluation)}{_peer_caption(evaluation)}</div>")
+        else:
+            parts.append(f"<div>{_info(f'{label}のデータなし')}</div>")
+    parts.append("</div><hr>")
+
+    # 血管健康リスク
+    parts.append("<h2>血管健康リスク</h2>")
+    athero = peer_report.get("atherosclerosis_risk")
+    if athero is not None:
+        parts.append(_risk_block("左右の平均", athero))
+        parts.append("<h3>同年代・同性との比較</h3>")
+        parts.append(
+            '<p class="caption">※ 上のスコア（絶対評価）とは別の指標です。'
+            "絶対的なリスクが低くても、同年代・同性の中での位置は異なる場合があります。</p>"
+        )
+        if athero.percentile is not None:
+            parts.append(build_athero_gauge_svg(athero.percentile))
+            parts.append(
+                "<p>"
+                + html.escape(format_relative_comparison_plain_text(athero.peer_label, athero.percentile))
+                + "</p>"
+            )
+            parts.append(f'<p class="caption">（同グループの参考データ: n={athero.sample_size}件）</p>')
+            if athero.sample_size < 30:
+                parts.append(
+                    '<p class="caption">※ 参考データの件数が少ないため、相対位置は参考値としてご覧ください。</p>'
+                )
+        elif peer_report.peer_label is not None:
+            parts.append(_info("この性別・年代に対応する参考データがありません。"))
+        else:
+            parts.append(_info("性別が未登録のため、同年代・同性との比較は表示できません。"))
+    else:
+        parts.append(_info("血管健康リスクのデータがありません。"))
+    parts.append(
+        '<p class="caption">※ 各リスクスコアは0から1の範囲で算出され、'
+        "1に近いほどAIが推定するリスクが高いことを示します。</p>"
+    )
+
+    return (
+        '<!DOCTYPE html><html lang="ja"><head><meta charset="utf-8">'
+        '<meta name="viewport" content="width=device-width, initial-scale=1">'
+        '<meta name="robots" content="noindex">'
+        f"<title>健康チェック結果</title><style>{PAGE_STYLE}</style></head><body>"
+        + "".join(parts)
+        + "</body></html>"
+    )
+
+
+def export_snapshot(
+    questionnaire: QuestionnaireRecord,
+    visit: VisitResults,
+    thumbnails: dict[str, bytes] | None = None,
+    root: str = SNAPSHOT_DIR,
+    peer_report: VisitPeerReport | None = None,
+) -> str:
+    """スナップショットを書き出してパスを返す。同じ内容ハッシュのファイルがあれば再描画しない。"""
+    path = snapshot_path(snapshot_hash(questionnaire, visit), root)
+    if os.path.exists(path):
+        return path
+
+    thumbnails = dict(thumbnails or {})
+    for result in visit.eyes():
+        if result.eye not in thumbnails and result.image_url:
+            img = download_image(result.image_url)
+            if img:
+                thumbnails[result.eye] = make_thumbnail(img)
+
+    document = render_snapshot_html(questionnaire, visit, thumbnails, peer_report)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            f.write(document)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+    return path
+
+
+def main() -> None:
+    from history import fetch_questionnaire_by_timestamp, fetch_visit_results
+    from service_client import create_service_client
+
+    parser = argparse.ArgumentParser(description="結果ページの静的HTMLスナップショットを書き出す")
+    parser.add_argument("--uuid", required=True)
+    parser.add_argument("--ts", required=True, help="撮影日時（questionnaires.timestamp）")
+    parser.add_argument("--out-dir", default=SNAPSHOT_DIR)
+    args = parser.parse_args()
+
+    client = create_service_client()
+    questionnaire = fetch_questionnaire_by_timestamp(client, args.uuid, args.ts)
+    visit = fetch_visit_results(client, args.uuid, args.ts)
+    if questionnaire is None or visit is None:
+        raise SystemExit("指定された撮影日時の問診または解析結果が見つかりません。")
+    print(export_snapshot(questionnaire, visit, root=args.out_dir))
+
+
+if __name__ == "__main__":
+    main()
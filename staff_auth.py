@@ -0,0 +1,78 @@
+"""スタッフ用ページ（admin.py・kiosk.py）とスタッフ用の操作に共通する認証。
+
+スタッフキー（st.secrets の STAFF_KEY）をパスワード欄のフォームで受け取り、一致したら
+セッションに staff_authenticated を立てる。キーは URL やログに残る場所には載せない。
+失敗が続いたときの待ち時間は患者の本人確認と同じ login_guard で数える
+（セッションごとに長く、スタッフキー全体では短く）。
+
+    from staff_auth import require_staff
+    require_staff()  # 認証済みでなければキーの入力欄を出してページを止める
+
+    if not is_staff():
+        staff_sidebar_login()  # 患者用ページで、スタッフだけの表示を有効にする
+"""
+
+from __future__ import annotations
+
+import hmac
+
+import streamlit as st
+from streamlit.runtime.scriptrunner import get_script_run_ctx
+
+from login_guard import get_login_guard
+
+# login_guard で uuid の代わりに使う対象名（スタッフキー全体の失敗回数をこの名前で数える）
+STAFF_LOGIN_SUBJECT = "staff"
+
+
+def staff_key_matches(entered: str | None, staff_key: str | None) -> bool:
+    """入力されたキーがスタッフキーと一致するか（比較は定数時間）。"""
+    if not entered or not staff_key:
+        return False
+    return hmac.compare_digest(str(entered), str(staff_key))
+
+
+def is_staff() -> bool:
+    """このセッションがスタッフキーで認証済みか。"""
+    return bool(st.session_state.get("staff_authenticated"))
+
+
+def _submit_staff_key(entered: str, staff_key: str | None, show_error) -> None:
+    """送信されたキーを login_guard を通して確かめ、一致したらセッションを認証済みにする。"""
+    outcome = get_login_guard().attempt(
+        STAFF_LOGIN_SUBJECT, entered, get_script_run_ctx().session_id,
+        # 一致したときは None 以外を返せばよい（本人確認の「最新の timestamp」の代わり）
+        lambda: "ok" if staff_key_matches(entered, staff_key) else None,
+    )
+    if outcome.status == "ok":
+        st.session_state.staff_authenticated = True
+        st.rerun()
+    if outcome.status == "throttled":
+        show_error(f"試行が続いたため、約{max(1, round(outcome.retry_after))}秒後に再度お試しください。")
+    else:
+        show_error("スタッフキーが正しくありません。")
+
+
+def require_staff() -> None:
+    """スタッフ認証を求める。認証済みでなければ入力欄を出して st.stop() する。"""
+    staff_key = st.secrets.get("STAFF_KEY")
+    if not staff_key:
+        st.error("STAFF_KEY が設定されていません。")
+        st.stop()
+    if is_staff():
+        return
+    with st.form("staff_login"):
+        entered = st.text_input("スタッフキー", type="password")
+        submitted = st.form_submit_button("ログイン")
+    if submitted and entered:
+        _submit_staff_key(entered, staff_key, st.error)
+    st.stop()
+
+
+def staff_sidebar_login(submit_label: str = "スタッフとして有効にする") -> None:
+    """患者用ページのサイドバーにスタッフキーの入力フォームを出す（ページは止めない）。"""
+    with st.sidebar.form("staff_login"):
+        entered = st.text_input("スタッフキー", type="password")
+        submitted = st.form_submit_button(submit_label)
+    if submitted and entered:
+        _submit_staff_key(entered, st.secrets.get("STAFF_KEY"), st.sidebar.error)
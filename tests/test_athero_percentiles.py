@@ -0,0 +1,72 @@
+"""一括版の scores_to_percentiles / evaluate_metric_batch が、1件ずつの score_to_percentile と一致するか。"""
+
+import math
+
+import numpy as np
+import pytest
+
+from athero_percentiles import (
+    ATHERO_PERCENTILE_TABLE,
+    evaluate_metric_batch,
+    get_age_group,
+    lookup_percentiles,
+    score_to_percentile,
+    scores_to_percentiles,
+)
+
+TABLES = sorted(ATHERO_PERCENTILE_TABLE.items())
+
+
+def baseline(gender, age, score):
+    """1件ずつの元の計算（参照データがなければ None）。"""
+    ref_data = lookup_percentiles(gender, get_age_group(age)) if gender is not None else None
+    if ref_data is None:
+        return None
+    return score_to_percentile(score, ref_data["percentiles"])
+
+
+def assert_same(batch, expected):
+    for got, want in zip(batch.tolist(), expected):
+        if want is None or math.isnan(want):
+            assert math.isnan(got)
+        else:
+            assert got == pytest.approx(want, abs=1e-9)
+
+
+def boundary_scores(breakpoints):
+    """十分位そのもの・すぐ上下・表の外・NaN。"""
+    breakpoints = np.asarray(breakpoints, dtype=float)
+    scores = [*breakpoints, *np.nextafter(breakpoints, -np.inf), *np.nextafter(breakpoints, np.inf)]
+    scores += [(breakpoints[i] + breakpoints[i + 1]) / 2 for i in range(len(breakpoints) - 1)]
+    return scores + [-1.0, 0.0, 1.0, 2.0, float("nan"), float("inf"), float("-inf")]
+
+
+@pytest.mark.parametrize("group, ref_data", TABLES, ids=[f"{g}{a}" for (g, a), _ in TABLES])
+def test_boundaries_match_the_loop(group, ref_data):
+    breakpoints = ref_data["percentiles"]
+    scores = boundary_scores(breakpoints)
+    batch = scores_to_percentiles(np.array(scores), np.tile(breakpoints, (len(scores), 1)))
+    assert_same(batch, [score_to_percentile(score, breakpoints) for score in scores])
+
+
+def test_ties_in_the_reference_match_the_loop():
+    breakpoints = [0.0, 0.1, 0.1, 0.1, 0.2, 0.3, 0.3, 0.5, 0.7, 0.9, 1.0]
+    scores = boundary_scores(breakpoints)
+    batch = scores_to_percentiles(np.array(scores), np.tile(breakpoints, (len(scores), 1)))
+    assert_same(batch, [score_to_percentile(score, breakpoints) for score in scores])
+
+
+def test_random_people_match_the_loop():
+    rng = np.random.default_rng(0)
+    size = 5_000
+    genders = rng.choice(["M", "F", None, "X"], size, p=[0.45, 0.45, 0.05, 0.05]).tolist()
+    genders = [None if g == "None" else g for g in genders]
+    # 参照テーブルの外（負の年齢・90歳以上）も混ぜる
+    ages = rng.integers(-5, 110, size).tolist()
+    scores = np.where(rng.random(size) < 0.5, rng.random(size), 10 ** rng.uniform(-9, 0, size))
+    scores[rng.random(size) < 0.02] = np.nan
+    percentiles, labels, sizes, _levels = evaluate_metric_batch("atherosclerosis_risk", genders, ages, scores)
+    expected = [baseline(g, a, s) for g, a, s in zip(genders, ages, scores.tolist())]
+    assert_same(percentiles, expected)
+    assert [label is None for label in labels] == [p is None or math.isnan(p) for p in expected]
+    assert [bool(n) for n in sizes.tolist()] == [p is not None for p in expected]
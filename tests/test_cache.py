@@ -0,0 +1,48 @@
+"""名前空間ごとのサイズ上限（プロセス内 LRU とディスク）と、上限より大きい値の扱い。"""
+
+import pytest
+
+from cache import Cache, DiskBackend, MemoryLRUBackend, NamespaceConfig
+from disk_cache import DiskCache
+
+NAMESPACES = {
+    "small": NamespaceConfig(max_bytes=10_000),
+    "large": NamespaceConfig(max_bytes=1_000_000),
+}
+
+
+@pytest.fixture(params=["memory", "disk"])
+def cache(request, tmp_path):
+    # ディスクの読み出しは mmap なので、比べるときは bytes() にする
+    if request.param == "memory":
+        return Cache(MemoryLRUBackend(), NAMESPACES)
+    return Cache(DiskBackend(DiskCache(str(tmp_path), max_bytes=10 ** 9)), NAMESPACES)
+
+
+def test_namespace_limit_evicts_oldest_in_that_namespace(cache):
+    small, large = cache.namespace("small"), cache.namespace("large")
+    large.set("keep", b"L" * 50_000)
+    for n in range(5):
+        small.set(f"k{n}", bytes([n]) * 3_000)
+    # small は 10,000 バイトまで。古いものから追い出され、large の値は残る
+    assert small.get("k0") is None
+    assert bytes(small.get("k4")) == bytes([4]) * 3_000
+    assert bytes(large.get("keep")) == b"L" * 50_000
+
+
+def test_value_larger_than_the_namespace_is_not_stored(cache):
+    small = cache.namespace("small")
+    small.set("a", b"a" * 100)
+    small.set("huge", b"h" * 20_000)
+    assert small.get("huge") is None
+    assert bytes(small.get("a")) == b"a" * 100
+    assert small.stats()["oversized"] == 1
+
+
+def test_memory_backend_rejects_values_over_the_budget():
+    backend = MemoryLRUBackend()
+    backend.configure_namespace("small", NAMESPACES["small"])
+    backend.set("small", "a", b"a" * 100, None)
+    backend.set("small", "huge", b"h" * 20_000, None)
+    assert backend.get("small", "huge") is None
+    assert backend.get("small", "a") == b"a" * 100
@@ -0,0 +1,124 @@
+"""RespBackend を resp_server のローカル代替サーバーに対して動かす。"""
+
+import threading
+import time
+
+import pytest
+
+from cache import Cache, NamespaceConfig, RespBackend
+from resp_server import RespServer
+
+
+@pytest.fixture
+def server():
+    server = RespServer()
+    server.start_background()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def backend(server):
+    return RespBackend(port=server.port)
+
+
+def test_get_put(backend):
+    backend.set("images", "a", b"\x00\x01payload", None)
+    assert backend.get("images", "a") == b"\x00\x01payload"
+
+
+def test_miss(backend):
+    assert backend.get("images", "missing") is None
+
+
+def test_delete(backend):
+    backend.set("images", "a", b"x", None)
+    backend.delete("images", "a")
+    assert backend.get("images", "a") is None
+
+
+def test_ttl_expires(backend):
+    backend.set("images", "a", b"x", 0.05)
+    assert backend.get("images", "a") == b"x"
+    time.sleep(0.1)
+    assert backend.get("images", "a") is None
+
+
+def test_namespaces_do_not_collide(backend):
+    backend.set("images", "k", b"image", None)
+    backend.set("reports", "k", b"report", None)
+    assert backend.get("images", "k") == b"image"
+    assert backend.get("reports", "k") == b"report"
+
+
+def test_select_db(server):
+    RespBackend(port=server.port, db=1).set("images", "a", b"db1", None)
+    assert RespBackend(port=server.port, db=0).get("images", "a") is None
+    assert RespBackend(port=server.port, db=1).get("images", "a") == b"db1"
+
+
+def test_error_reply_is_a_miss(backend):
+    # サーバーのエラー応答でページを止めず、接続を張り直して次の呼び出しは通る
+    assert backend._safe_command("NOSUCHCOMMAND") is None
+    assert backend.errors == 1
+    backend.set("images", "a", b"x", None)
+    assert backend.get("images", "a") == b"x"
+
+
+def test_unreachable_server_is_a_miss():
+    server = RespServer()
+    port = server.port
+    server.server_close()
+    backend = RespBackend(port=port, timeout=0.2)
+    assert backend.get("images", "a") is None
+    backend.set("images", "a", b"x", None)
+    assert backend.errors == 2
+
+
+def test_namespaced_cache_over_resp(backend):
+    cache = Cache(backend, {"gauges": NamespaceConfig(codec="json", ttl=60)})
+    gauges = cache.namespace("gauges")
+    assert gauges.get_or_set("50", lambda: {"percentile": 50}) == {"percentile": 50}
+    assert gauges.get("50") == {"percentile": 50}
+    stats = gauges.stats()
+    assert (stats["hits"], stats["misses"], stats["sets"]) == (1, 1, 1)
+
+
+def test_unshared_namespace_stays_in_process(backend):
+    cache = Cache(backend, {"rows": NamespaceConfig(codec="json", shared=False)})
+    cache.namespace("rows").set("q", {"bday": "1970-01-01"})
+    assert cache.namespace("rows").get("q") == {"bday": "1970-01-01"}
+    assert backend.get("rows", "q") is None
+
+
+def test_incr_counts_and_expires(backend):
+    assert backend.incr("login", "n", 0.05) == 1
+    assert backend.incr("login", "n", 0.05) == 2
+    assert backend.get("login", "n") == b"2"
+    time.sleep(0.1)
+    assert backend.incr("login", "n", None) == 1
+
+
+def test_concurrent_incr_loses_no_increments(server):
+    backend = RespBackend(port=server.port)
+
+    def bump():
+        for _ in range(50):
+            backend.incr("login", "n", 60)
+
+    threads = [threading.Thread(target=bump) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert backend.get("login", "n") == b"200"
+
+
+def test_namespaces_without_ttl_get_a_default_ttl(server, backend):
+    from cache import RESP_DEFAULT_TTL
+
+    Cache(backend, {"barcodes": NamespaceConfig(ttl=None)}).namespace("barcodes").set("b", b"png")
+    store = server.store.db(0)
+    _value, expires_at = store[b"viewer:barcodes:b"]
+    assert expires_at is not None and expires_at - time.monotonic() == pytest.approx(RESP_DEFAULT_TTL, abs=5)
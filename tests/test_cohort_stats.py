@@ -0,0 +1,68 @@
+"""参照テーブルから引いた標本で、CohortAggregator の PSI と十分位が参照と一致するか。"""
+
+import numpy as np
+import pytest
+
+from athero_percentiles import AGE_GROUPS, ATHERO_PERCENTILE_TABLE, GENDERS, PERCENTILE_LABELS
+from cohort_stats import PSI_WARN, CohortAggregator, reference_shares
+
+SAMPLES_PER_GROUP = 20_000
+
+
+def sample_reference(breakpoints, size, rng):
+    """参照の十分位を区分線形の分位関数とみなして標本を引く。"""
+    return np.interp(rng.uniform(0, 100, size), PERCENTILE_LABELS, breakpoints)
+
+
+@pytest.fixture(scope="module")
+def aggregator():
+    rng = np.random.default_rng(0)
+    aggregator = CohortAggregator()
+    histogram = aggregator.histograms["atherosclerosis_risk"]
+    for (gender, age_group), ref_data in ATHERO_PERCENTILE_TABLE.items():
+        values = sample_reference(ref_data["percentiles"], SAMPLES_PER_GROUP, rng)
+        gender_idx = np.full(len(values), GENDERS.index(gender))
+        age_idx = np.full(len(values), AGE_GROUPS.index(age_group))
+        histogram.add(gender_idx, age_idx, values)
+    return aggregator
+
+
+def test_reference_sample_has_psi_near_zero_in_every_group(aggregator):
+    rows = aggregator.group_rows("atherosclerosis_risk")
+    assert len(rows) == len(ATHERO_PERCENTILE_TABLE)
+    for row in rows:
+        assert row["n"] == SAMPLES_PER_GROUP
+        assert row["psi"] < PSI_WARN / 10, row["group"]
+
+
+def test_deciles_resolve_small_risks(aggregator):
+    rows = {row["group"]: row for row in aggregator.group_rows("atherosclerosis_risk")}
+    reference = ATHERO_PERCENTILE_TABLE[("F", 50)]["percentiles"]
+    deciles = rows["50代・女性"]["deciles"]
+    # 対数ビン1つ分（約5%）と標本のばらつきの範囲で参照の十分位に一致する
+    for estimate, expected in zip(deciles[1:-1], reference[1:-1]):
+        assert estimate == pytest.approx(expected, rel=0.1)
+
+
+def test_reference_shares_without_ties():
+    assert np.allclose(reference_shares(np.linspace(0, 1, 11)), 0.1)
+
+
+def test_reference_shares_with_tied_deciles():
+    # 30〜50 パーセンタイルが同じ値なら、その値を含む区間に 20% + 10% が入る
+    shares = reference_shares(ATHERO_PERCENTILE_TABLE[("F", 20)]["percentiles"])
+    assert shares.sum() == pytest.approx(1.0)
+    assert shares[3] == shares[4] == 0
+    assert shares[5] == pytest.approx(0.3)
+
+
+def test_shifted_sample_is_flagged():
+    rng = np.random.default_rng(1)
+    aggregator = CohortAggregator()
+    ref_data = ATHERO_PERCENTILE_TABLE[("M", 60)]
+    values = sample_reference(ref_data["percentiles"], SAMPLES_PER_GROUP, rng) * 3
+    aggregator.histograms["atherosclerosis_risk"].add(
+        np.zeros(len(values), dtype=np.int64), np.full(len(values), AGE_GROUPS.index(60)), values
+    )
+    row = next(r for r in aggregator.group_rows("atherosclerosis_risk") if r["group"] == "60代・男性")
+    assert row["psi"] > PSI_WARN
@@ -0,0 +1,102 @@
+"""DiskCache の LRU 追い出し・期限・incr・本体の共有と、複数プロセスからの同時書き込み。"""
+
+import multiprocessing
+import os
+import time
+
+import pytest
+
+from disk_cache import EVICT_TARGET_RATIO, DiskCache
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return DiskCache(str(tmp_path), max_bytes=10_000)
+
+
+def blob_files(root):
+    return sorted(name for _dir, _dirs, files in os.walk(os.path.join(root, "objects")) for name in files)
+
+
+def test_put_get(cache):
+    cache.put("a", b"payload")
+    assert bytes(cache.get("a")) == b"payload"
+    assert "a" in cache
+    assert cache.get("missing") is None
+
+
+def test_eviction_keeps_the_key_just_written(cache):
+    for n in range(3):
+        cache.put(f"k{n}", bytes([n]) * 4_000)
+        time.sleep(0.01)
+    # 12,000 > 10,000 なので、書いたばかりの k2 を残して古い方から上限の90%以下まで追い出す
+    assert cache.get("k0") is None
+    assert bytes(cache.get("k2")) == bytes([2]) * 4_000
+    assert cache.stats()["bytes"] <= cache.max_bytes * EVICT_TARGET_RATIO
+
+
+def test_oversized_value_survives_its_own_write(cache):
+    cache.put("small", b"s" * 100)
+    cache.put("big", b"b" * 20_000)
+    assert bytes(cache.get("big")) == b"b" * 20_000
+    assert cache.get("small") is None
+
+
+def test_ttl_expiry_removes_the_entry_and_blob(cache, tmp_path):
+    cache.put("a", b"short-lived", ttl=0.05)
+    assert bytes(cache.get("a")) == b"short-lived"
+    time.sleep(0.1)
+    assert cache.get("a") is None
+    assert "a" not in cache
+    assert blob_files(str(tmp_path)) == []
+
+
+def test_shared_blob_is_removed_with_its_last_key(cache, tmp_path):
+    cache.put("a", b"same")
+    cache.put("b", b"same")
+    assert len(blob_files(str(tmp_path))) == 1
+    cache.delete("a")
+    assert bytes(cache.get("b")) == b"same"
+    cache.delete("b")
+    assert blob_files(str(tmp_path)) == []
+    assert cache.stats()["blobs"] == 0
+
+
+def test_incr(cache):
+    assert cache.incr("n") == 1
+    assert cache.incr("n") == 2
+    assert bytes(cache.get("n")) == b"2"
+    cache.incr("t", ttl=0.05)
+    time.sleep(0.1)
+    assert cache.incr("t") == 1
+
+
+def _writer(root, worker, count, max_bytes):
+    cache = DiskCache(root, max_bytes=max_bytes)
+    for n in range(count):
+        cache.put(f"w{worker}-{n}", os.urandom(500))
+        cache.incr("counter")
+
+
+def test_concurrent_processes_keep_index_and_files_consistent(tmp_path):
+    root, workers, count, max_bytes = str(tmp_path), 4, 40, 20_000
+    DiskCache(root, max_bytes=max_bytes)
+    context = multiprocessing.get_context("spawn")
+    processes = [context.Process(target=_writer, args=(root, w, count, max_bytes)) for w in range(workers)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join(60)
+        assert process.exitcode == 0
+
+    cache = DiskCache(root, max_bytes=max_bytes)
+    # incr は BEGIN IMMEDIATE の中で数えるので増分が失われない
+    assert bytes(cache.get("counter")) == str(workers * count).encode()
+    stats = cache.stats()
+    assert stats["bytes"] <= max_bytes
+    # 索引の本体とファイルが一致し、一時ファイルも残らない
+    conn = cache._conn()
+    digests = sorted(row[0] for row in conn.execute("SELECT digest FROM blobs"))
+    assert blob_files(root) == digests
+    orphans = conn.execute("SELECT COUNT(*) FROM entries WHERE digest NOT IN (SELECT digest FROM blobs)").fetchone()
+    assert orphans[0] == 0
@@ -0,0 +1,160 @@
+"""run_export の再開と、書き出しを確定してから状態ファイルを進める順序。"""
+
+import csv
+import json
+
+import pytest
+
+import export
+from export import fetch_latest_feedback
+from visit_stream import StreamCursor, VisitBatch, group_visits, index_questionnaires
+
+VISITS = 6
+
+
+def make_batches():
+    """1撮影1バッチ。撮影日時の昇順で uuid-0 … uuid-5。"""
+    batches = []
+    for n in range(VISITS):
+        captured = f"2025-06-0{n + 1}T09:30:00+00:00"
+        rows = [
+            {"questionnaire_uuid": f"uuid-{n}", "captured_datetime": captured, "eye": eye, "image_url": None,
+             "fundus_age": 50 + n, "glaucoma_risk": 0.1, "atherosclerosis_risk": 0.001}
+            for eye in ("L", "R")
+        ]
+        questionnaires = index_questionnaires([{
+            "uuid": f"uuid-{n}", "bday": "1975-04-01", "gender": "F", "height": 160, "weight": 50,
+            "health": None, "timestamp": captured,
+        }])
+        batches.append(VisitBatch(group_visits(rows, questionnaires), StreamCursor.from_row(rows[-1]), len(rows)))
+    return batches
+
+
+class Source:
+    """iter_visit_batches の代わりに make_batches() を after の次から返す。fail_at 番目で止まる。"""
+
+    def __init__(self, fail_at=None):
+        self.fail_at = fail_at
+        self.after = []
+
+    def __call__(self, client, after=None, page_size=None):
+        self.after.append(after.to_dict() if after else None)
+        for n, batch in enumerate(make_batches()):
+            if after is not None and batch.cursor.captured_datetime <= after.captured_datetime:
+                continue
+            if n == self.fail_at:
+                raise ConnectionError("connection reset")
+            yield batch
+
+
+@pytest.fixture(autouse=True)
+def no_feedback(monkeypatch):
+    monkeypatch.setattr(export, "fetch_latest_feedback", lambda client, uuids: {})
+
+
+def exported_uuids(path):
+    with open(path, newline="", encoding="utf-8") as f:
+        return [row["uuid"] for row in csv.DictReader(f)]
+
+
+@pytest.mark.parametrize("fmt", ["csv", "parquet"])
+def test_writers_share_the_commit_interface(tmp_path, fmt):
+    writer = export.EXPORT_WRITERS[fmt](str(tmp_path / "out"), {})
+    assert writer.pending() == 0 and writer.rows_per_part >= 1
+    writer.write([dict.fromkeys(export.EXPORT_COLUMNS, None)])
+    assert writer.pending() == 1
+    writer.flush({})
+    assert writer.pending() == 0
+    writer.close()
+
+
+def test_csv_resume_after_failure(tmp_path, monkeypatch):
+    out, state_path = str(tmp_path / "out.csv"), str(tmp_path / "state.json")
+    monkeypatch.setattr(export, "iter_visit_batches", Source(fail_at=3))
+    with pytest.raises(ConnectionError):
+        export.run_export(None, out, "csv", state_path, resume=False)
+    state = json.load(open(state_path, encoding="utf-8"))
+    assert state["rows"] == 3 and state["cursor"]["uuid"] == "uuid-2"
+    assert "pending_cursor" not in state
+
+    # 確定後に書きかけた分は再開時に切り詰められる
+    with open(out, "a", encoding="utf-8") as f:
+        f.write("uuid-partial,")
+    source = Source()
+    monkeypatch.setattr(export, "iter_visit_batches", source)
+    state = export.run_export(None, out, "csv", state_path, resume=True)
+    assert source.after[0]["uuid"] == "uuid-2"
+    assert state["rows"] == VISITS
+    assert exported_uuids(out) == [f"uuid-{n}" for n in range(VISITS)]
+
+
+def test_state_is_not_advanced_when_the_flush_fails(tmp_path, monkeypatch):
+    out, state_path = str(tmp_path / "out.csv"), str(tmp_path / "state.json")
+    monkeypatch.setattr(export, "iter_visit_batches", Source())
+    flushes = []
+    original_flush = export.CsvExportWriter.flush
+
+    def failing_flush(self, state):
+        flushes.append(1)
+        if len(flushes) == 3:
+            raise OSError("disk full")
+        original_flush(self, state)
+
+    monkeypatch.setattr(export.CsvExportWriter, "flush", failing_flush)
+    with pytest.raises(OSError):
+        export.run_export(None, out, "csv", state_path, resume=False)
+    state = json.load(open(state_path, encoding="utf-8"))
+    # 3回目の確定に失敗したので、状態ファイルは2撮影目までを指したまま
+    assert state["cursor"]["uuid"] == "uuid-1"
+
+
+def test_parquet_resume_writes_each_row_once(tmp_path, monkeypatch):
+    pq = pytest.importorskip("pyarrow.parquet")
+    out, state_path = str(tmp_path / "parts"), str(tmp_path / "state.json")
+    monkeypatch.setattr(export, "iter_visit_batches", Source(fail_at=5))
+    with pytest.raises(ConnectionError):
+        export.run_export(None, out, "parquet", state_path, resume=False, rows_per_part=2)
+    # 5撮影目は確定前に止まったので、パートは2つ（4撮影）だけ
+    state = json.load(open(state_path, encoding="utf-8"))
+    assert state["parquet_parts"] == 2 and state["cursor"]["uuid"] == "uuid-3"
+
+    monkeypatch.setattr(export, "iter_visit_batches", Source())
+    export.run_export(None, out, "parquet", state_path, resume=True, rows_per_part=2)
+    uuids = pq.read_table(out).column("uuid").to_pylist()
+    assert sorted(uuids) == [f"uuid-{n}" for n in range(VISITS)]
+
+
+def test_resume_rejects_another_format(tmp_path, monkeypatch):
+    state_path = str(tmp_path / "state.json")
+    monkeypatch.setattr(export, "iter_visit_batches", Source())
+    export.run_export(None, str(tmp_path / "out.csv"), "csv", state_path, resume=False)
+    with pytest.raises(ValueError):
+        export.run_export(None, str(tmp_path / "parts"), "parquet", state_path, resume=True)
+
+
+def test_feedback_is_fetched_in_chunks():
+    class Client:
+        def __init__(self):
+            self.chunks = []
+
+        def table(self, name):
+            return self
+
+        def select(self, columns):
+            return self
+
+        def in_(self, column, values):
+            self.chunks.append(list(values))
+            return self
+
+        def order(self, column):
+            return self
+
+        def execute(self):
+            return type("Response", (), {"data": [{"uuid": self.chunks[-1][0], "ux_rating": 5}]})()
+
+    client = Client()
+    uuids = [f"uuid-{n:03d}" for n in range(250)]
+    result = fetch_latest_feedback(client, uuids)
+    assert [len(chunk) for chunk in client.chunks] == [100, 100, 50]
+    assert sorted(result) == ["uuid-000", "uuid-100", "uuid-200"]
@@ -0,0 +1,62 @@
+"""LoginGuard の待ち時間を (uuid, クライアント) と uuid に分けて数える。"""
+
+import threading
+
+import pytest
+
+from cache import Cache, DiskBackend, MemoryLRUBackend, NamespaceConfig
+from disk_cache import DiskCache
+from login_guard import (
+    FREE_FAILURES_PER_CLIENT,
+    FREE_FAILURES_PER_UUID,
+    UUID_BACKOFF_MAX_SECONDS,
+    LoginGuard,
+)
+
+NAMESPACES = {"login": NamespaceConfig(ttl=60, codec="json")}
+
+
+@pytest.fixture
+def guard():
+    return LoginGuard(Cache(MemoryLRUBackend(), NAMESPACES).namespace("login"))
+
+
+def fail(guard, client_id, bday="1900-01-01"):
+    return guard.attempt("uuid-1", bday, client_id, lambda: None)
+
+
+def test_failing_client_is_throttled(guard):
+    for n in range(FREE_FAILURES_PER_CLIENT + 1):
+        assert fail(guard, "attacker", f"1900-01-{n + 1:02d}").status == "not_found"
+    outcome = fail(guard, "attacker", "1900-02-01")
+    assert (outcome.status, outcome.source) == ("throttled", "client_backoff")
+
+
+def test_other_client_is_not_locked_out(guard):
+    for n in range(FREE_FAILURES_PER_CLIENT + 1):
+        fail(guard, "attacker", f"1900-01-{n + 1:02d}")
+    outcome = guard.attempt("uuid-1", "1980-01-01", "patient", lambda: "2025-06-01T09:30:00")
+    assert outcome.status == "ok"
+
+
+def test_uuid_backoff_is_short(guard):
+    # セッションを替えながら失敗を続けても、uuid ごとの待ち時間は上限で止まる
+    for n in range(FREE_FAILURES_PER_UUID + 20):
+        outcome = fail(guard, f"session-{n}", f"1900-01-{n % 28 + 1:02d}")
+    assert outcome.source == "uuid_backoff"
+    assert outcome.retry_after <= UUID_BACKOFF_MAX_SECONDS
+
+
+def test_concurrent_failures_are_all_counted(tmp_path):
+    cache = Cache(DiskBackend(DiskCache(str(tmp_path))), NAMESPACES).namespace("login")
+
+    def bump():
+        for _ in range(25):
+            cache.incr("n")
+
+    threads = [threading.Thread(target=bump) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert cache.get("n") == 100
@@ -0,0 +1,82 @@
+"""qa_scan の QA_CHECKS の各検査と、読めない値で止まらないこと。"""
+
+import io
+import json
+
+import pytest
+
+from qa_scan import QA_CHECKS, QaScanReport, scan_batch
+from visit_stream import VisitBatch, group_visits, index_questionnaires
+
+UUID = "00000000-0000-0000-0000-000000000001"
+CAPTURED = "2025-06-01T09:30:00+00:00"
+
+
+def result_row(eye, **overrides):
+    row = {
+        "questionnaire_uuid": UUID, "captured_datetime": CAPTURED, "eye": eye,
+        "image_url": f"https://example.test/{eye}.jpg",
+        "fundus_age": 52, "glaucoma_risk": 0.2, "atherosclerosis_risk": 0.01,
+    }
+    row.update(overrides)
+    return row
+
+
+def questionnaire_row(**overrides):
+    row = {
+        "uuid": UUID, "bday": "1975-04-01", "gender": "M", "height": 170, "weight": 65,
+        "health": None, "timestamp": CAPTURED,
+    }
+    row.update(overrides)
+    return row
+
+
+def scan(rows, questionnaires=(questionnaire_row(),)):
+    visits = group_visits(rows, index_questionnaires(list(questionnaires)))
+    return scan_batch(VisitBatch(visits, None, len(rows)))
+
+
+def checks(anomalies):
+    return sorted({anomaly.check for anomaly in anomalies})
+
+
+def test_clean_visit_has_no_anomalies():
+    assert scan([result_row("L"), result_row("R")]) == []
+
+
+@pytest.mark.parametrize("rows, questionnaires, expected", [
+    ([result_row("L"), result_row("R")], [], "missing_questionnaire"),
+    ([result_row("L"), result_row("R")], [questionnaire_row(timestamp="2025-06-01T18:30:00+09:00")],
+     "timestamp_text_mismatch"),
+    ([result_row("L"), result_row("R")], [questionnaire_row(bday=None)], "missing_bday"),
+    ([result_row("L"), result_row("R")], [questionnaire_row(bday="1975-13-45")], "invalid_bday"),
+    ([result_row("L", fundus_age=150), result_row("R", fundus_age=150)], [questionnaire_row(bday="1870-01-01")],
+     "implausible_age"),
+    ([result_row("L"), result_row("R")], [questionnaire_row(gender="X")], "unknown_gender"),
+    ([result_row("R")], [questionnaire_row()], "missing_eye"),
+    ([result_row("L"), result_row("R"), result_row("X")], [questionnaire_row()], "unassigned_rows"),
+    ([result_row("L"), result_row("R", glaucoma_risk=None)], [questionnaire_row()], "missing_score"),
+    ([result_row("L"), result_row("R", atherosclerosis_risk=1.5)], [questionnaire_row()], "risk_out_of_range"),
+    ([result_row("L"), result_row("R", fundus_age=80)], [questionnaire_row()], "fundus_age_gap"),
+    ([result_row("L"), result_row("R", image_url="")], [questionnaire_row()], "missing_image"),
+    ([result_row("L", captured_datetime="yesterday"), result_row("R", captured_datetime="yesterday")],
+     [questionnaire_row()], "invalid_captured_datetime"),
+])
+def test_each_check(rows, questionnaires, expected):
+    assert expected in QA_CHECKS
+    assert checks(scan(rows, questionnaires)) == [expected]
+
+
+def test_invalid_bday_does_not_stop_the_scan():
+    anomalies = scan([result_row("L"), result_row("R")], [questionnaire_row(bday="not a date")])
+    assert [(a.check, a.uuid) for a in anomalies] == [("invalid_bday", UUID)]
+
+
+def test_report_counts_missing_captured_datetime_beyond_the_written_rows():
+    out = io.StringIO()
+    report = QaScanReport(out, max_per_check=1)
+    rows = [{"questionnaire_uuid": UUID, "eye": "R"}, {"questionnaire_uuid": UUID, "eye": "L"}]
+    report.add_missing_captured_datetime(rows, total=5)
+    assert report.summary()["anomalies"] == {"missing_captured_datetime": 5}
+    written = [json.loads(line) for line in out.getvalue().splitlines()]
+    assert written == [{"check": "missing_captured_datetime", "uuid": UUID, "captured_datetime": None, "eye": "R"}]
@@ -0,0 +1,143 @@
+"""ReportArchive の保管・索引の統合・詰め直し・照合・索引の作り直し。"""
+
+import datetime
+import hashlib
+import os
+
+import pytest
+
+import report_archive
+from report_archive import PACK_MAGIC, RECORD_HEADER, ArchiveIntegrityError, ReportArchive, pack_key
+
+CAPTURED_AT = datetime.datetime(2025, 4, 1, 9, 30, tzinfo=datetime.timezone.utc)
+
+
+def report(n: int) -> tuple[str, datetime.datetime, str, bytes]:
+    data = f"%PDF-1.4 report {n} ".encode("ascii") * (n % 7 + 1)
+    uuid = f"00000000-0000-0000-0000-{n:012d}"
+    return uuid, CAPTURED_AT + datetime.timedelta(days=n % 3), hashlib.sha256(data).hexdigest(), data
+
+
+@pytest.fixture
+def archive(tmp_path):
+    return ReportArchive(str(tmp_path))
+
+
+def fill(archive, count):
+    reports = [report(n) for n in range(count)]
+    for uuid, captured_at, content_hash, data in reports:
+        archive.put(uuid, captured_at, content_hash, data)
+    return reports
+
+
+def assert_all_readable(archive, reports):
+    for uuid, captured_at, content_hash, data in reports:
+        assert bytes(archive.get(uuid, captured_at, content_hash)) == data
+
+
+def test_put_get(archive):
+    uuid, captured_at, content_hash, data = report(1)
+    entry = archive.put(uuid, captured_at, content_hash, data)
+    assert bytes(archive.get(uuid, captured_at, content_hash)) == data
+    # 同じキーは書き直さない
+    assert archive.put(uuid, captured_at, content_hash, data).offset == entry.offset
+    assert archive.stats()["pending"] == 1
+    assert archive.get(uuid, captured_at, "00" * 32) is None
+
+
+def test_merge_at_threshold(archive, monkeypatch):
+    monkeypatch.setattr(report_archive, "MERGE_THRESHOLD", 5)
+    reports = fill(archive, 12)
+    stats = archive.stats()
+    # 5件ごとに index.dat へ統合され、残りが index.log に残る
+    assert (stats["indexed"], stats["pending"]) == (10, 2)
+    assert_all_readable(archive, reports)
+    assert [entry.key for entry in archive.entries()] == sorted(pack_key(*r[:3]) for r in reports)
+
+
+def test_other_process_merge_is_seen(archive, tmp_path):
+    reports = fill(archive, 3)
+    other = ReportArchive(str(tmp_path))
+    assert_all_readable(other, reports)
+    archive.merge()
+    reports += fill(archive, 5)[3:]
+    assert_all_readable(other, reports)
+    assert other.stats()["indexed"] == 3
+
+
+def test_compact_drops_and_repacks(tmp_path):
+    archive = ReportArchive(str(tmp_path), pack_max_bytes=400)
+    reports = fill(archive, 10)
+    old_packs = archive.pack_numbers()
+    assert len(old_packs) > 1
+    drop = reports[0][0]
+    result = archive.compact(keep=lambda entry: entry.uuid != drop)
+    assert (result["entries"], result["dropped"], result["corrupt"]) == (9, 1, [])
+    assert not set(old_packs) & set(archive.pack_numbers())
+    assert result["bytes_after"] < result["bytes_before"]
+    assert archive.get(*reports[0][:3]) is None
+    assert_all_readable(archive, reports[1:])
+    assert archive.verify()["ok"] == 9
+
+
+def test_verify_reports_corrupt_records(archive):
+    reports = fill(archive, 3)
+    entry = archive.entries()[1]
+    with open(archive.pack_path(entry.pack), "r+b") as f:
+        f.seek(entry.offset + RECORD_HEADER.size)
+        f.write(b"X")
+    result = archive.verify()
+    assert (result["ok"], len(result["corrupt"])) == (2, 1)
+    assert result["corrupt"][0]["uuid"] == entry.uuid
+    # 走査もそこで止まるので、後ろのレコードを確かめられない。force のときだけ壊れたものを除いて詰め直す
+    assert result["torn_tails"] == [{"pack": entry.pack, "offset": entry.offset}]
+    with pytest.raises(ArchiveIntegrityError):
+        archive.compact()
+    compacted = archive.compact(force=True)
+    assert (compacted["entries"], len(compacted["corrupt"])) == (2, 1)
+    assert_all_readable(archive, [r for r in reports if r[0] != entry.uuid])
+
+
+def test_compact_refuses_unindexed_records(archive):
+    reports = fill(archive, 2)
+    # 本体を書いた後、索引に載せる前に落ちたレコード
+    uuid, captured_at, content_hash, data = report(99)
+    archive._append_record(archive.pack_numbers()[-1], pack_key(uuid, captured_at, content_hash), data)
+    assert archive.verify()["unindexed_records"] == 1
+    with pytest.raises(ArchiveIntegrityError) as excinfo:
+        archive.compact()
+    assert excinfo.value.report["unindexed_records"] == 1
+    assert archive.get(uuid, captured_at, content_hash) is None
+
+    # 索引を作り直せば拾える
+    assert archive.rebuild_index() == 3
+    assert bytes(archive.get(uuid, captured_at, content_hash)) == data
+    assert archive.compact()["entries"] == 3
+    assert_all_readable(archive, reports)
+
+
+def test_compact_refuses_torn_tail_unless_forced(archive):
+    reports = fill(archive, 2)
+    pack = archive.pack_numbers()[-1]
+    with open(archive.pack_path(pack), "ab") as f:
+        f.write(PACK_MAGIC + b"\x10\x00")
+    tail = archive.verify()["torn_tails"]
+    assert tail == [{"pack": pack, "offset": os.path.getsize(archive.pack_path(pack)) - 6}]
+    with pytest.raises(ArchiveIntegrityError):
+        archive.compact()
+    result = archive.compact(force=True)
+    assert result["entries"] == 2
+    assert archive.verify()["torn_tails"] == []
+    assert_all_readable(archive, reports)
+
+
+def test_rebuild_index_after_losing_it(archive, monkeypatch):
+    monkeypatch.setattr(report_archive, "MERGE_THRESHOLD", 4)
+    reports = fill(archive, 6)
+    os.unlink(archive.index_path)
+    os.unlink(archive.log_path)
+    assert archive.get(*reports[0][:3]) is None
+    assert archive.rebuild_index() == 6
+    assert_all_readable(archive, reports)
+    result = archive.verify()
+    assert (result["ok"], result["unindexed_records"], result["torn_tails"]) == (6, 0, [])
@@ -0,0 +1,112 @@
+"""ResultWatcher を LocalResultSource で動かす（解析待ち → 到着 → ページの更新）。"""
+
+import datetime
+import threading
+import time
+
+import pytest
+
+from result_watch import LocalResultSource, ResultSource, ResultWatcher
+
+CAPTURED_AT = datetime.datetime(2025, 6, 1, 9, 30, tzinfo=datetime.timezone.utc)
+
+
+class CountingSource(ResultSource):
+    """問い合わせの回数と、問い合わせで渡された撮影を記録する。"""
+
+    def __init__(self, inner: ResultSource):
+        self.inner = inner
+        self.polls: list[list] = []
+        self.polled = threading.Event()
+
+    def arrived(self, keys):
+        self.polls.append(sorted(keys))
+        self.polled.set()
+        return self.inner.arrived(keys)
+
+
+@pytest.fixture
+def source():
+    return LocalResultSource()
+
+
+def test_pending_until_result_arrives(source):
+    watcher = ResultWatcher(source, interval=0.02)
+    watch = watcher.watch("uuid-1", CAPTURED_AT)
+    assert not watch.ready
+    assert not watch.wait(0.1)
+
+    source.add("uuid-1", CAPTURED_AT)
+    assert watch.wait(1.0)
+    # 結果ページのフラグメントは次の実行で ready を見てページ全体を再実行する
+    assert watcher.watch("uuid-1", CAPTURED_AT).ready
+    assert watcher.metrics()["arrived"] == 1
+
+
+def test_other_visits_stay_pending(source):
+    watcher = ResultWatcher(source, interval=0.02)
+    waiting = watcher.watch("uuid-1", CAPTURED_AT)
+    other = watcher.watch("uuid-1", CAPTURED_AT + datetime.timedelta(days=1))
+
+    source.add("uuid-1", CAPTURED_AT)
+    assert waiting.wait(1.0)
+    assert not other.ready
+
+
+def test_sessions_share_watches_and_polls(source):
+    counting = CountingSource(source)
+    watcher = ResultWatcher(counting, interval=0.02)
+    watches = [watcher.watch(f"uuid-{n}", CAPTURED_AT) for n in range(50)]
+    assert watcher.watch("uuid-0", CAPTURED_AT) is watches[0]
+
+    # 待っている全撮影を1回の問い合わせでまとめて確認する（最初の watch() で起動した直後の
+    # 1回だけは、登録が揃う前の撮影で問い合わせることがある）
+    for _ in range(50):
+        if any(len(keys) == 50 for keys in counting.polls):
+            break
+        time.sleep(0.02)
+    assert any(len(keys) == 50 for keys in counting.polls)
+
+
+def test_arrived_visits_are_not_polled_again(source):
+    counting = CountingSource(source)
+    watcher = ResultWatcher(counting, interval=0.02)
+    watch = watcher.watch("uuid-1", CAPTURED_AT)
+    source.add("uuid-1", CAPTURED_AT)
+    assert watch.wait(1.0)
+
+    polls = len(counting.polls)
+    watcher.watch("uuid-2", CAPTURED_AT)
+    counting.polled.clear()
+    assert counting.polled.wait(1.0)
+    assert all(("uuid-1", CAPTURED_AT) not in keys for keys in counting.polls[polls:])
+
+
+def test_idle_watches_expire(source):
+    watcher = ResultWatcher(source, interval=0.02, idle_seconds=0.05)
+    watcher.watch("uuid-1", CAPTURED_AT)
+    for _ in range(50):
+        if watcher.metrics().get("expired"):
+            break
+        time.sleep(0.02)
+    metrics = watcher.metrics()
+    assert metrics["expired"] == 1
+    assert metrics["watching"] == 0
+
+
+def test_poll_errors_keep_watching(source):
+    class FlakySource(ResultSource):
+        def __init__(self):
+            self.calls = 0
+
+        def arrived(self, keys):
+            self.calls += 1
+            if self.calls == 1:
+                raise ConnectionError("temporarily unavailable")
+            return source.arrived(keys)
+
+    watcher = ResultWatcher(FlakySource(), interval=0.02)
+    watch = watcher.watch("uuid-1", CAPTURED_AT)
+    source.add("uuid-1", CAPTURED_AT)
+    assert watch.wait(1.0)
+    assert watcher.metrics()["errors"] == 1
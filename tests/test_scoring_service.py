@@ -0,0 +1,166 @@
+"""scoring_service を同じプロセスで起動し、HTTP で評価・入力の検査・過負荷時の応答を確かめる。"""
+
+import http.client
+import json
+import random
+import time
+
+import pytest
+
+from athero_percentiles import REFERENCE_DIGEST, evaluate_visit
+from scoring_benchmark import benchmark, make_payload
+from scoring_service import MAX_BODY_BYTES, ScoringServer, parse_items
+
+ITEM = {
+    "gender": "M", "age": 55,
+    "right": {"fundus_age": 60, "glaucoma_risk": 0.2, "atherosclerosis_risk": 0.0001},
+    "left": {"fundus_age": 58, "glaucoma_risk": 0.1, "atherosclerosis_risk": 0.0002},
+}
+
+
+def start_server(**kwargs) -> ScoringServer:
+    server = ScoringServer(**kwargs)
+    server.start_background()
+    return server
+
+
+@pytest.fixture
+def server():
+    server = start_server(workers=2, accept_wait=0.2)
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def connect(server) -> http.client.HTTPConnection:
+    return http.client.HTTPConnection("127.0.0.1", server.port, timeout=10)
+
+
+def post(connection, body: bytes, headers: dict | None = None):
+    connection.request("POST", "/v1/score", body, {"Content-Type": "application/json", **(headers or {})})
+    response = connection.getresponse()
+    data = response.read()
+    return response, json.loads(data) if data else None
+
+
+def post_raw_length(server, content_length: str):
+    """Content-Length だけを指定して本文を送らない。"""
+    connection = connect(server)
+    connection.putrequest("POST", "/v1/score")
+    connection.putheader("Content-Length", content_length)
+    connection.endheaders()
+    response = connection.getresponse()
+    body = json.loads(response.read())
+    connection.close()
+    return response, body
+
+
+def test_score_matches_evaluate_visit_over_keepalive(server):
+    connection = connect(server)
+    _gender, _age, (visit,) = parse_items({"items": [ITEM]})
+    expected = evaluate_visit("M", 55, visit)
+    for _ in range(2):
+        response, body = post(connection, json.dumps({"items": [ITEM, {**ITEM, "gender": None}]}).encode())
+        assert response.status == 200
+        assert body["reference"] == REFERENCE_DIGEST
+        first, unknown = body["results"]
+        assert first["peer_group"] == "50代・男性"
+        athero = next(m for m in first["metrics"] if m["metric"] == "atherosclerosis_risk")
+        assert athero["percentile"] == round(expected.get("atherosclerosis_risk").percentile, 1)
+        assert athero["message"]
+        assert unknown["peer_group"] is None
+        assert all(m["percentile"] is None and m["message"] is None for m in unknown["metrics"])
+    connection.close()
+
+    connection = connect(server)
+    connection.request("GET", "/metrics")
+    metrics = json.loads(connection.getresponse().read())
+    connection.close()
+    assert (metrics["requests"], metrics["items"]) == (2, 4)
+    # 2回のリクエストが1本の接続で処理された
+    assert metrics["connections"] == 2
+
+
+def test_healthz_and_unknown_path(server):
+    connection = connect(server)
+    connection.request("GET", "/healthz")
+    response = connection.getresponse()
+    assert (response.status, json.loads(response.read())["reference"]) == (200, REFERENCE_DIGEST)
+    connection.request("GET", "/nope")
+    response = connection.getresponse()
+    response.read()
+    assert response.status == 404
+    connection.close()
+
+
+@pytest.mark.parametrize("body", [
+    b'{"items": [{"gender": "M", "age": 55, "right": {"glaucoma_risk": NaN}}]}',
+    b'{"items": [{"gender": "M", "age": 55, "left": {"atherosclerosis_risk": Infinity}}]}',
+    b'{"items": [{"gender": "M", "age": 55, "left": {"atherosclerosis_risk": -Infinity}}]}',
+    b'{"items": [{"gender": "M", "age": 200}]}',
+    b'{"items": [{"gender": "M", "age": true}]}',
+    b'{"items": [{"gender": "M", "age": 55, "right": {"fundus_age": "60"}}]}',
+    b'{"items": {}}',
+    b"{not json",
+])
+def test_invalid_body_is_rejected(server, body):
+    connection = connect(server)
+    response, error = post(connection, body)
+    assert response.status == 400
+    assert error["error"]
+    # 400 の後も同じ接続で続けられる
+    response, _body = post(connection, json.dumps({"items": [ITEM]}).encode())
+    assert response.status == 200
+    connection.close()
+
+
+@pytest.mark.parametrize("content_length", ["-1", "abc"])
+def test_bad_content_length_is_rejected_and_closed(server, content_length):
+    response, body = post_raw_length(server, content_length)
+    assert response.status == 400
+    assert "Content-Length" in body["error"]
+    assert response.getheader("Connection") == "close"
+    assert server.metrics()["bad_requests"] == 1
+
+
+def test_oversized_body_is_rejected(server):
+    response, _body = post_raw_length(server, str(MAX_BODY_BYTES + 1))
+    assert response.status == 413
+    assert response.getheader("Connection") == "close"
+
+
+def test_overload_answers_503_and_recovers():
+    server = start_server(workers=1, accept_wait=0.2)
+    try:
+        # keep-alive の接続が唯一のワーカーを使っている間は、新しい接続は 503 で閉じられる
+        busy = connect(server)
+        assert post(busy, json.dumps({"items": [ITEM]}).encode())[0].status == 200
+        waiting = connect(server)
+        response, _body = post(waiting, json.dumps({"items": [ITEM]}).encode())
+        assert response.status == 503
+        assert response.getheader("Connection") == "close"
+        waiting.close()
+        assert server.metrics()["rejected"] == 1
+
+        # 接続を閉じればワーカーが空く
+        busy.close()
+        deadline = time.monotonic() + 5
+        while True:
+            connection = connect(server)
+            response, _body = post(connection, json.dumps({"items": [ITEM]}).encode())
+            connection.close()
+            if response.status == 200 or time.monotonic() > deadline:
+                break
+        assert response.status == 200
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_benchmark_payloads_are_accepted(server):
+    genders, ages, visits = parse_items(json.loads(make_payload(50, random.Random(1))))
+    assert len(genders) == len(ages) == len(visits) == 50
+    result = benchmark("127.0.0.1", server.port, clients=2, batch=20, seconds=0.3, warmup=0.1)
+    assert result["requests"] > 0
+    assert result["errors"] == 0
+    assert result["items_per_second"] > 0
@@ -0,0 +1,208 @@
+"""results と questionnaires を全件ストリーミングするためのキーセットページング。
+
+results を (captured_datetime, questionnaire_uuid, eye) の複合キー昇順で1ページずつ取得し、
+同じ撮影の左右の行を1件の撮影にまとめ、対応する問診（誕生日・性別）を付けて返す。
+ページ境界で左右が分かれた撮影は次のページまで持ち越すので、
+呼び出し側は常に完全な撮影だけを受け取る。手元に持つのは1ページ分だけ。
+
+撮影日時が NULL の行はキーにできないので読まない（qa_scan が別に数える）。
+誕生日や日時が読めない問診でも止まらず、読めなかったことを StreamedVisit.issues に残す。
+
+管理者ダッシュボード・一括エクスポートなど、スタッフ用のバッチ処理から使う（サービスキー前提）。
+"""
+
+from __future__ import annotations
+
+import logging
+from typing import Iterator
+
+from records import QuestionnaireRecord, VisitResults, parse_timestamp
+
+logger = logging.getLogger(__name__)
+
+STREAM_PAGE_SIZE = 500
+
+RESULT_STREAM_COLUMNS = (
+    "questionnaire_uuid, captured_datetime, eye, image_url, "
+    "fundus_age, glaucoma_risk, atherosclerosis_risk"
+)
+QUESTIONNAIRE_STREAM_COLUMNS = "uuid, bday, gender, height, weight, health, timestamp"
+
+
+class StreamCursor:
+    """results の複合キー（最後に処理した行）。ここより後の行から再開する。
+
+    eye は NULL（None）でもよい。昇順の並びでは NULL が同じ撮影の最後に来る。
+    """
+
+    __slots__ = ("captured_datetime", "uuid", "eye")
+
+    def __init__(self, captured_datetime: str, uuid: str, eye: str | None):
+        self.captured_datetime = captured_datetime
+        self.uuid = uuid
+        self.eye = eye
+
+    @classmethod
+    def from_row(cls, row: dict) -> StreamCursor:
+        return cls(row["captured_datetime"], row["questionnaire_uuid"], row.get("eye"))
+
+    def to_dict(self) -> dict:
+        return {"captured_datetime": self.captured_datetime, "uuid": self.uuid, "eye": self.eye}
+
+    @classmethod
+    def from_dict(cls, data: dict) -> StreamCursor:
+        return cls(data["captured_datetime"], data["uuid"], data.get("eye"))
+
+    def filter(self) -> str:
+        """PostgREST の or フィルタ（この行より後）。値は予約文字を含むので引用符で囲む。
+
+        eye.gt は NULL の行に一致しないので、同じ撮影の NULL の行は eye.is.null で拾う。
+        カーソル自体が NULL の行なら、その撮影には後に続く行がない。
+        """
+        ts, uuid = (f'"{v}"' for v in (self.captured_datetime, self.uuid))
+        parts = [
+            f"captured_datetime.gt.{ts}",
+            f"and(captured_datetime.eq.{ts},questionnaire_uuid.gt.{uuid})",
+        ]
+        if self.eye is not None:
+            parts.append(
+                f'and(captured_datetime.eq.{ts},questionnaire_uuid.eq.{uuid},'
+                f'or(eye.gt."{self.eye}",eye.is.null))'
+            )
+        return ",".join(parts)
+
+
+class StreamedVisit:
+    """1回の撮影（左右の結果と、あれば対応する問診）。
+
+    issues: まとめる途中で読めなかった値（"invalid_bday" / "invalid_captured_datetime"）
+    """
+
+    __slots__ = ("uuid", "captured_datetime", "visit", "questionnaire", "issues")
+
+    def __init__(self, uuid: str, captured_datetime: str, visit: VisitResults,
+                 questionnaire: QuestionnaireRecord | None, issues: tuple[str, ...] = ()):
+        self.uuid = uuid
+        self.captured_datetime = captured_datetime
+        self.visit = visit
+        self.questionnaire = questionnaire  # 問診が見つからなければ None
+        self.issues = issues
+
+
+class VisitBatch:
+    """1ページ分の撮影と、その最後の撮影までを処理済みとするカーソル。"""
+
+    __slots__ = ("visits", "cursor", "rows_read")
+
+    def __init__(self, visits: list[StreamedVisit], cursor: StreamCursor | None, rows_read: int):
+        self.visits = visits
+        self.cursor = cursor
+        self.rows_read = rows_read
+
+
+def fetch_result_page(client, after: StreamCursor | None, page_size: int) -> list[dict]:
+    query = client.table("results").select(RESULT_STREAM_COLUMNS).not_.is_("captured_datetime", "null")
+    if after is not None:
+        query = query.or_(after.filter())
+    response = query.order("captured_datetime") \
+        .order("questionnaire_uuid") \
+        .order("eye") \
+        .limit(page_size) \
+        .execute()
+    return response.data or []
+
+
+def fetch_questionnaires_for(client, rows: list[dict]) -> dict[tuple, tuple[QuestionnaireRecord, tuple[str, ...]]]:
+    """results の行に対応する問診を1回のクエリで取得し、(uuid, 撮影日時) で引ける dict にする。
+
+    値は (問診, 読めなかった値)。誕生日が読めない問診は bday を None にして "invalid_bday" を付ける。
+    """
+    if not rows:
+        return {}
+    uuids = sorted({row["questionnaire_uuid"] for row in rows})
+    timestamps = [row["captured_datetime"] for row in rows]
+    response = client.table("questionnaires").select(QUESTIONNAIRE_STREAM_COLUMNS) \
+        .in_("uuid", uuids) \
+        .gte("timestamp", min(timestamps)) \
+        .lte("timestamp", max(timestamps)) \
+        .execute()
+    return index_questionnaires(response.data or [])
+
+
+def index_questionnaires(rows: list[dict]) -> dict[tuple, tuple[QuestionnaireRecord, tuple[str, ...]]]:
+    """問診の行を (uuid, 撮影日時) で引ける dict にする（値は fetch_questionnaires_for と同じ）。"""
+    questionnaires = {}
+    for row in rows:
+        issues: tuple[str, ...] = ()
+        try:
+            record = QuestionnaireRecord.from_row(row)
+        except ValueError:
+            try:
+                record = QuestionnaireRecord.from_row({**row, "bday": None})
+                issues = ("invalid_bday",)
+            except ValueError:
+                # timestamp が読めない問診は撮影と対応づけられない（撮影側は問診なしになる）
+                logger.warning("skipping questionnaire with unreadable timestamp: %s", row.get("uuid"))
+                continue
+        questionnaires[(record.uuid, record.captured_at)] = (record, issues)
+    return questionnaires
+
+
+def iter_visit_batches(
+    client,
+    after: StreamCursor | None = None,
+    page_size: int = STREAM_PAGE_SIZE,
+    with_questionnaires: bool = True,
+) -> Iterator[VisitBatch]:
+    """results を先頭（または after の次）から最後まで、撮影単位のバッチで返す。"""
+    carry: list[dict] = []
+    while True:
+        rows = fetch_result_page(client, after, page_size)
+        last_page = len(rows) < page_size
+        if rows:
+            after = StreamCursor.from_row(rows[-1])
+        rows = carry + rows
+
+        # 末尾の撮影は次のページに続きがあるかもしれないので持ち越す
+        carry = []
+        if not last_page and rows:
+            tail_key = (rows[-1]["questionnaire_uuid"], rows[-1]["captured_datetime"])
+            while rows and (rows[-1]["questionnaire_uuid"], rows[-1]["captured_datetime"]) == tail_key:
+                carry.insert(0, rows.pop())
+
+        questionnaires = fetch_questionnaires_for(client, rows) if with_questionnaires else {}
+        visits = group_visits(rows, questionnaires)
+
+        cursor = StreamCursor.from_row(rows[-1]) if rows else None
+        if visits:
+            yield VisitBatch(visits, cursor, len(rows))
+        if last_page:
+            return
+
+
+def group_visits(rows: list[dict], questionnaires: dict) -> list[StreamedVisit]:
+    """(captured_datetime, questionnaire_uuid) 順に並んだ results の行を撮影ごとにまとめる。"""
+    visits: list[StreamedVisit] = []
+    group: list[dict] = []
+    for row in rows:
+        if group and (row["questionnaire_uuid"], row["captured_datetime"]) != (
+            group[0]["questionnaire_uuid"], group[0]["captured_datetime"]
+        ):
+            visits.append(_to_visit(group, questionnaires))
+            group = []
+        group.append(row)
+    if group:
+        visits.append(_to_visit(group, questionnaires))
+    return visits
+
+
+def _to_visit(rows: list[dict], questionnaires: dict[tuple, tuple[QuestionnaireRecord, tuple[str, ...]]]) -> StreamedVisit:
+    uuid = rows[0]["questionnaire_uuid"]
+    captured_datetime = rows[0]["captured_datetime"]
+    try:
+        captured_at = parse_timestamp(captured_datetime)
+    except ValueError:
+        visit = VisitResults.from_rows([{**row, "captured_datetime": None} for row in rows])
+        return StreamedVisit(uuid, captured_datetime, visit, None, ("invalid_captured_datetime",))
+    questionnaire, issues = questionnaires.get((uuid, captured_at), (None, ()))
+    return StreamedVisit(uuid, captured_datetime, VisitResults.from_rows(rows), questionnaire, issues)